@@ -0,0 +1,12 @@
+"""
+Дополнительные форматы ответа API.
+"""
+from rest_framework.renderers import JSONRenderer
+
+
+class ColumnarJSONRenderer(JSONRenderer):
+    """
+    JSON в колоночном виде (параллельные массивы вместо вложенных объектов).
+    Выбирается параметром ?format=columnar; данные готовит сама view.
+    """
+    format = 'columnar'
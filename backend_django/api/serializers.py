@@ -109,6 +109,7 @@ class RegisterSerializer(serializers.Serializer):
 class CompleteRegistrationSerializer(serializers.Serializer):
     """Сериализатор для завершения регистрации."""
     user_id = serializers.IntegerField()
+    external_id = serializers.CharField(max_length=255, required=False, allow_blank=True)
     
     def validate_user_id(self, value):
         """Проверка существования пользователя."""
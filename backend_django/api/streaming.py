@@ -0,0 +1,117 @@
+"""
+Потоковая отдача больших JSON ответов API.
+Ответ собирается из фрагментов по мере чтения строк из базы, поэтому
+память воркера не зависит от размера структуры.
+"""
+import json
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+from rest_framework.utils.encoders import JSONEncoder
+from mlm.models import StructureNode, StructureEvent
+from mlm.services import SUBTREE_FIELDS, structure_tree_node
+
+# Сколько строк читать из базы за раз (QuerySet.iterator) и склеивать в один фрагмент ответа
+STREAM_CHUNK_SIZE = 500
+
+
+def is_stream_requested(request):
+    """Клиент запросил потоковый режим (?stream=1)."""
+    return request.query_params.get('stream', '').lower() in ('1', 'true', 'yes')
+
+
+def dumps(data):
+    """JSON в том же виде, что и JSONRenderer DRF (компактно, без экранирования unicode)."""
+    return json.dumps(data, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':'))
+
+
+def json_stream_response(fragments):
+    """StreamingHttpResponse с типом application/json."""
+    return StreamingHttpResponse(
+        (fragment.encode('utf-8') for fragment in fragments),
+        content_type='application/json',
+    )
+
+
+def iter_json_array(items, serialize, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Отдать итерируемое как JSON массив фрагментами.
+    
+    Args:
+        items: итерируемое (например, queryset.iterator())
+        serialize: функция item -> JSON-совместимый объект
+        chunk_size: сколько элементов склеивать в один фрагмент
+    
+    Yields:
+        str: Фрагменты JSON
+    """
+    yield '['
+    buffer = []
+    first = True
+    for item in items:
+        buffer.append(dumps(serialize(item)))
+        if len(buffer) >= chunk_size:
+            yield ('' if first else ',') + ','.join(buffer)
+            first = False
+            buffer = []
+    if buffer:
+        yield ('' if first else ',') + ','.join(buffer)
+    yield ']'
+
+
+def iter_structure_tree_json(root_node, max_depth=None, chunk_size=STREAM_CHUNK_SIZE, version=None):
+    """
+    Отдать дерево get_structure_tree фрагментами JSON без сборки дерева в памяти.
+    
+    Узлы читаются в порядке материализованного пути - это обход в глубину,
+    поэтому каждый узел можно сразу записать в ответ, а в памяти держится
+    только стек открытых узлов (не глубже дерева). Требует заполненных путей.
+    
+    Узлы читаются вне транзакции, поэтому с version узлы, добавленные позже
+    этой версии или еще без версии (по журналу StructureEvent), пропускаются: ответ соответствует
+    версии из ETag, даже если размещение закоммитилось во время отдачи.
+    
+    Args:
+        root_node: StructureNode корня (с заполненным path)
+        max_depth: Максимальная глубина (если None - без ограничений)
+        chunk_size: размер пакета чтения из базы
+        version: версия структуры, на которую отдается дерево
+    
+    Yields:
+        str: Фрагменты JSON
+    """
+    queryset = StructureNode.objects.filter(path__startswith=root_node.path, level__gte=root_node.level)
+    if max_depth is not None:
+        queryset = queryset.filter(level__lte=root_node.level + max_depth)
+    if version is not None:
+        queryset = queryset.exclude(user_id__in=StructureEvent.objects.filter(
+            Q(version__gt=version) | Q(version=None),
+            event_type=StructureEvent.EventType.NODE_CREATED,
+        ).values('user_id'))
+    rows = queryset.order_by('path').values(*SUBTREE_FIELDS).iterator(chunk_size=chunk_size)
+    
+    stack = []  # пути открытых узлов; у последнего еще пишутся дети
+    has_children = []  # у открытого узла уже записан хотя бы один ребенок
+    buffer = []
+    for row in rows:
+        while stack and not row['path'].startswith(stack[-1]):
+            stack.pop()
+            has_children.pop()
+            buffer.append(']}')
+        
+        if has_children:
+            if has_children[-1]:
+                buffer.append(',')
+            has_children[-1] = True
+        
+        # Узел без закрывающих скобок: дети допишутся следом
+        node_json = dumps(structure_tree_node(row))
+        buffer.append(node_json[:-len('[]}')] + '[')
+        stack.append(row['path'])
+        has_children.append(False)
+        
+        if len(buffer) >= chunk_size:
+            yield ''.join(buffer)
+            buffer = []
+    
+    buffer.append(']}' * len(stack))
+    yield ''.join(buffer)
@@ -0,0 +1,132 @@
+import json
+import time
+from decimal import Decimal
+
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+
+from core.models import User
+from mlm.models import Tariff, StructureNode
+from billing.models import Payment, Bonus, PaymentNotification
+from billing.webhooks import SIGNATURE_HEADER, TIMESTAMP_HEADER, sign_payload, process_notification_batch
+
+WEBHOOK_SECRET = 'test-secret'
+
+
+class ApiTestCase(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.tariff = Tariff.objects.create(code='basic', name='Basic', entry_amount=Decimal('100.00'))
+
+    def _pending(self, username, inviter=None):
+        user = User.objects.create(username=username, referral_code=username.upper(), invited_by=inviter)
+        payment = Payment.objects.create(user=user, tariff=self.tariff, amount=self.tariff.entry_amount)
+        return user, payment
+
+
+@override_settings(REGISTRATION_COMPLETION_ASYNC=False)
+class CompleteIdempotencyTests(ApiTestCase):
+    """Повтор /api/complete/ с тем же ключом не размещает пользователя повторно."""
+
+    def _complete(self, data, key):
+        return self.client.post('/api/complete/', data, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_replay_returns_stored_response(self):
+        root, _ = self._pending('root')
+        self._complete({'user_id': root.pk}, 'key-root')
+        user, _ = self._pending('partner', inviter=root)
+        data = {'user_id': user.pk, 'external_id': 'ext-1'}
+
+        first = self._complete(data, 'key-1')
+        self.assertEqual(first.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', first)
+        bonuses = Bonus.objects.count()
+
+        replay = self._complete(data, 'key-1')
+        self.assertEqual(replay.status_code, 200)
+        self.assertEqual(replay['Idempotent-Replayed'], 'true')
+        self.assertEqual(replay.json(), first.json())
+        self.assertEqual(StructureNode.objects.filter(user=user).count(), 1)
+        self.assertEqual(Bonus.objects.count(), bonuses)
+
+    def test_same_key_with_other_body_is_rejected(self):
+        user, _ = self._pending('root')
+        self._complete({'user_id': user.pk}, 'key-1')
+        other, _ = self._pending('other')
+        response = self._complete({'user_id': other.pk}, 'key-1')
+        self.assertEqual(response.status_code, 422)
+        self.assertFalse(StructureNode.objects.filter(user=other).exists())
+
+    def test_external_id_is_used_as_key(self):
+        user, _ = self._pending('root')
+        data = {'user_id': user.pk, 'external_id': 'ext-1'}
+        first = self.client.post('/api/complete/', data, format='json')
+        replay = self.client.post('/api/complete/', data, format='json')
+        self.assertEqual(replay['Idempotent-Replayed'], 'true')
+        self.assertEqual(replay.json(), first.json())
+
+
+@override_settings(PAYMENT_WEBHOOK_SECRET=WEBHOOK_SECRET)
+class PaymentWebhookTests(ApiTestCase):
+    """Вебхук провайдера проверяет подпись и игнорирует повторную доставку."""
+
+    def _post(self, events, timestamp=None, secret=WEBHOOK_SECRET, signature=None):
+        body = json.dumps(events).encode('utf-8')
+        timestamp = str(int(time.time()) if timestamp is None else timestamp)
+        headers = {TIMESTAMP_HEADER: timestamp, SIGNATURE_HEADER: signature or sign_payload(body, timestamp, secret)}
+        return self.client.generic(
+            'POST', '/api/webhooks/payments/', body, content_type='application/json',
+            headers=headers,
+        )
+
+    def _event(self, payment, event_id='evt-1', status='completed'):
+        return {
+            'event_id': event_id,
+            'payment_id': payment.pk,
+            'external_id': f'ext-{payment.pk}',
+            'status': status,
+            'amount': str(payment.amount),
+        }
+
+    def test_signed_event_is_accepted_and_processed(self):
+        user, payment = self._pending('root')
+        response = self._post(self._event(payment))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json(), {'accepted': 1, 'duplicates': 0})
+
+        self.assertEqual(process_notification_batch(), {PaymentNotification.Status.PROCESSED: 1})
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.external_id), (Payment.PaymentStatus.COMPLETED, f'ext-{payment.pk}'))
+        self.assertTrue(StructureNode.objects.filter(user=user).exists())
+
+    def test_redelivery_is_deduplicated(self):
+        _, payment = self._pending('root')
+        self._post(self._event(payment))
+        response = self._post([self._event(payment), self._event(payment, event_id='evt-2', status='failed')])
+        self.assertEqual(response.json(), {'accepted': 1, 'duplicates': 1})
+        self.assertEqual(PaymentNotification.objects.filter(event_id='evt-1').count(), 1)
+
+        counts = process_notification_batch()
+        self.assertEqual(counts, {PaymentNotification.Status.PROCESSED: 1, PaymentNotification.Status.SKIPPED: 1})
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, Payment.PaymentStatus.COMPLETED)
+
+    def test_invalid_signatures_are_rejected(self):
+        _, payment = self._pending('root')
+        event = self._event(payment)
+        for label, kwargs in (
+            ('wrong secret', {'secret': 'other-secret'}),
+            ('stale timestamp', {'timestamp': int(time.time()) - 3600}),
+            ('malformed signature', {'signature': 'sha256=deadbeef'}),
+        ):
+            with self.subTest(label):
+                self.assertEqual(self._post(event, **kwargs).status_code, 401)
+        response = self.client.post('/api/webhooks/payments/', event, format='json')
+        self.assertEqual(response.status_code, 401)
+        self.assertFalse(PaymentNotification.objects.exists())
+
+    @override_settings(PAYMENT_WEBHOOK_SECRET='')
+    def test_unconfigured_webhook_is_unavailable(self):
+        _, payment = self._pending('root')
+        self.assertEqual(self._post(self._event(payment), secret=WEBHOOK_SECRET).status_code, 503)
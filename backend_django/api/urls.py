@@ -17,10 +17,16 @@ urlpatterns = [
     
     # Завершение регистрации
     path('complete/', views.complete, name='api-complete'),
+    path('complete/jobs/<int:job_id>/', views.completion_job, name='api-completion-job'),
+    
+    # Уведомления платежного провайдера (обрабатываются воркером)
+    path('webhooks/payments/', views.payment_webhook, name='api-payment-webhook'),
     
     # Структура MLM
     path('structure/', views.structure, name='api-structure'),
     path('structure/tree/', views.structure_tree, name='api-structure-tree'),
+    path('structure/children/', views.structure_children, name='api-structure-children'),
+    path('structure/changes/', views.structure_changes, name='api-structure-changes'),
     path('structure/generate/', views.generate_structure, name='api-generate-structure'),
     
     # Бонусы (из базы данных)
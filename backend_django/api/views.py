@@ -2,29 +2,60 @@
 API Views для REST API.
 Все расчеты и размещение происходят на сервере.
 """
+import json
 import secrets
 import random
 import string
 import logging
 from decimal import Decimal
-from django.db import transaction, models
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction, models
+from django.http import HttpResponse, HttpResponseNotModified
+from django.urls import reverse
 from django.utils import timezone
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, authentication_classes, permission_classes, renderer_classes
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.settings import api_settings
 from core.models import User
 from mlm.models import StructureNode, Tariff
-from mlm.services import place_user, get_structure_tree, get_active_tariff
-from billing.models import Payment, Bonus
-from billing.services import apply_signup_bonuses
+from mlm.services import (
+    place_users_bulk, get_structure_tree, get_structure_columnar, get_structure_root, get_structure_children,
+    get_active_tariff,
+    get_structure_version, get_structure_changes, create_root_node,
+    structure_snapshot, structure_changes_pending,
+)
+from billing.models import Payment, Bonus, CompletionJob
+from billing.services import (
+    complete_registration, get_bonus_totals_summary,
+    IdempotencyKeyMismatch, request_fingerprint, get_idempotent_result, save_idempotent_result
+)
+from billing.jobs import enqueue_completion, get_queue_position
+from billing.webhooks import (
+    SIGNATURE_HEADER, TIMESTAMP_HEADER, WebhookError, WebhookSignatureError,
+    parse_notifications, store_notifications, verify_signature
+)
 from .serializers import (
     RegisterSerializer, CompleteRegistrationSerializer, QueueItemSerializer,
     StructureNodeSerializer, BonusSerializer, TariffSerializer
 )
+from .renderers import ColumnarJSONRenderer
+from .streaming import (
+    STREAM_CHUNK_SIZE, dumps, is_stream_requested, json_stream_response, iter_json_array, iter_structure_tree_json
+)
 
 logger = logging.getLogger(__name__)
 
+# Операция для ключей идемпотентности /api/complete/
+COMPLETE_IDEMPOTENCY_SCOPE = 'complete'
+
+# Размер страницы детей узла для ленивого раскрытия дерева
+STRUCTURE_CHILDREN_PAGE_SIZE = 50
+STRUCTURE_CHILDREN_MAX_PAGE_SIZE = 500
+
 
 @api_view(['GET'])
 @permission_classes([AllowAny])
@@ -187,7 +218,29 @@ def complete(request):
     """
     Завершить регистрацию партнера.
     Все расчеты и размещение на сервере.
+    
+    Идемпотентность: ключ берется из заголовка Idempotency-Key (или из external_id
+    платежа провайдера). Повтор запроса с тем же ключом возвращает сохраненный
+    результат с заголовком Idempotent-Replayed, не размещая пользователя повторно.
+    
+    При REGISTRATION_COMPLETION_ASYNC завершение ставится в очередь: ответ 202
+    с ID задачи, статус - /api/complete/jobs/<id>/.
     """
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if not idempotency_key and isinstance(request.data, dict):
+        # Тело может быть не объектом (например, списком) - тогда его отклонит сериализатор
+        idempotency_key = request.data.get('external_id')
+    idempotency_key = idempotency_key or None
+    request_hash = request_fingerprint(request.data)
+    if idempotency_key:
+        try:
+            stored = get_idempotent_result(COMPLETE_IDEMPOTENCY_SCOPE, idempotency_key, request_hash)
+        except IdempotencyKeyMismatch as e:
+            return Response({"error": str(e)}, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+        if stored is not None:
+            logger.info(f"↩️ Повтор запроса с ключом {idempotency_key}: возвращаем сохраненный результат")
+            return _idempotent_replay(stored)
+    
     serializer = CompleteRegistrationSerializer(data=request.data)
     
     if not serializer.is_valid():
@@ -242,56 +295,53 @@ def complete(request):
                 status=status.HTTP_400_BAD_REQUEST
             )
     
+    if settings.REGISTRATION_COMPLETION_ASYNC:
+        return _enqueue_complete(
+            request, user, payment,
+            serializer.validated_data.get('external_id'), idempotency_key, request_hash,
+        )
+    
     try:
         with transaction.atomic():
-            # 1. Завершаем платеж
-            logger.info(f"🔄 Завершаем платеж {payment.id}")
-            payment.mark_completed()
-            
-            # 2. Меняем статус пользователя на PARTNER
-            if user.status == User.UserStatus.PARTICIPANT:
-                logger.info(f"🔄 Меняем статус пользователя {user.username} на PARTNER")
-                user.status = User.UserStatus.PARTNER
-                user.save()
-            else:
-                logger.info(f"ℹ️ Статус пользователя {user.username} уже {user.get_status_display()}")
+            # Блокируем платеж: параллельный запрос дождется этой транзакции и увидит платеж завершенным
+            locked_payment = Payment.objects.select_for_update().filter(
+                pk=payment.pk,
+                status=Payment.PaymentStatus.PENDING
+            ).first()
+            if locked_payment is None:
+                stored = None
+                if idempotency_key:
+                    stored = get_idempotent_result(COMPLETE_IDEMPOTENCY_SCOPE, idempotency_key, request_hash)
+                if stored is not None:
+                    return _idempotent_replay(stored)
+                logger.warning(f"⚠️ Платеж {payment.id} уже завершен параллельным запросом")
+                return Response(
+                    {"error": "Платеж уже завершен параллельным запросом"},
+                    status=status.HTTP_409_CONFLICT
+                )
             
-            # 3. Размещаем пользователя в структуре (на сервере)
-            try:
-                logger.info(f"🔄 Размещаем пользователя {user.username} в структуре")
-                structure_node = place_user(user, payment)
-                logger.info(f"✅ Пользователь {user.username} размещен: Level {structure_node.level}, Position {structure_node.position}")
-            except Exception as place_error:
-                logger.error(f"❌ Ошибка при размещении пользователя {user.username} в структуре: {place_error}")
-                # Если размещение не удалось, продолжаем и начисляем бонусы
-                structure_node = None
-            
-            # 4. Начисляем бонусы (на сервере, согласно БД)
-            try:
-                logger.info(f"🔄 Начисляем бонусы для пользователя {user.username}")
-                bonuses = apply_signup_bonuses(user, payment)
-                logger.info(f"✅ Начислено бонусов: {len(bonuses)}")
-            except Exception as bonus_error:
-                logger.error(f"❌ Ошибка при начислении бонусов: {bonus_error}")
-                bonuses = []
-            
-            response_data = {
-                "detail": "Регистрация завершена",
-                "bonuses_created": len(bonuses),
-            }
-            
-            if structure_node:
-                response_data.update({
-                    "placement_parent": structure_node.parent.username if structure_node.parent else None,
-                    "level": structure_node.level,
-                    "position": structure_node.position,
-                })
-            else:
-                response_data["warning"] = "Пользователь не был размещен в структуре (возможно, структура заполнена или произошла ошибка)"
+            logger.info(f"🔄 Завершаем платеж {payment.id}, размещаем и начисляем бонусы")
+            response_data = complete_registration(
+                user,
+                locked_payment,
+                external_id=serializer.validated_data.get('external_id'),
+            )
+            if idempotency_key:
+                save_idempotent_result(
+                    COMPLETE_IDEMPOTENCY_SCOPE, idempotency_key, request_hash,
+                    status.HTTP_200_OK, response_data, payment=locked_payment,
+                )
             
             logger.info(f"✅ Регистрация завершена для пользователя {user.username}")
             return Response(response_data, status=status.HTTP_200_OK)
     
+    except IntegrityError as e:
+        # external_id уже принадлежит другому платежу (или ключ занят параллельным запросом)
+        logger.warning(f"⚠️ Конфликт при завершении регистрации: {e}")
+        return Response(
+            {"error": "Платеж с этим external_id или ключом идемпотентности уже обработан"},
+            status=status.HTTP_409_CONFLICT
+        )
     except Exception as e:
         logger.error(f"❌ Критическая ошибка при завершении регистрации: {e}", exc_info=True)
         return Response(
@@ -300,26 +350,151 @@ def complete(request):
         )
 
 
+def _enqueue_complete(request, user, payment, external_id, idempotency_key, request_hash):
+    """Поставить завершение регистрации в очередь и ответить 202 с ID задачи."""
+    try:
+        with transaction.atomic():
+            job, created = enqueue_completion(user, payment, external_id=external_id)
+            status_url = request.build_absolute_uri(reverse('api-completion-job', args=[job.pk]))
+            response_data = {
+                "detail": "Завершение регистрации поставлено в очередь",
+                "job_id": job.pk,
+                "status": job.status,
+                "status_url": status_url,
+            }
+            if idempotency_key:
+                save_idempotent_result(
+                    COMPLETE_IDEMPOTENCY_SCOPE, idempotency_key, request_hash,
+                    status.HTTP_202_ACCEPTED, response_data, payment=payment,
+                )
+    except (ValidationError, IntegrityError) as e:
+        # Параллельный запрос с тем же ключом уже поставил задачу - возвращаем его ответ
+        stored = None
+        if idempotency_key:
+            stored = get_idempotent_result(COMPLETE_IDEMPOTENCY_SCOPE, idempotency_key, request_hash)
+        if stored is not None:
+            return _idempotent_replay(stored)
+        logger.warning(f"⚠️ Конфликт при постановке завершения в очередь: {e}")
+        error = e.messages[0] if isinstance(e, ValidationError) else "Ключ идемпотентности уже использован параллельным запросом"
+        return Response({"error": error}, status=status.HTTP_409_CONFLICT)
+    
+    if created:
+        logger.info(f"📥 Завершение регистрации {user.username} поставлено в очередь: задача #{job.pk}")
+    return Response(response_data, status=status.HTTP_202_ACCEPTED, headers={'Location': status_url})
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def completion_job(request, job_id):
+    """
+    Статус задачи завершения регистрации.
+    
+    queue_position - сколько задач перед этой (только для задач в очереди),
+    result - ответ завершения (как у синхронного /api/complete/).
+    """
+    try:
+        job = CompletionJob.objects.get(pk=job_id)
+    except CompletionJob.DoesNotExist:
+        return Response(
+            {"error": f"Задача {job_id} не найдена"},
+            status=status.HTTP_404_NOT_FOUND
+        )
+    
+    return Response({
+        "job_id": job.pk,
+        "status": job.status,
+        "user_id": job.user_id,
+        "payment_id": job.payment_id,
+        "queue_position": get_queue_position(job),
+        "result": job.result,
+        "error": job.error,
+        "created_at": job.created_at,
+        "finished_at": job.finished_at,
+    })
+
+
+def _idempotent_replay(record):
+    """Ответ из сохраненного результата запроса с ключом идемпотентности."""
+    return Response(
+        record.response_body,
+        status=record.response_status,
+        headers={'Idempotent-Replayed': 'true'},
+    )
+
+
+@api_view(['POST'])
+@authentication_classes([])
+@permission_classes([AllowAny])
+def payment_webhook(request):
+    """
+    Принять уведомления платежного провайдера (одно или пакет).
+    
+    Запрос только проверяется и сохраняется во входящую очередь одним
+    bulk_create; завершение платежей, размещение и бонусы выполняет воркер
+    process_payment_notifications. Ответ 202 отправляется сразу.
+    """
+    if not settings.PAYMENT_WEBHOOK_SECRET:
+        return Response({"error": "Вебхук провайдера не настроен"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    
+    body = request.body
+    try:
+        verify_signature(body, request.headers.get(TIMESTAMP_HEADER), request.headers.get(SIGNATURE_HEADER))
+    except WebhookSignatureError as e:
+        logger.warning(f"⚠️ Вебхук провайдера: {e}")
+        return Response({"error": str(e)}, status=status.HTTP_401_UNAUTHORIZED)
+    
+    try:
+        notifications = parse_notifications(json.loads(body, parse_float=Decimal))
+    except ValueError:
+        return Response({"error": "Тело запроса должно быть JSON"}, status=status.HTTP_400_BAD_REQUEST)
+    except WebhookError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    accepted, duplicates = store_notifications(notifications)
+    logger.info(f"📥 Вебхук провайдера: принято {accepted}, повторов {duplicates}")
+    return Response({"accepted": accepted, "duplicates": duplicates}, status=status.HTTP_202_ACCEPTED)
+
+
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def structure(request):
     """
     Получить структуру MLM.
     Данные из базы данных.
+    
+    С параметром ?stream=1 ответ отдается потоково: узлы читаются пакетами
+    и сразу пишутся в ответ, не собираясь в памяти целиком.
     """
     # Получаем все узлы структуры
     nodes = StructureNode.objects.select_related('user', 'parent', 'tariff').all()
     
+    if is_stream_requested(request):
+        return json_stream_response(iter_json_array(
+            nodes.iterator(chunk_size=STREAM_CHUNK_SIZE),
+            lambda node: StructureNodeSerializer(node).data,
+        ))
+    
     serializer = StructureNodeSerializer(nodes, many=True)
     return Response(serializer.data)
 
 
 @api_view(['GET'])
 @permission_classes([AllowAny])
+@renderer_classes(api_settings.DEFAULT_RENDERER_CLASSES + [ColumnarJSONRenderer])
 def structure_tree(request):
     """
     Получить дерево структуры для визуализации.
     Данные из базы данных.
+    
+    С параметром ?stream=1 дерево отдается потоково (в порядке обхода в глубину),
+    если у структуры заполнены материализованные пути.
+    
+    Готовый JSON кэшируется по (корень, max_depth, версия структуры); та же версия
+    используется как ETag, поэтому при опросе без изменений клиент получает 304.
+    Версия и дерево читаются в одном снимке (structure_snapshot), иначе размещение,
+    закоммиченное между ними, попало бы в кэш и ETag старой версии.
+    
+    С параметром ?format=columnar дерево отдается параллельными массивами без вложенности.
     """
     root_user_id = request.query_params.get('root_user_id', None)
     max_depth = request.query_params.get('max_depth', None)
@@ -336,12 +511,117 @@ def structure_tree(request):
     
     max_depth_int = int(max_depth) if max_depth else None
     
-    tree = get_structure_tree(root_user, max_depth_int)
+    columnar = request.accepted_renderer.format == ColumnarJSONRenderer.format
+    wire_format = 'columnar' if columnar else 'tree'
+    
+    # Дерево меняется только при размещении: версия структуры - ключ кэша и ETag
+    def make_etag(version):
+        return f'"structure-{version}-{root_user.id if root_user else "root"}-{max_depth_int}-{wire_format}"'
+    
+    version = get_structure_version()
+    etag = make_etag(version)
+    if etag in _parse_if_none_match(request):
+        return HttpResponseNotModified(headers={'ETag': etag})
+    
+    if not columnar and is_stream_requested(request) and (max_depth_int is None or max_depth_int > 0):
+        root_node = get_structure_root(root_user)
+        if root_node is None:
+            return Response({"error": "Структура пуста"}, status=status.HTTP_404_NOT_FOUND)
+        if root_node.path:
+            response = json_stream_response(
+                iter_structure_tree_json(root_node, max_depth_int, chunk_size=STREAM_CHUNK_SIZE, version=version)
+            )
+            response['ETag'] = etag
+            return response
+    
+    cache_key_prefix = f'structure_tree:{wire_format}:{root_user.id if root_user else "root"}:{max_depth_int}'
+    content = cache.get(f'{cache_key_prefix}:{version}')
+    if content is None:
+        # Версия перечитывается в снимке вместе с деревом: кэш и ETag - версии, которую отражает дерево
+        with structure_snapshot():
+            version = get_structure_version()
+            pending = structure_changes_pending()
+            if columnar:
+                tree = get_structure_columnar(root_user, max_depth_int)
+            else:
+                tree = get_structure_tree(root_user, max_depth_int)
+        
+        if tree is None:
+            return Response({"error": "Структура пуста"}, status=status.HTTP_404_NOT_FOUND)
+        
+        content = dumps(tree).encode('utf-8')
+        if pending:
+            # В дереве есть изменения, еще не получившие версию: не кэшируем и не отдаем ETag
+            return HttpResponse(content, content_type='application/json')
+        cache.set(f'{cache_key_prefix}:{version}', content, settings.MLM_SETTINGS['STRUCTURE_CACHE_TIMEOUT'])
+        etag = make_etag(version)
+    
+    return HttpResponse(content, content_type='application/json', headers={'ETag': etag})
+
+
+def _parse_if_none_match(request):
+    """Список ETag из заголовка If-None-Match."""
+    header = request.headers.get('If-None-Match', '')
+    return [tag.strip() for tag in header.split(',') if tag.strip()]
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def structure_changes(request):
+    """
+    Изменения структуры после версии клиента (?since=<version>).
+    
+    Версию клиент берет из поля version прошлого ответа или из ETag дерева.
+    Если resync=true - дельты недостаточно, дерево нужно загрузить заново.
+    """
+    try:
+        since = int(request.query_params.get('since', ''))
+    except ValueError:
+        return Response(
+            {"error": "Параметр since обязателен и должен быть числом"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    return Response(get_structure_changes(since))
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def structure_children(request):
+    """
+    Получить прямых детей одного узла (ленивое раскрытие дерева).
+    
+    Параметры: user_id (по умолчанию корень), cursor (next_cursor прошлой страницы), limit.
+    У каждого узла есть has_children и descendant_count.
+    """
+    user_id = request.query_params.get('user_id', None)
+    cursor = request.query_params.get('cursor', None)
+    limit = request.query_params.get('limit', None)
+    
+    try:
+        user_id = int(user_id) if user_id else None
+        cursor = int(cursor) if cursor else None
+        limit = int(limit) if limit else STRUCTURE_CHILDREN_PAGE_SIZE
+    except ValueError:
+        return Response(
+            {"error": "user_id, cursor и limit должны быть числами"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    limit = max(1, min(limit, STRUCTURE_CHILDREN_MAX_PAGE_SIZE))
     
-    if tree is None:
-        return Response({"error": "Структура пуста"}, status=status.HTTP_404_NOT_FOUND)
+    if user_id:
+        parent_node = StructureNode.objects.filter(user_id=user_id).first()
+        if parent_node is None:
+            return Response(
+                {"error": "Пользователь не размещен в структуре"},
+                status=status.HTTP_404_NOT_FOUND
+            )
+    else:
+        parent_node = get_structure_root()
+        if parent_node is None:
+            return Response({"error": "Структура пуста"}, status=status.HTTP_404_NOT_FOUND)
     
-    return Response(tree)
+    return Response(get_structure_children(parent_node, after_position=cursor, limit=limit))
 
 
 @api_view(['GET'])
@@ -457,17 +737,10 @@ def stats(request):
     total_nodes = StructureNode.objects.count()
     pending_payments = Payment.objects.filter(status=Payment.PaymentStatus.PENDING).count()
     
-    total_bonuses = Bonus.objects.aggregate(
-        total=models.Sum('amount')
-    )['total'] or 0
-    
-    green_bonuses = Bonus.objects.filter(bonus_type=Bonus.BonusType.GREEN).aggregate(
-        total=models.Sum('amount')
-    )['total'] or 0
-    
-    yellow_bonuses = Bonus.objects.filter(bonus_type=Bonus.BonusType.YELLOW).aggregate(
-        total=models.Sum('amount')
-    )['total'] or 0
+    bonus_summary = get_bonus_totals_summary()
+    total_bonuses = bonus_summary['total']
+    green_bonuses = bonus_summary['green']
+    yellow_bonuses = bonus_summary['yellow']
     
     return Response({
         "users": {
@@ -533,15 +806,7 @@ def _get_or_create_tariff():
 
 def _ensure_root_structure(root_user, tariff):
     """Создает корневой узел, если его еще нет."""
-    StructureNode.objects.get_or_create(
-        user=root_user,
-        defaults={
-            "parent": None,
-            "position": 1,
-            "level": 0,
-            "tariff": tariff,
-        },
-    )
+    create_root_node(root_user, tariff)
     if root_user.status != User.UserStatus.PARTNER:
         root_user.status = User.UserStatus.PARTNER
         root_user.save(update_fields=["status"])
@@ -555,7 +820,7 @@ def _generate_username(seed):
 
 def _create_demo_partners(root_user, tariff, count):
     """Создает тестовых партнеров."""
-    created_usernames = []
+    created_users = []
     for index in range(count):
         username = _generate_username(index)
         user, created = User.objects.get_or_create(
@@ -566,21 +831,22 @@ def _create_demo_partners(root_user, tariff, count):
                 "invited_by": root_user,
             },
         )
-        if not created:
-            continue
+        if created:
+            created_users.append(user)
 
-        payment = Payment.objects.create(
+    payments = Payment.objects.bulk_create([
+        Payment(
             user=user,
             tariff=tariff,
             amount=tariff.entry_amount,
             status=Payment.PaymentStatus.COMPLETED,
             completed_at=timezone.now(),
         )
-        place_user(user, payment)
-        # Начисляем бонусы
-        apply_signup_bonuses(user, payment)
-        created_usernames.append(username)
-    return created_usernames
+        for user in created_users
+    ])
+    # Размещаем всех одним пакетом и начисляем бонусы
+    place_users_bulk(zip(created_users, payments))
+    return [user.username for user in created_users]
 
 
 @api_view(['POST', 'GET'])
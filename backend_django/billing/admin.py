@@ -2,7 +2,7 @@ from django.contrib import admin
 from django.utils.html import format_html
 from django.db.models import Sum, Count
 from django.urls import reverse
-from .models import Payment, Bonus
+from .models import Payment, Bonus, LedgerEntry, PaymentNotification, CompletionJob
 
 
 @admin.register(Payment)
@@ -213,3 +213,86 @@ class BonusAdmin(admin.ModelAdmin):
             return "-"
     get_payment_link.short_description = "Платеж"
     get_payment_link.admin_order_field = 'payment__id'
+
+
+@admin.register(LedgerEntry)
+class LedgerEntryAdmin(admin.ModelAdmin):
+    """Журнал баланса: только просмотр (записи добавляются сервисами billing)."""
+    list_display = ['id', 'get_user_link', 'get_delta_display', 'balance_after', 'reason', 'payment', 'bonus', 'created_at']
+    list_filter = ['reason', 'created_at']
+    search_fields = ['user__username', 'description']
+    raw_id_fields = ['user', 'payment', 'bonus']
+    list_select_related = ['user']
+    date_hierarchy = 'created_at'
+    list_per_page = 50
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
+    
+    def get_user_link(self, obj):
+        """Ссылка на пользователя."""
+        return format_html(
+            '<a href="{}">{}</a>',
+            reverse('admin:core_user_change', args=[obj.user_id]),
+            obj.user.username
+        )
+    get_user_link.short_description = "Пользователь"
+    get_user_link.admin_order_field = 'user__username'
+    
+    def get_delta_display(self, obj):
+        """Изменение баланса с цветом."""
+        color = '#28a745' if obj.delta > 0 else '#dc3545'
+        return format_html(
+            '<span style="color: {}; font-weight: bold;">{}</span>',
+            color,
+            f"{obj.delta:+.2f}"
+        )
+    get_delta_display.short_description = "Изменение"
+    get_delta_display.admin_order_field = 'delta'
+
+
+@admin.register(PaymentNotification)
+class PaymentNotificationAdmin(admin.ModelAdmin):
+    """Входящие уведомления провайдера: только просмотр (записывает вебхук, обрабатывает воркер)."""
+    list_display = ['id', 'event_id', 'payment', 'payment_status', 'amount', 'status', 'received_at', 'processed_at']
+    list_filter = ['status', 'payment_status', 'received_at']
+    search_fields = ['event_id', 'external_id', 'error']
+    raw_id_fields = ['payment']
+    date_hierarchy = 'received_at'
+    list_per_page = 50
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(CompletionJob)
+class CompletionJobAdmin(admin.ModelAdmin):
+    """Очередь завершения регистраций: только просмотр (задачи ставит API, выполняет воркер)."""
+    list_display = ['id', 'user', 'payment', 'status', 'created_at', 'finished_at']
+    list_filter = ['status', 'created_at']
+    search_fields = ['user__username', 'external_id', 'error']
+    raw_id_fields = ['user', 'payment']
+    list_select_related = ['user']
+    date_hierarchy = 'created_at'
+    list_per_page = 50
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,118 @@
+"""
+Очередь завершения регистраций в БД (CompletionJob).
+
+/api/complete/ ставит задачу (enqueue_completion) и сразу отвечает 202,
+воркер (python manage.py process_completion_jobs) выполняет задачи по одной
+в транзакции в порядке id через complete_registration. Для строгого порядка
+размещения запускайте один воркер; на PostgreSQL несколько воркеров берут
+разные задачи (SKIP LOCKED).
+"""
+import logging
+from collections import Counter
+
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import Payment, CompletionJob
+from .services import complete_registration
+
+logger = logging.getLogger(__name__)
+
+
+@transaction.atomic
+def enqueue_completion(user, payment, external_id=None):
+    """
+    Поставить завершение регистрации в очередь.
+
+    Повторная постановка того же платежа возвращает задачу, которая уже в очереди.
+
+    Args:
+        user: User объект
+        payment: ожидающий Payment объект
+        external_id: ID платежа у провайдера (уникален среди платежей)
+
+    Returns:
+        tuple: (CompletionJob, создана ли новая задача)
+
+    Raises:
+        ValidationError: если платеж уже не в статусе PENDING или external_id занят
+    """
+    # Блокировка платежа сериализует параллельные постановки одного платежа
+    locked = Payment.objects.select_for_update().filter(pk=payment.pk).first()
+    if locked is None or locked.status != Payment.PaymentStatus.PENDING:
+        raise ValidationError("Платеж уже завершен")
+    if external_id and Payment.objects.filter(external_id=external_id).exclude(pk=payment.pk).exists():
+        raise ValidationError(f"external_id {external_id} уже принадлежит другому платежу")
+
+    job = CompletionJob.objects.filter(payment=payment, status=CompletionJob.Status.QUEUED).first()
+    if job is not None:
+        return job, False
+    job = CompletionJob.objects.create(
+        user=user,
+        payment=payment,
+        external_id=external_id or '',
+    )
+    return job, True
+
+
+def get_queue_position(job):
+    """Сколько задач в очереди перед этой (0 - следующая; None - задача уже выполнена)."""
+    if job.status != CompletionJob.Status.QUEUED:
+        return None
+    return CompletionJob.objects.filter(status=CompletionJob.Status.QUEUED, id__lt=job.pk).count()
+
+
+def run_next_completion_job():
+    """
+    Выполнить следующую задачу очереди в одной транзакции.
+
+    Ошибка задачи (платеж уже завершен, external_id занят) помечает задачу FAILED,
+    остальные изменения задачи откатываются. Уже размещенного пользователя
+    complete_registration обрабатывает так же, как синхронный /api/complete/:
+    платеж завершается, в результате - предупреждение.
+
+    Returns:
+        CompletionJob или None, если очередь пуста
+    """
+    with transaction.atomic():
+        queryset = CompletionJob.objects.filter(status=CompletionJob.Status.QUEUED).order_by('id')
+        if connection.features.has_select_for_update_skip_locked:
+            queryset = queryset.select_for_update(skip_locked=True)
+        job = queryset.select_related('user').first()
+        if job is None:
+            return None
+
+        payment = Payment.objects.select_for_update().filter(pk=job.payment_id).first()
+        if payment is None or payment.status != Payment.PaymentStatus.PENDING:
+            job.status = CompletionJob.Status.FAILED
+            job.error = "Платеж уже завершен"
+        else:
+            try:
+                with transaction.atomic():
+                    job.result = complete_registration(job.user, payment, external_id=job.external_id or None)
+            except Exception as e:
+                logger.error(f"❌ Задача завершения #{job.pk}: {e}", exc_info=True)
+                job.status = CompletionJob.Status.FAILED
+                job.error = str(e)
+            else:
+                job.status = CompletionJob.Status.DONE
+        job.finished_at = timezone.now()
+        job.save(update_fields=['status', 'result', 'error', 'finished_at'])
+        return job
+
+
+def process_completion_jobs(limit=100):
+    """
+    Выполнить до limit задач очереди (каждую в своей транзакции).
+
+    Returns:
+        Counter: количество задач по итоговому статусу (пустой - очередь пуста)
+    """
+    counts = Counter()
+    for _ in range(limit):
+        job = run_next_completion_job()
+        if job is None:
+            break
+        counts[job.status] += 1
+    return counts
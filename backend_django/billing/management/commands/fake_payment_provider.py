@@ -0,0 +1,176 @@
+"""
+Django команда - локальный фейковый платежный провайдер.
+
+Создает ожидающие платежи (или берет существующие), отправляет подписанные
+уведомления на вебхук пакетами (с повторами, как настоящий провайдер) и,
+по флагу --process, прогоняет воркер и проверяет результат.
+По умолчанию запросы отправляются в процессе через тестовый клиент Django,
+с --url - по HTTP на запущенный сервер. Запускать только на тестовой базе.
+"""
+import json
+import random
+import secrets
+import time
+import urllib.error
+import urllib.request
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from core.models import User
+from mlm.models import Tariff, StructureNode
+from billing.models import Payment, PaymentNotification
+from billing.webhooks import SIGNATURE_HEADER, TIMESTAMP_HEADER, sign_payload
+
+
+class Command(BaseCommand):
+    help = 'Отправить подписанные уведомления об оплате на вебхук (локальный фейковый провайдер)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--count',
+            type=int,
+            default=100,
+            help='Сколько новых пользователей с ожидающими платежами создать (0 - только существующие)',
+        )
+        parser.add_argument(
+            '--batch',
+            type=int,
+            default=50,
+            help='Уведомлений в одном запросе',
+        )
+        parser.add_argument(
+            '--duplicates',
+            type=float,
+            default=0.1,
+            help='Доля уведомлений, отправляемых повторно',
+        )
+        parser.add_argument(
+            '--url',
+            help='URL вебхука запущенного сервера (по умолчанию - запрос в процессе)',
+        )
+        parser.add_argument(
+            '--secret',
+            help='Секрет подписи (по умолчанию PAYMENT_WEBHOOK_SECRET)',
+        )
+        parser.add_argument(
+            '--process',
+            action='store_true',
+            help='Прогнать воркер после отправки и проверить, что все платежи завершены',
+        )
+
+    def handle(self, *args, **options):
+        secret = options['secret'] or settings.PAYMENT_WEBHOOK_SECRET
+        if not secret:
+            if options['url']:
+                raise CommandError('Укажите --secret или PAYMENT_WEBHOOK_SECRET')
+            # В процессе можно подписывать временным секретом
+            secret = secrets.token_hex(16)
+
+        if options['count']:
+            self._create_pending(options['count'])
+        payments = list(
+            Payment.objects.filter(status=Payment.PaymentStatus.PENDING).exclude(notifications__isnull=False).order_by('id')
+        )
+        if not payments:
+            self.stdout.write(self.style.WARNING('⚠️  Нет ожидающих платежей'))
+            return
+
+        run_id = secrets.token_hex(4)
+        events = [
+            {
+                'event_id': f'evt_{run_id}_{payment.pk}',
+                'payment_id': payment.pk,
+                'external_id': f'fake_{run_id}_{payment.pk}',
+                'status': 'completed',
+                'amount': str(payment.amount),
+            }
+            for payment in payments
+        ]
+        # Повторная доставка части событий, как при ретраях провайдера
+        events += random.sample(events, int(len(events) * options['duplicates']))
+
+        self.stdout.write(f'📤 Отправка {len(events)} уведомлений ({len(payments)} платежей) пакетами по {options["batch"]}...')
+        with override_settings(PAYMENT_WEBHOOK_SECRET=secret):
+            client = None if options['url'] else Client()
+            started = time.perf_counter()
+            accepted = duplicates = 0
+            for start in range(0, len(events), options['batch']):
+                response = self._send(client, options['url'], secret, events[start:start + options['batch']])
+                accepted += response['accepted']
+                duplicates += response['duplicates']
+            elapsed = time.perf_counter() - started
+        self.stdout.write(f'   Принято: {accepted}, повторов: {duplicates}, {elapsed:.2f} с')
+
+        if options['process']:
+            call_command('process_payment_notifications', once=True, stdout=self.stdout)
+            self._check(payments)
+
+    def _create_pending(self, count):
+        """Создать пользователей с ожидающими платежами (пригласивший - случайный партнер)."""
+        tariff = Tariff.objects.filter(is_active=True).order_by('entry_amount').first()
+        if tariff is None:
+            tariff = Tariff.objects.create(code='fake', name='Fake', entry_amount=Decimal('10.00'))
+        inviter_ids = list(StructureNode.objects.values_list('user_id', flat=True)[:1000])
+        run_id = secrets.token_hex(4)
+        User.objects.bulk_create([
+            User(
+                username=f'fake_{run_id}_{index}',
+                email=f'fake_{run_id}_{index}@example.com',
+                referral_code=f'F{run_id}{index}'[:20],
+                status=User.UserStatus.PARTICIPANT,
+                invited_by_id=random.choice(inviter_ids) if inviter_ids else None,
+            )
+            for index in range(count)
+        ])
+        users = User.objects.filter(username__startswith=f'fake_{run_id}_')
+        Payment.objects.bulk_create([
+            Payment(user=user, tariff=tariff, amount=tariff.entry_amount)
+            for user in users
+        ])
+
+    def _send(self, client, url, secret, events):
+        """Отправить подписанный пакет уведомлений, вернуть ответ вебхука."""
+        body = json.dumps({'events': events}).encode('utf-8')
+        timestamp = str(int(time.time()))
+        headers = {
+            TIMESTAMP_HEADER: timestamp,
+            SIGNATURE_HEADER: sign_payload(body, timestamp, secret),
+        }
+        if client is not None:
+            response = client.post(
+                reverse('api-payment-webhook'),
+                data=body,
+                content_type='application/json',
+                headers=headers,
+            )
+            if response.status_code != 202:
+                raise CommandError(f'Вебхук ответил {response.status_code}: {response.content[:200]}')
+            return response.json()
+
+        request = urllib.request.Request(url, data=body, method='POST', headers={
+            'Content-Type': 'application/json',
+            **headers,
+        })
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            raise CommandError(f'Вебхук ответил {e.code}: {e.read()[:200]}')
+
+    def _check(self, payments):
+        """Проверить, что все платежи завершены, а пользователи размещены."""
+        payment_ids = [payment.pk for payment in payments]
+        pending = Payment.objects.filter(pk__in=payment_ids).exclude(status=Payment.PaymentStatus.COMPLETED).count()
+        unplaced = len(payments) - StructureNode.objects.filter(user_id__in=[payment.user_id for payment in payments]).count()
+        failed = PaymentNotification.objects.filter(
+            payment_id__in=payment_ids,
+            status=PaymentNotification.Status.FAILED,
+        ).count()
+        if pending or unplaced or failed:
+            raise CommandError(f'Не завершено платежей: {pending}, не размещено: {unplaced}, ошибок: {failed}')
+        self.stdout.write(self.style.SUCCESS(f'✅ Все {len(payments)} платежей завершены, пользователи размещены'))
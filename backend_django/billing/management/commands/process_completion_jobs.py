@@ -0,0 +1,59 @@
+"""
+Django команда - воркер очереди завершения регистраций.
+
+Задачи, поставленные /api/complete/, выполняются по одной в транзакции
+в порядке постановки: платеж, статус, размещение и бонусы (complete_registration).
+Для строгого порядка размещения запускайте один воркер; на PostgreSQL
+несколько воркеров берут разные задачи (SKIP LOCKED).
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from billing.jobs import process_completion_jobs
+
+
+class Command(BaseCommand):
+    help = 'Выполнить задачи завершения регистрации из очереди: платеж, размещение, бонусы'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            dest='batch_size',
+            type=int,
+            default=100,
+            help='Сколько задач выполнить между выводом статистики',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Выполнить накопившиеся задачи и завершиться',
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=0.5,
+            help='Пауза (секунд) между проверками пустой очереди',
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'🚀 Воркер завершения регистраций (пакет {options["batch_size"]})')
+        totals = {}
+        try:
+            while True:
+                started = time.perf_counter()
+                counts = process_completion_jobs(limit=options['batch_size'])
+                if not counts:
+                    if options['once']:
+                        break
+                    time.sleep(options['sleep'])
+                    continue
+                for key, value in counts.items():
+                    totals[key] = totals.get(key, 0) + value
+                summary = ', '.join(f'{key}: {value}' for key, value in sorted(counts.items()))
+                self.stdout.write(f'   ... {sum(counts.values())} задач за {time.perf_counter() - started:.2f} с ({summary})')
+        except KeyboardInterrupt:
+            self.stdout.write('⏹  Остановлено')
+
+        self.stdout.write(self.style.SUCCESS('✅ Обработка завершена!'))
+        for key, value in sorted(totals.items()):
+            self.stdout.write(f'   - {key}: {value}')
@@ -0,0 +1,59 @@
+"""
+Django команда - воркер входящих уведомлений платежного провайдера.
+
+Уведомления обрабатываются пакетами в порядке получения: платеж завершается,
+пользователь размещается в структуре, начисляются бонусы. Для строгого порядка
+размещения запускайте один воркер; на PostgreSQL несколько воркеров берут
+разные пакеты (SKIP LOCKED).
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from billing.webhooks import process_notification_batch
+
+
+class Command(BaseCommand):
+    help = 'Обработать уведомления платежного провайдера: завершить платежи, разместить пользователей, начислить бонусы'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            dest='batch_size',
+            type=int,
+            default=100,
+            help='Количество уведомлений в одном пакете',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Обработать накопившиеся уведомления и завершиться',
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=1.0,
+            help='Пауза (секунд) между проверками пустой очереди',
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'🚀 Воркер уведомлений провайдера (пакет {options["batch_size"]})')
+        totals = {}
+        try:
+            while True:
+                started = time.perf_counter()
+                counts = process_notification_batch(batch_size=options['batch_size'])
+                if not counts:
+                    if options['once']:
+                        break
+                    time.sleep(options['sleep'])
+                    continue
+                for key, value in counts.items():
+                    totals[key] = totals.get(key, 0) + value
+                summary = ', '.join(f'{key}: {value}' for key, value in sorted(counts.items()))
+                self.stdout.write(f'   ... пакет {sum(counts.values())} за {time.perf_counter() - started:.2f} с ({summary})')
+        except KeyboardInterrupt:
+            self.stdout.write('⏹  Остановлено')
+
+        self.stdout.write(self.style.SUCCESS('✅ Обработка завершена!'))
+        for key, value in sorted(totals.items()):
+            self.stdout.write(f'   - {key}: {value}')
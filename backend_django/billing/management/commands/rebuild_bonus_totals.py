@@ -0,0 +1,51 @@
+"""
+Django команда для пересчета сумм бонусов пользователей (UserBonusTotals) из таблицы Bonus.
+С флагом --check только сообщает о расхождениях, ничего не меняя.
+"""
+from django.core.management.base import BaseCommand
+from billing.services import rebuild_bonus_totals, bonus_totals_stale
+
+
+class Command(BaseCommand):
+    help = 'Пересчитать суммы бонусов пользователей (total/green/yellow) и найти расхождения'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            dest='batch_size',
+            type=int,
+            default=1000,
+            help='Количество пользователей в одном пакете',
+        )
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Только проверить расхождения, не исправляя их',
+        )
+        parser.add_argument(
+            '--if-stale',
+            action='store_true',
+            help='Пересчитывать, только если суммы еще не заполнены',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if options['if_stale'] and not bonus_totals_stale():
+            self.stdout.write(self.style.SUCCESS('✅ Суммы бонусов заполнены'))
+            return
+        
+        fix = not options['check']
+        self.stdout.write('🔄 Пересчет сумм бонусов...' if fix else '🔍 Проверка сумм бонусов...')
+        
+        def progress(processed):
+            if processed % (batch_size * 10) == 0:
+                self.stdout.write(f'   ... {processed}')
+        
+        processed, drift = rebuild_bonus_totals(batch_size=batch_size, fix=fix, progress=progress)
+        
+        if drift and not fix:
+            self.stdout.write(self.style.WARNING(f'⚠️  Расхождений: {drift} (пользователей: {processed})'))
+            return
+        self.stdout.write(self.style.SUCCESS('✅ Суммы бонусов пересчитаны!' if fix else '✅ Расхождений нет'))
+        self.stdout.write(f'   - Пользователей: {processed}')
+        self.stdout.write(f'   - Исправлено расхождений: {drift}')
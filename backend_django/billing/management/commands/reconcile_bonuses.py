@@ -0,0 +1,127 @@
+"""
+Django команда для сверки начисленных бонусов с ожидаемыми.
+
+Завершенные платежи читаются пакетами по возрастанию id (keyset-пагинация),
+ожидаемые бонусы считаются по текущим процентам тарифов. Память ограничена
+размером пакета; расхождения пишутся в CSV построчно. После каждого пакета
+сохраняется контрольная точка, поэтому прерванный запуск продолжается с места
+остановки.
+"""
+import csv
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from mlm.models import Tariff
+from billing.services import iter_completed_payment_batches, reconcile_bonus_batch
+
+CSV_FIELDS = ['payment_id', 'user_id', 'bonus_type', 'depth', 'expected', 'stored', 'action']
+
+
+class Command(BaseCommand):
+    help = 'Пересчитать ожидаемые бонусы по завершенным платежам и найти (или исправить) расхождения'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            dest='batch_size',
+            type=int,
+            default=1000,
+            help='Количество платежей в одном пакете',
+        )
+        parser.add_argument(
+            '--tariff',
+            help='Сверять только платежи тарифа с этим кодом',
+        )
+        parser.add_argument(
+            '--output',
+            help='CSV-файл для расхождений (по умолчанию - вывод в консоль)',
+        )
+        parser.add_argument(
+            '--checkpoint',
+            help='JSON-файл контрольной точки: если существует, сверка продолжается с него',
+        )
+        parser.add_argument(
+            '--fix',
+            action='store_true',
+            help='Исправить расхождения (каждый пакет - в своей транзакции)',
+        )
+        parser.add_argument(
+            '--include-unbonused',
+            dest='include_unbonused',
+            action='store_true',
+            help='Сверять платежи без единого бонуса как обычные (по умолчанию они только '
+                 'отмечаются действием review: возможно, размещены без бонусов)',
+        )
+
+    def handle(self, *args, **options):
+        tariffs = {tariff.pk: tariff for tariff in Tariff.objects.all()}
+        tariff_id = None
+        if options['tariff']:
+            tariff_id = next((tariff.pk for tariff in tariffs.values() if tariff.code == options['tariff']), None)
+            if tariff_id is None:
+                raise CommandError(f'Тариф {options["tariff"]} не найден')
+
+        # Если CSV выводится в консоль, сообщения идут в stderr, чтобы не смешиваться с отчетом
+        log = self.stdout if options['output'] else self.stderr
+        state = {'last_payment_id': 0, 'payments': 0, 'discrepancies': 0, 'review': 0}
+        checkpoint = options['checkpoint']
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as checkpoint_file:
+                state.update(json.load(checkpoint_file))
+            log.write(f'↩️  Продолжение с платежа #{state["last_payment_id"]} ({state["payments"]} уже сверено)')
+
+        output = options['output']
+        if output:
+            # При продолжении с контрольной точки отчет дописывается
+            append = bool(state['last_payment_id']) and os.path.exists(output)
+            stream = open(output, 'a' if append else 'w', newline='')
+        else:
+            append = False
+            stream = self.stdout
+        writer = csv.DictWriter(stream, fieldnames=CSV_FIELDS, lineterminator='\n')
+        if not append:
+            writer.writeheader()
+
+        mode = 'Исправление' if options['fix'] else 'Сверка'
+        log.write(f'🔄 {mode} бонусов (пакет {options["batch_size"]})...')
+        try:
+            for payments in iter_completed_payment_batches(
+                after_id=state['last_payment_id'],
+                batch_size=options['batch_size'],
+                tariff_id=tariff_id,
+            ):
+                discrepancies = reconcile_bonus_batch(
+                    payments, tariffs, fix=options['fix'], include_unbonused=options['include_unbonused'],
+                )
+                writer.writerows(discrepancies)
+                stream.flush()
+
+                state['last_payment_id'] = payments[-1].pk
+                state['payments'] += len(payments)
+                state['discrepancies'] += len(discrepancies)
+                state['review'] += sum(1 for row in discrepancies if row['action'] == 'review')
+                if checkpoint:
+                    self._save_checkpoint(checkpoint, state)
+                if state['payments'] % (options['batch_size'] * 10) == 0:
+                    log.write(f'   ... {state["payments"]} платежей, расхождений: {state["discrepancies"]}')
+        finally:
+            if output:
+                stream.close()
+
+        style = self.style.WARNING if state['discrepancies'] and not options['fix'] else self.style.SUCCESS
+        log.write(style(f'✅ {mode} завершена!'))
+        log.write(f'   - Платежей: {state["payments"]}')
+        log.write(f'   - Расхождений: {state["discrepancies"]}' + (' (исправлены)' if options['fix'] else ''))
+        if state['review']:
+            log.write(self.style.WARNING(
+                f'   - Из них у платежей без бонусов (review): {state["review"]}. Если платеж размещен без бонусов, '
+                f'отметьте его metadata.without_bonuses; если начисление потеряно - запустите с --include-unbonused --fix'
+            ))
+
+    def _save_checkpoint(self, path, state):
+        """Записать контрольную точку атомарно (через временный файл)."""
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as checkpoint_file:
+            json.dump(state, checkpoint_file)
+        os.replace(tmp_path, path)
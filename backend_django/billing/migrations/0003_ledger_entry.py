@@ -0,0 +1,58 @@
+# Generated by Django 5.1.2 on 2026-10-18 03:38
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def create_opening_entries(apps, schema_editor):
+    """Начальный остаток в журнале для каждого ненулевого баланса (история до журнала неизвестна)."""
+    User = apps.get_model('core', 'User')
+    LedgerEntry = apps.get_model('billing', 'LedgerEntry')
+    balances = User.objects.exclude(balance=0).order_by('id').values_list('id', 'balance')
+    batch = []
+    for user_id, balance in balances.iterator(chunk_size=1000):
+        batch.append(LedgerEntry(
+            user_id=user_id,
+            delta=balance,
+            balance_after=balance,
+            reason='OPENING',
+            description='Баланс на момент включения журнала',
+        ))
+        if len(batch) >= 1000:
+            LedgerEntry.objects.bulk_create(batch)
+            batch = []
+    LedgerEntry.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing', '0002_initial'),
+        ('core', '0002_user_balance'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('delta', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='Изменение')),
+                ('balance_after', models.DecimalField(decimal_places=2, max_digits=12, verbose_name='Баланс после операции')),
+                ('reason', models.CharField(choices=[('OPENING', 'Начальный остаток'), ('ADMIN_TOPUP', 'Пополнение администратором'), ('ADMIN_ADJUSTMENT', 'Корректировка администратором'), ('PAYMENT', 'Оплата с баланса'), ('BONUS', 'Начисление бонуса')], max_length=20, verbose_name='Основание')),
+                ('description', models.TextField(blank=True, verbose_name='Описание')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата операции')),
+                ('bonus', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='ledger_entries', to='billing.bonus', verbose_name='Бонус')),
+                ('payment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='ledger_entries', to='billing.payment', verbose_name='Платеж')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger_entries', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Операция с балансом',
+                'verbose_name_plural': 'Журнал баланса',
+                'ordering': ['-id'],
+                'indexes': [models.Index(fields=['user', 'id'], name='billing_ledger_user_idx')],
+            },
+        ),
+        migrations.RunPython(create_opening_entries, migrations.RunPython.noop),
+    ]
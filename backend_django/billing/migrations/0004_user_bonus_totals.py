@@ -0,0 +1,29 @@
+# Generated by Django 5.1.2 on 2026-10-18 03:48
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing', '0003_ledger_entry'),
+        ('core', '0002_user_balance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserBonusTotals',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='bonus_totals', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+                ('total', models.DecimalField(db_index=True, decimal_places=2, default=0, max_digits=12, verbose_name='Всего бонусов')),
+                ('green', models.DecimalField(decimal_places=2, default=0, max_digits=12, verbose_name='Зеленые бонусы')),
+                ('yellow', models.DecimalField(decimal_places=2, default=0, max_digits=12, verbose_name='Желтые бонусы')),
+            ],
+            options={
+                'verbose_name': 'Суммы бонусов пользователя',
+                'verbose_name_plural': 'Суммы бонусов пользователей',
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.2 on 2026-10-18 03:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing', '0004_user_bonus_totals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bonus',
+            name='depth',
+            field=models.PositiveIntegerField(blank=True, help_text='Для уровневого бонуса: на сколько уровней получатель выше источника', null=True, verbose_name='Уровень'),
+        ),
+        migrations.AlterField(
+            model_name='bonus',
+            name='bonus_type',
+            field=models.CharField(choices=[('GREEN', 'Зеленый бонус'), ('YELLOW', 'Желтый бонус'), ('LEVEL', 'Уровневый бонус')], max_length=20, verbose_name='Тип бонуса'),
+        ),
+    ]
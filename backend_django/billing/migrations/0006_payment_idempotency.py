@@ -0,0 +1,64 @@
+# Generated by Django 5.1.2 on 2026-10-18 03:57
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def release_duplicate_external_ids(apps, schema_editor):
+    """Оставить external_id только у первого платежа с этим ID, у остальных перенести его в metadata."""
+    Payment = apps.get_model('billing', 'Payment')
+    duplicates = (
+        Payment.objects.exclude(external_id=None).exclude(external_id='')
+        .values('external_id').annotate(total=Count('id')).filter(total__gt=1)
+        .values_list('external_id', flat=True)
+    )
+    for external_id in list(duplicates):
+        for payment in Payment.objects.filter(external_id=external_id).order_by('id')[1:]:
+            payment.metadata = {**(payment.metadata or {}), 'duplicate_external_id': external_id}
+            payment.external_id = None
+            payment.save(update_fields=['metadata', 'external_id'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing', '0005_bonus_level_depth'),
+        ('mlm', '0009_tariff_level_bonus'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(max_length=50, verbose_name='Операция')),
+                ('key', models.CharField(max_length=255, verbose_name='Ключ')),
+                ('request_hash', models.CharField(help_text='Повтор с тем же ключом, но другим телом запроса отклоняется', max_length=64, verbose_name='Хеш запроса')),
+                ('response_status', models.PositiveSmallIntegerField(verbose_name='HTTP статус ответа')),
+                ('response_body', models.JSONField(default=dict, verbose_name='Тело ответа')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+            ],
+            options={
+                'verbose_name': 'Ключ идемпотентности',
+                'verbose_name_plural': 'Ключи идемпотентности',
+                'ordering': ['-id'],
+            },
+        ),
+        migrations.RunPython(release_duplicate_external_ids, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='payment',
+            constraint=models.UniqueConstraint(condition=models.Q(('external_id__isnull', False), models.Q(('external_id', ''), _negated=True)), fields=('external_id',), name='billing_payment_external_id_uniq'),
+        ),
+        migrations.AddField(
+            model_name='idempotencykey',
+            name='payment',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='idempotency_keys', to='billing.payment', verbose_name='Платеж'),
+        ),
+        migrations.AddConstraint(
+            model_name='idempotencykey',
+            constraint=models.UniqueConstraint(fields=('scope', 'key'), name='billing_idempotency_key_uniq'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.1.2 on 2026-10-18 03:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing', '0006_payment_idempotency'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentNotification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(help_text='Повторная доставка события с тем же ID игнорируется', max_length=255, unique=True, verbose_name='ID события')),
+                ('external_id', models.CharField(max_length=255, verbose_name='ID платежа у провайдера')),
+                ('payment_status', models.CharField(max_length=20, verbose_name='Статус у провайдера')),
+                ('amount', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True, verbose_name='Сумма')),
+                ('payload', models.JSONField(default=dict, verbose_name='Данные уведомления')),
+                ('status', models.CharField(choices=[('RECEIVED', 'Получено'), ('PROCESSED', 'Обработано'), ('SKIPPED', 'Пропущено'), ('FAILED', 'Ошибка')], default='RECEIVED', max_length=20, verbose_name='Статус обработки')),
+                ('result', models.JSONField(blank=True, default=dict, verbose_name='Результат')),
+                ('error', models.TextField(blank=True, verbose_name='Ошибка')),
+                ('received_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата получения')),
+                ('processed_at', models.DateTimeField(blank=True, null=True, verbose_name='Дата обработки')),
+                ('payment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='notifications', to='billing.payment', verbose_name='Платеж')),
+            ],
+            options={
+                'verbose_name': 'Уведомление провайдера',
+                'verbose_name_plural': 'Уведомления провайдера',
+                'ordering': ['-id'],
+                'indexes': [models.Index(fields=['status', 'id'], name='billing_notification_queue_idx')],
+            },
+        ),
+    ]
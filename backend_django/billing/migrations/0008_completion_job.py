@@ -0,0 +1,37 @@
+# Generated by Django 5.1.2 on 2026-10-18 04:02
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing', '0007_payment_notification'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompletionJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('external_id', models.CharField(blank=True, max_length=255, verbose_name='ID платежа у провайдера')),
+                ('status', models.CharField(choices=[('QUEUED', 'В очереди'), ('DONE', 'Выполнено'), ('FAILED', 'Ошибка')], default='QUEUED', max_length=20, verbose_name='Статус')),
+                ('result', models.JSONField(blank=True, default=dict, verbose_name='Результат')),
+                ('error', models.TextField(blank=True, verbose_name='Ошибка')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата постановки')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Дата выполнения')),
+                ('payment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='completion_jobs', to='billing.payment', verbose_name='Платеж')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='completion_jobs', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Задача завершения регистрации',
+                'verbose_name_plural': 'Задачи завершения регистрации',
+                'ordering': ['-id'],
+                'indexes': [models.Index(fields=['status', 'id'], name='billing_completion_queue_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('status', 'QUEUED')), fields=('payment',), name='billing_completion_job_queued_uniq')],
+            },
+        ),
+    ]
@@ -64,6 +64,14 @@ class Payment(models.Model):
         verbose_name = _('Платеж')
         verbose_name_plural = _('Платежи')
         ordering = ['-created_at']
+        constraints = [
+            # Один платеж провайдера завершает только один платеж в системе
+            models.UniqueConstraint(
+                fields=['external_id'],
+                condition=models.Q(external_id__isnull=False) & ~models.Q(external_id=''),
+                name='billing_payment_external_id_uniq',
+            ),
+        ]
     
     def mark_completed(self):
         """Пометить платеж как завершенный."""
@@ -83,6 +91,7 @@ class Bonus(models.Model):
     class BonusType(models.TextChoices):
         GREEN = 'GREEN', _('Зеленый бонус')
         YELLOW = 'YELLOW', _('Желтый бонус')
+        LEVEL = 'LEVEL', _('Уровневый бонус')
     
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
@@ -112,6 +121,12 @@ class Bonus(models.Model):
         decimal_places=2,
         verbose_name=_('Сумма')
     )
+    depth = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        verbose_name=_('Уровень'),
+        help_text=_('Для уровневого бонуса: на сколько уровней получатель выше источника')
+    )
     description = models.TextField(
         blank=True,
         verbose_name=_('Описание')
@@ -129,3 +144,331 @@ class Bonus(models.Model):
     def __str__(self):
         return f"{self.user.username} - {self.amount} ({self.get_bonus_type_display()})"
 
+
+class LedgerEntry(models.Model):
+    """
+    Запись журнала изменений баланса (только добавление).
+    
+    User.balance - денормализованный текущий баланс: он меняется только
+    атомарным F()-обновлением вместе с записью в журнал, а balance_after
+    хранит баланс после операции, поэтому историю можно сверить с балансом.
+    """
+    class Reason(models.TextChoices):
+        OPENING = 'OPENING', _('Начальный остаток')
+        ADMIN_TOPUP = 'ADMIN_TOPUP', _('Пополнение администратором')
+        ADMIN_ADJUSTMENT = 'ADMIN_ADJUSTMENT', _('Корректировка администратором')
+        PAYMENT = 'PAYMENT', _('Оплата с баланса')
+        BONUS = 'BONUS', _('Начисление бонуса')
+    
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='ledger_entries',
+        verbose_name=_('Пользователь')
+    )
+    delta = models.DecimalField(
+        max_digits=12,
+        decimal_places=2,
+        verbose_name=_('Изменение')
+    )
+    balance_after = models.DecimalField(
+        max_digits=12,
+        decimal_places=2,
+        verbose_name=_('Баланс после операции')
+    )
+    reason = models.CharField(
+        max_length=20,
+        choices=Reason.choices,
+        verbose_name=_('Основание')
+    )
+    payment = models.ForeignKey(
+        Payment,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='ledger_entries',
+        verbose_name=_('Платеж')
+    )
+    bonus = models.ForeignKey(
+        Bonus,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='ledger_entries',
+        verbose_name=_('Бонус')
+    )
+    description = models.TextField(
+        blank=True,
+        verbose_name=_('Описание')
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name=_('Дата операции')
+    )
+    
+    class Meta:
+        verbose_name = _('Операция с балансом')
+        verbose_name_plural = _('Журнал баланса')
+        ordering = ['-id']
+        indexes = [
+            models.Index(fields=['user', 'id'], name='billing_ledger_user_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.user.username} {self.delta:+.2f} → {self.balance_after} ({self.get_reason_display()})"
+
+
+class UserBonusTotals(models.Model):
+    """
+    Суммы бонусов пользователя (денормализация Bonus).
+    
+    Увеличиваются в той же транзакции, что и создание бонусов
+    (billing.services.apply_bonus_totals), поэтому сводка по бонусам
+    читается одной строкой вместо трех агрегатов по таблице Bonus.
+    Пересчет и проверка расхождений: python manage.py rebuild_bonus_totals
+    """
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='bonus_totals',
+        verbose_name=_('Пользователь')
+    )
+    total = models.DecimalField(
+        max_digits=12,
+        decimal_places=2,
+        default=0,
+        db_index=True,
+        verbose_name=_('Всего бонусов')
+    )
+    green = models.DecimalField(
+        max_digits=12,
+        decimal_places=2,
+        default=0,
+        verbose_name=_('Зеленые бонусы')
+    )
+    yellow = models.DecimalField(
+        max_digits=12,
+        decimal_places=2,
+        default=0,
+        verbose_name=_('Желтые бонусы')
+    )
+    
+    class Meta:
+        verbose_name = _('Суммы бонусов пользователя')
+        verbose_name_plural = _('Суммы бонусов пользователей')
+    
+    def __str__(self):
+        return f"{self.user_id}: {self.total} (green {self.green}, yellow {self.yellow})"
+
+
+class IdempotencyKey(models.Model):
+    """
+    Результат запроса с ключом идемпотентности.
+    
+    Строка создается в той же транзакции, что и сама операция, поэтому
+    повтор запроса с тем же ключом (ретрай провайдера или клиента) получает
+    сохраненный ответ вместо повторного размещения и начисления бонусов.
+    """
+    scope = models.CharField(
+        max_length=50,
+        verbose_name=_('Операция')
+    )
+    key = models.CharField(
+        max_length=255,
+        verbose_name=_('Ключ')
+    )
+    request_hash = models.CharField(
+        max_length=64,
+        verbose_name=_('Хеш запроса'),
+        help_text=_('Повтор с тем же ключом, но другим телом запроса отклоняется')
+    )
+    payment = models.ForeignKey(
+        Payment,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='idempotency_keys',
+        verbose_name=_('Платеж')
+    )
+    response_status = models.PositiveSmallIntegerField(
+        verbose_name=_('HTTP статус ответа')
+    )
+    response_body = models.JSONField(
+        default=dict,
+        verbose_name=_('Тело ответа')
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name=_('Дата создания')
+    )
+    
+    class Meta:
+        verbose_name = _('Ключ идемпотентности')
+        verbose_name_plural = _('Ключи идемпотентности')
+        ordering = ['-id']
+        constraints = [
+            models.UniqueConstraint(fields=['scope', 'key'], name='billing_idempotency_key_uniq'),
+        ]
+    
+    def __str__(self):
+        return f"{self.scope}:{self.key} → {self.response_status}"
+
+
+class PaymentNotification(models.Model):
+    """
+    Входящее уведомление платежного провайдера (inbox).
+    
+    Вебхук только проверяет подпись и сохраняет уведомления одним bulk_create,
+    завершение платежей, размещение и бонусы выполняет воркер
+    (python manage.py process_payment_notifications) пакетами в порядке id.
+    """
+    class Status(models.TextChoices):
+        RECEIVED = 'RECEIVED', _('Получено')
+        PROCESSED = 'PROCESSED', _('Обработано')
+        SKIPPED = 'SKIPPED', _('Пропущено')
+        FAILED = 'FAILED', _('Ошибка')
+    
+    event_id = models.CharField(
+        max_length=255,
+        unique=True,
+        verbose_name=_('ID события'),
+        help_text=_('Повторная доставка события с тем же ID игнорируется')
+    )
+    external_id = models.CharField(
+        max_length=255,
+        verbose_name=_('ID платежа у провайдера')
+    )
+    payment = models.ForeignKey(
+        Payment,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='notifications',
+        verbose_name=_('Платеж')
+    )
+    payment_status = models.CharField(
+        max_length=20,
+        verbose_name=_('Статус у провайдера')
+    )
+    amount = models.DecimalField(
+        max_digits=10,
+        decimal_places=2,
+        null=True,
+        blank=True,
+        verbose_name=_('Сумма')
+    )
+    payload = models.JSONField(
+        default=dict,
+        verbose_name=_('Данные уведомления')
+    )
+    status = models.CharField(
+        max_length=20,
+        choices=Status.choices,
+        default=Status.RECEIVED,
+        verbose_name=_('Статус обработки')
+    )
+    result = models.JSONField(
+        default=dict,
+        blank=True,
+        verbose_name=_('Результат')
+    )
+    error = models.TextField(
+        blank=True,
+        verbose_name=_('Ошибка')
+    )
+    received_at = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name=_('Дата получения')
+    )
+    processed_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        verbose_name=_('Дата обработки')
+    )
+    
+    class Meta:
+        verbose_name = _('Уведомление провайдера')
+        verbose_name_plural = _('Уведомления провайдера')
+        ordering = ['-id']
+        indexes = [
+            models.Index(fields=['status', 'id'], name='billing_notification_queue_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.event_id} ({self.get_status_display()})"
+
+
+class CompletionJob(models.Model):
+    """
+    Задача завершения регистрации в очереди (очередь в БД).
+    
+    /api/complete/ только ставит задачу и отвечает 202 с ее ID, платеж,
+    размещение и бонусы выполняет воркер (python manage.py process_completion_jobs)
+    по одной задаче в транзакции в порядке id.
+    """
+    class Status(models.TextChoices):
+        QUEUED = 'QUEUED', _('В очереди')
+        DONE = 'DONE', _('Выполнено')
+        FAILED = 'FAILED', _('Ошибка')
+    
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='completion_jobs',
+        verbose_name=_('Пользователь')
+    )
+    payment = models.ForeignKey(
+        Payment,
+        on_delete=models.CASCADE,
+        related_name='completion_jobs',
+        verbose_name=_('Платеж')
+    )
+    external_id = models.CharField(
+        max_length=255,
+        blank=True,
+        verbose_name=_('ID платежа у провайдера')
+    )
+    status = models.CharField(
+        max_length=20,
+        choices=Status.choices,
+        default=Status.QUEUED,
+        verbose_name=_('Статус')
+    )
+    result = models.JSONField(
+        default=dict,
+        blank=True,
+        verbose_name=_('Результат')
+    )
+    error = models.TextField(
+        blank=True,
+        verbose_name=_('Ошибка')
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name=_('Дата постановки')
+    )
+    finished_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        verbose_name=_('Дата выполнения')
+    )
+    
+    class Meta:
+        verbose_name = _('Задача завершения регистрации')
+        verbose_name_plural = _('Задачи завершения регистрации')
+        ordering = ['-id']
+        indexes = [
+            models.Index(fields=['status', 'id'], name='billing_completion_queue_idx'),
+        ]
+        constraints = [
+            # Не больше одной задачи в очереди на платеж
+            models.UniqueConstraint(
+                fields=['payment'],
+                condition=models.Q(status='QUEUED'),
+                name='billing_completion_job_queued_uniq',
+            ),
+        ]
+    
+    def __str__(self):
+        return f"#{self.pk} {self.user} ({self.get_status_display()})"
@@ -1,12 +1,27 @@
 """
 Billing Services - логика начисления бонусов.
 """
+import hashlib
+import json
+import logging
+from collections import defaultdict
+from decimal import Decimal
 from django.conf import settings
-from django.db import transaction
+from django.db import connection, transaction
+from django.db.models import Case, DecimalField, F, Q, Sum, Value, When
 from django.utils import timezone
-from .models import Payment, Bonus
+from .models import Payment, Bonus, LedgerEntry, UserBonusTotals, IdempotencyKey
 from core.models import User
 
+logger = logging.getLogger(__name__)
+
+# Размер пакета для UPDATE ... WHERE id IN (...) и bulk_create (журнал, бонусы)
+LEDGER_BATCH_SIZE = 1000
+
+# Метки metadata платежей, за которые бонусы регистрации не начисляются:
+# пополнение счета из админки и размещение без бонусов (seed_structure, placement_stress)
+NON_SIGNUP_PAYMENT_FLAGS = ('admin_action', 'without_bonuses')
+
 
 def calculate_bonus_amounts(tariff):
     """
@@ -31,8 +46,111 @@ def calculate_bonus_amounts(tariff):
     }
 
 
+def build_signup_bonuses(user, payment, parent_id, tariff=None):
+    """
+    Подготовить (не сохраняя) бонусы за регистрацию нового партнера.
+    
+    Args:
+        user: User объект нового партнера
+        payment: Payment объект
+        parent_id: ID владельца позиции размещения (None для корня)
+        tariff: Tariff объект (по умолчанию payment.tariff)
+    
+    Returns:
+        list: Список несохраненных Bonus объектов для bulk_create
+    """
+    tariff = tariff or payment.tariff
+    if not tariff:
+        return []
+    
+    bonus_amounts = calculate_bonus_amounts(tariff)
+    bonuses = []
+    
+    # 1. Green Bonus - пригласившему (inviter)
+    if user.invited_by_id:
+        bonuses.append(Bonus(
+            user_id=user.invited_by_id,
+            source_user=user,
+            payment=payment,
+            bonus_type=Bonus.BonusType.GREEN,
+            amount=bonus_amounts['green'],
+            description=f"Зеленый бонус за приглашение {user.username}"
+        ))
+    
+    # 2. Yellow Bonus - владельцу позиции размещения (parent)
+    if parent_id:
+        bonuses.append(Bonus(
+            user_id=parent_id,
+            source_user=user,
+            payment=payment,
+            bonus_type=Bonus.BonusType.YELLOW,
+            amount=bonus_amounts['yellow'],
+            description=f"Желтый бонус за размещение {user.username} в структуре"
+        ))
+    
+    return bonuses
+
+
+def build_level_bonuses(signups, tariffs=None):
+    """
+    Подготовить (не сохраняя) уровневые бонусы вышестоящим по таблице TariffLevelBonus.
+    
+    Количество запросов не зависит от глубины и размера пакета: одна выборка
+    уровней тарифов и одна выборка вышестоящих по таблице замыкания на каждые
+    LEDGER_BATCH_SIZE регистраций.
+    
+    Args:
+        signups: список (user, payment, parent_id); неразмещенные (parent_id None) пропускаются
+        tariffs: необязательный словарь {tariff_id: Tariff}
+    
+    Returns:
+        list: Список несохраненных Bonus объектов для bulk_create
+    """
+    from mlm.models import TariffLevelBonus
+    from mlm.services import get_uplines
+    
+    placed = [(user, payment) for user, payment, parent_id in signups if parent_id and payment.tariff_id]
+    if not placed:
+        return []
+    
+    levels = defaultdict(dict)
+    for tariff_id, depth, percent in TariffLevelBonus.objects.filter(
+        tariff_id__in={payment.tariff_id for _, payment in placed},
+    ).values_list('tariff_id', 'depth', 'percent'):
+        levels[tariff_id][depth] = percent
+    placed = [(user, payment) for user, payment in placed if payment.tariff_id in levels]
+    if not placed:
+        return []
+    max_depth = max(max(depths) for depths in levels.values())
+    
+    bonuses = []
+    for start in range(0, len(placed), LEDGER_BATCH_SIZE):
+        chunk = placed[start:start + LEDGER_BATCH_SIZE]
+        uplines = get_uplines([user.pk for user, _ in chunk], max_depth)
+        for user, payment in chunk:
+            tariff = (tariffs.get(payment.tariff_id) if tariffs else None) or payment.tariff
+            percents = levels[payment.tariff_id]
+            for ancestor_id, depth in uplines[user.pk]:
+                percent = percents.get(depth)
+                if not percent:
+                    continue
+                amount = (tariff.entry_amount * percent / 100).quantize(Decimal('0.01'))
+                if amount <= 0:
+                    continue
+                bonuses.append(Bonus(
+                    user_id=ancestor_id,
+                    source_user=user,
+                    payment=payment,
+                    bonus_type=Bonus.BonusType.LEVEL,
+                    amount=amount,
+                    depth=depth,
+                    description=f"Уровневый бонус ({depth} уровень) за размещение {user.username}"
+                ))
+    return bonuses
+
+
 @transaction.atomic
-def apply_signup_bonuses(user, payment):
+def apply_signup_bonuses(user, payment, node=None):
     """
     Начислить бонусы при регистрации нового партнера.
     
@@ -40,54 +158,603 @@ def apply_signup_bonuses(user, payment):
     1. Green Bonus - пригласившему (inviter)
     2. Yellow Bonus - владельцу позиции размещения (parent)
     
+    Суммы получателей (UserBonusTotals) увеличиваются в той же транзакции.
+    
     Args:
         user: User объект нового партнера
         payment: Payment объект
+        node: StructureNode нового партнера, если размещение уже известно
+            (иначе узел ищется в БД; не размещен - только зеленый бонус)
     
     Returns:
         list: Список созданных Bonus объектов
     """
-    bonuses = []
-    tariff = payment.tariff
+    if node is None:
+        from mlm.models import StructureNode
+        parent_id = StructureNode.objects.filter(user=user).values_list('parent_id', flat=True).first()
+    else:
+        parent_id = node.parent_id
+    return apply_signup_bonuses_bulk([(user, payment, parent_id)])
+
+
+@transaction.atomic
+def apply_signup_bonuses_bulk(signups, tariffs=None):
+    """
+    Начислить бонусы за пакет регистраций с известным размещением.
     
-    if not tariff:
+    Все бонусы (зеленый, желтый, уровневые) пишутся одним bulk_create, суммы
+    получателей - сгруппированными UPDATE (apply_bonus_totals). Используется при размещении пакетом, импорте
+    и повторном проведении регистраций.
+    
+    Args:
+        signups: список (user, payment, parent_id); parent_id - владелец позиции
+            размещения (None - корень или пользователь не размещен)
+        tariffs: необязательный словарь {tariff_id: Tariff}, чтобы не читать
+            payment.tariff для каждого платежа
+    
+    Returns:
+        list: Список созданных Bonus объектов
+    """
+    bonuses = []
+    for user, payment, parent_id in signups:
+        tariff = tariffs.get(payment.tariff_id) if tariffs else None
+        bonuses.extend(build_signup_bonuses(user, payment, parent_id, tariff))
+    bonuses.extend(build_level_bonuses(signups, tariffs))
+    if not bonuses:
         return bonuses
     
-    # Рассчитываем суммы бонусов
-    bonus_amounts = calculate_bonus_amounts(tariff)
+    Bonus.objects.bulk_create(bonuses, batch_size=LEDGER_BATCH_SIZE)
+    apply_bonus_totals(bonuses)
+    return bonuses
+
+
+def apply_bonus_totals(bonuses):
+    """
+    Увеличить суммы бонусов получателей (UserBonusTotals) на новые бонусы.
     
-    # 1. Green Bonus - пригласившему (inviter)
-    if user.invited_by:
-        green_bonus = Bonus.objects.create(
-            user=user.invited_by,  # Получатель - пригласивший
-            source_user=user,  # Источник - новый партнер
-            payment=payment,
-            bonus_type=Bonus.BonusType.GREEN,
-            amount=bonus_amounts['green'],
-            description=f"Зеленый бонус за приглашение {user.username}"
+    Вызывается в той же транзакции, что и создание бонусов. Недостающие строки
+    создаются одним bulk_create, затем получатели обновляются одним UPDATE на
+    LEDGER_BATCH_SIZE строк: приращения сгруппированы в CASE по значению, поэтому
+    число запросов не зависит от числа разных сумм.
+    
+    Args:
+        bonuses: созданные Bonus объекты
+    """
+    deltas = defaultdict(lambda: [Decimal('0.00'), Decimal('0.00'), Decimal('0.00')])
+    for bonus in bonuses:
+        delta = deltas[bonus.user_id]
+        delta[0] += bonus.amount
+        if bonus.bonus_type == Bonus.BonusType.GREEN:
+            delta[1] += bonus.amount
+        elif bonus.bonus_type == Bonus.BonusType.YELLOW:
+            delta[2] += bonus.amount
+    if not deltas:
+        return
+    
+    UserBonusTotals.objects.bulk_create(
+        [UserBonusTotals(user_id=user_id) for user_id in deltas],
+        ignore_conflicts=True,
+        batch_size=LEDGER_BATCH_SIZE,
+    )
+    user_ids = list(deltas)
+    for start in range(0, len(user_ids), LEDGER_BATCH_SIZE):
+        chunk = user_ids[start:start + LEDGER_BATCH_SIZE]
+        changes = {}
+        for index, field in enumerate(('total', 'green', 'yellow')):
+            increment = _grouped_increment(chunk, {user_id: deltas[user_id][index] for user_id in chunk})
+            if increment is not None:
+                changes[field] = F(field) + increment
+        UserBonusTotals.objects.filter(user_id__in=chunk).update(**changes)
+
+
+def _grouped_increment(user_ids, deltas):
+    """
+    Выражение приращения для UPDATE: одно значение или CASE по группам
+    пользователей с одинаковым приращением (None - приращения нет).
+    """
+    users_by_delta = defaultdict(list)
+    for user_id in user_ids:
+        if deltas[user_id]:
+            users_by_delta[deltas[user_id]].append(user_id)
+    if not users_by_delta:
+        return None
+    output_field = DecimalField(max_digits=12, decimal_places=2)
+    if len(users_by_delta) == 1 and len(next(iter(users_by_delta.values()))) == len(user_ids):
+        return Value(next(iter(users_by_delta)), output_field=output_field)
+    return Case(
+        *[
+            When(user_id__in=group, then=Value(delta, output_field=output_field))
+            for delta, group in users_by_delta.items()
+        ],
+        default=Value(Decimal('0.00'), output_field=output_field),
+        output_field=output_field,
+    )
+
+
+def get_bonus_totals(user):
+    """
+    Суммы бонусов пользователя одной строкой.
+    
+    Returns:
+        tuple: (total, green, yellow)
+    """
+    row = UserBonusTotals.objects.filter(user_id=user.pk).values_list('total', 'green', 'yellow').first()
+    return row or (Decimal('0.00'), Decimal('0.00'), Decimal('0.00'))
+
+
+def get_bonus_totals_summary():
+    """
+    Суммы бонусов по всей системе (один запрос к UserBonusTotals).
+    
+    Returns:
+        dict: {'total': ..., 'green': ..., 'yellow': ...}
+    """
+    sums = UserBonusTotals.objects.aggregate(total=Sum('total'), green=Sum('green'), yellow=Sum('yellow'))
+    return {key: value or Decimal('0.00') for key, value in sums.items()}
+
+
+def bonus_totals_stale():
+    """Бонусы есть, а сумм по пользователям нет (UserBonusTotals еще не заполнена)."""
+    return Bonus.objects.exists() and not UserBonusTotals.objects.exists()
+
+
+def rebuild_bonus_totals(batch_size=1000, fix=True, progress=None):
+    """
+    Пересчитать суммы бонусов из таблицы Bonus и найти расхождения.
+    
+    Пользователи обрабатываются диапазонами id: суммы диапазона считаются
+    одним агрегатом по Bonus и сравниваются со строками UserBonusTotals.
+    
+    Args:
+        batch_size: количество пользователей в диапазоне
+        fix: исправить расхождения (иначе только посчитать)
+        progress: необязательная функция progress(processed) для отчета
+    
+    Returns:
+        tuple: (обработано пользователей, количество расхождений)
+    """
+    processed = 0
+    drift = 0
+    last_id = 0
+    while True:
+        ids = list(User.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            break
+        drift += sync_bonus_totals(user_id__gte=ids[0], user_id__lte=ids[-1], fix=fix)
+        processed += len(ids)
+        last_id = ids[-1]
+        if progress:
+            progress(processed)
+    return processed, drift
+
+
+def sync_bonus_totals(fix=True, **user_filter):
+    """
+    Сверить строки UserBonusTotals получателей с агрегатом по Bonus.
+    
+    Args:
+        fix: исправить расхождения (иначе только посчитать)
+        **user_filter: условие на user_id (например user_id__in=[...])
+    
+    Returns:
+        int: количество получателей с расхождением
+    """
+    zero = Decimal('0.00')
+    expected = {
+        row['user_id']: (row['total'] or zero, row['green'] or zero, row['yellow'] or zero)
+        for row in Bonus.objects.filter(**user_filter).order_by().values('user_id').annotate(
+            total=Sum('amount'),
+            green=Sum('amount', filter=Q(bonus_type=Bonus.BonusType.GREEN)),
+            yellow=Sum('amount', filter=Q(bonus_type=Bonus.BonusType.YELLOW)),
         )
-        bonuses.append(green_bonus)
+    }
+    with transaction.atomic():
+        stored = {
+            row.user_id: row
+            for row in UserBonusTotals.objects.select_for_update().filter(**user_filter)
+        }
+        to_create = []
+        to_update = []
+        for user_id in set(expected) | set(stored):
+            total, green, yellow = expected.get(user_id, (zero, zero, zero))
+            row = stored.get(user_id)
+            if row is None:
+                to_create.append(UserBonusTotals(user_id=user_id, total=total, green=green, yellow=yellow))
+            elif (row.total, row.green, row.yellow) != (total, green, yellow):
+                row.total, row.green, row.yellow = total, green, yellow
+                to_update.append(row)
+        if fix:
+            UserBonusTotals.objects.bulk_create(to_create, batch_size=LEDGER_BATCH_SIZE)
+            UserBonusTotals.objects.bulk_update(to_update, ['total', 'green', 'yellow'], batch_size=LEDGER_BATCH_SIZE)
+    return len(to_create) + len(to_update)
+
+
+def signup_payments(queryset=None):
+    """
+    Оставить только платежи за регистрацию: без пополнений счета из админки
+    и платежей, размещенных без бонусов (метки NON_SIGNUP_PAYMENT_FLAGS в metadata).
     
-    # 2. Yellow Bonus - владельцу позиции размещения (parent)
+    Args:
+        queryset: QuerySet платежей (по умолчанию все платежи)
+    
+    Returns:
+        QuerySet
+    """
+    queryset = Payment.objects.all() if queryset is None else queryset
+    for flag in NON_SIGNUP_PAYMENT_FLAGS:
+        # Ключа может не быть: exclude() по отсутствующему ключу JSON отбросил бы и такие строки
+        queryset = queryset.filter(Q(**{f'metadata__{flag}__isnull': True}) | ~Q(**{f'metadata__{flag}': True}))
+    return queryset
+
+
+def iter_completed_payment_batches(after_id=0, batch_size=1000, tariff_id=None):
+    """
+    Потоково читать завершенные платежи за регистрацию пакетами по возрастанию id
+    (keyset-пагинация). Пополнения из админки и платежи без бонусов пропускаются.
+    
+    Args:
+        after_id: читать платежи с id больше этого (контрольная точка)
+        batch_size: размер пакета
+        tariff_id: только платежи этого тарифа
+    
+    Yields:
+        list: Payment объекты пакета (id, user_id, tariff_id)
+    """
+    payments = signup_payments(Payment.objects.filter(status=Payment.PaymentStatus.COMPLETED))
+    if tariff_id is not None:
+        payments = payments.filter(tariff_id=tariff_id)
+    payments = payments.only('id', 'user_id', 'tariff_id').order_by('id')
+    while True:
+        batch = list(payments.filter(id__gt=after_id)[:batch_size])
+        if not batch:
+            return
+        yield batch
+        after_id = batch[-1].id
+
+
+def reconcile_bonus_batch(payments, tariffs, fix=False, include_unbonused=False):
+    """
+    Пересчитать ожидаемые бонусы пакета платежей и сравнить с сохраненными.
+    
+    Пригласившие и родители пакета загружаются двумя запросами, ожидаемые бонусы
+    строятся теми же функциями, что и при начислении (build_signup_bonuses,
+    build_level_bonuses). Бонус определяется ключом (получатель, тип, уровень).
+    
+    Платеж без единого бонуса мог быть размещен без бонусов до появления метки
+    without_bonuses (демо-структура, нагрузочный тест), а мог потерять начисление
+    целиком - по данным это не различить. Поэтому его недостающие бонусы
+    отмечаются действием 'review' и не создаются, пока не передан include_unbonused.
+    
+    Args:
+        payments: пакет завершенных платежей (iter_completed_payment_batches)
+        tariffs: словарь {tariff_id: Tariff} с текущими процентами
+        fix: исправить расхождения (создать недостающие, исправить суммы,
+            удалить лишние бонусы и пересчитать UserBonusTotals получателей)
+        include_unbonused: сверять платежи без бонусов как обычные (создавать их бонусы)
+    
+    Returns:
+        list: расхождения - словари payment_id, user_id, bonus_type, depth,
+            expected, stored, action ('create', 'update', 'delete', 'review')
+    """
     from mlm.models import StructureNode
     
-    try:
-        structure_node = StructureNode.objects.get(user=user)
-        parent_user = structure_node.parent
-        
-        if parent_user:
-            yellow_bonus = Bonus.objects.create(
-                user=parent_user,  # Получатель - владелец позиции
-                source_user=user,  # Источник - новый партнер
-                payment=payment,
-                bonus_type=Bonus.BonusType.YELLOW,
-                amount=bonus_amounts['yellow'],
-                description=f"Желтый бонус за размещение {user.username} в структуре"
+    user_ids = {payment.user_id for payment in payments}
+    users = {user.pk: user for user in User.objects.filter(id__in=user_ids).only('id', 'username', 'invited_by_id')}
+    parents = dict(StructureNode.objects.filter(user_id__in=user_ids).values_list('user_id', 'parent_id'))
+    signups = [
+        (users[payment.user_id], payment, parents.get(payment.user_id))
+        for payment in payments
+    ]
+    
+    cent = Decimal('0.01')
+    expected = defaultdict(dict)
+    for user, payment, parent_id in signups:
+        for bonus in build_signup_bonuses(user, payment, parent_id, tariffs.get(payment.tariff_id)):
+            expected[payment.pk][(bonus.user_id, bonus.bonus_type, bonus.depth)] = bonus
+    for bonus in build_level_bonuses(signups, tariffs):
+        expected[bonus.payment_id][(bonus.user_id, bonus.bonus_type, bonus.depth)] = bonus
+    
+    stored = defaultdict(dict)
+    duplicates = []
+    for bonus in Bonus.objects.filter(payment_id__in=[payment.pk for payment in payments]).only(
+        'id', 'payment_id', 'user_id', 'bonus_type', 'depth', 'amount',
+    ).order_by('id'):
+        key = (bonus.user_id, bonus.bonus_type, bonus.depth)
+        if key in stored[bonus.payment_id]:
+            duplicates.append(bonus)
+        else:
+            stored[bonus.payment_id][key] = bonus
+    
+    discrepancies = []
+    to_create, to_update, to_delete = [], [], list(duplicates)
+    for bonus in duplicates:
+        discrepancies.append(_discrepancy(bonus, None, bonus.amount, 'delete'))
+    for payment in payments:
+        expected_bonuses = expected.get(payment.pk, {})
+        stored_bonuses = stored.get(payment.pk, {})
+        unbonused = not stored_bonuses and not include_unbonused
+        for key, bonus in expected_bonuses.items():
+            amount = bonus.amount.quantize(cent)
+            current = stored_bonuses.get(key)
+            if current is None:
+                bonus.amount = amount
+                if unbonused:
+                    discrepancies.append(_discrepancy(bonus, amount, None, 'review'))
+                    continue
+                to_create.append(bonus)
+                discrepancies.append(_discrepancy(bonus, amount, None, 'create'))
+            elif current.amount != amount:
+                discrepancies.append(_discrepancy(current, amount, current.amount, 'update'))
+                to_update.append((current, amount))
+        for key, current in stored_bonuses.items():
+            if key not in expected_bonuses:
+                to_delete.append(current)
+                discrepancies.append(_discrepancy(current, None, current.amount, 'delete'))
+    
+    if fix and (to_create or to_update or to_delete):
+        with transaction.atomic():
+            Bonus.objects.bulk_create(to_create, batch_size=LEDGER_BATCH_SIZE)
+            for bonus, amount in to_update:
+                bonus.amount = amount
+            Bonus.objects.bulk_update([bonus for bonus, _ in to_update], ['amount'], batch_size=LEDGER_BATCH_SIZE)
+            Bonus.objects.filter(id__in=[bonus.pk for bonus in to_delete]).delete()
+            # Суммы затронутых получателей пересчитываются из Bonus, а не приращением:
+            # расхождение могло уже затронуть и UserBonusTotals
+            sync_bonus_totals(user_id__in={row['user_id'] for row in discrepancies if row['action'] != 'review'})
+    return discrepancies
+
+
+def _discrepancy(bonus, expected, stored, action):
+    """Строка отчета о расхождении бонуса."""
+    return {
+        'payment_id': bonus.payment_id,
+        'user_id': bonus.user_id,
+        'bonus_type': bonus.bonus_type,
+        'depth': bonus.depth,
+        'expected': expected,
+        'stored': stored,
+        'action': action,
+    }
+
+
+@transaction.atomic
+def apply_ledger_entries(entries):
+    """
+    Применить к балансам пакет операций и записать их в журнал.
+    
+    Балансы меняются атомарными F()-обновлениями без чтения в Python:
+    пользователи с одинаковым итоговым изменением обновляются одним UPDATE
+    (пополнение группы на одну сумму - один запрос). Затем балансы читаются
+    одним запросом (строки заблокированы UPDATE до конца транзакции),
+    и записи журнала с balance_after пишутся через bulk_create.
+    
+    Args:
+        entries: несохраненные LedgerEntry (user_id, delta, reason, payment/bonus) в порядке операций
+    
+    Returns:
+        list: Сохраненные LedgerEntry с заполненным balance_after
+    """
+    entries = [entry for entry in entries if entry.delta]
+    if not entries:
+        return []
+    
+    totals = defaultdict(Decimal)
+    for entry in entries:
+        totals[entry.user_id] += entry.delta
+    users_by_total = defaultdict(list)
+    for user_id, total in totals.items():
+        users_by_total[total].append(user_id)
+    
+    for total, user_ids in users_by_total.items():
+        for start in range(0, len(user_ids), LEDGER_BATCH_SIZE):
+            User.objects.filter(pk__in=user_ids[start:start + LEDGER_BATCH_SIZE]).update(
+                balance=F('balance') + total
             )
-            bonuses.append(yellow_bonus)
-    except StructureNode.DoesNotExist:
-        # Пользователь еще не размещен в структуре
-        pass
+    user_ids = list(totals)
+    balances = {}
+    for start in range(0, len(user_ids), LEDGER_BATCH_SIZE):
+        balances.update(
+            User.objects.filter(pk__in=user_ids[start:start + LEDGER_BATCH_SIZE]).values_list('id', 'balance')
+        )
     
-    return bonuses
+    # Баланс после каждой операции: идем от конца, вычитая более поздние изменения
+    running = dict(balances)
+    for entry in reversed(entries):
+        entry.balance_after = running[entry.user_id]
+        running[entry.user_id] -= entry.delta
+    
+    LedgerEntry.objects.bulk_create(entries, batch_size=LEDGER_BATCH_SIZE)
+    return entries
+
+
+def change_balance(user, delta, reason, payment=None, bonus=None, description=''):
+    """
+    Изменить баланс одного пользователя с записью в журнал.
+    
+    Args:
+        user: User объект (его поле balance обновляется значением из БД)
+        delta: сумма изменения (отрицательная - списание)
+        reason: LedgerEntry.Reason
+        payment: связанный Payment (опционально)
+        bonus: связанный Bonus (опционально)
+        description: описание операции
+    
+    Returns:
+        LedgerEntry объект или None, если delta равна нулю
+    """
+    entries = apply_ledger_entries([LedgerEntry(
+        user_id=user.pk,
+        delta=delta,
+        reason=reason,
+        payment=payment,
+        bonus=bonus,
+        description=description,
+    )])
+    if not entries:
+        return None
+    user.balance = entries[0].balance_after
+    return entries[0]
+
 
+@transaction.atomic
+def debit_balance(user, amount, reason, payment=None, description=''):
+    """
+    Списать сумму с баланса, только если ее хватает.
+    
+    Проверка и списание - один условный UPDATE
+    (UPDATE ... SET balance = balance - X WHERE id = ? AND balance >= X),
+    поэтому параллельные списания не уводят баланс в минус и не теряют
+    обновления. На PostgreSQL новый баланс возвращается тем же запросом
+    (UPDATE ... RETURNING), на остальных СУБД - перечитывается после UPDATE.
+    
+    Args:
+        user: User объект (его поле balance обновляется значением из БД)
+        amount: сумма списания (положительная)
+        reason: LedgerEntry.Reason
+        payment: связанный Payment (опционально)
+        description: описание операции
+    
+    Returns:
+        LedgerEntry объект или None, если средств недостаточно
+    """
+    if amount <= 0:
+        raise ValueError("Сумма списания должна быть положительной")
+    
+    if connection.vendor == 'postgresql':
+        table = connection.ops.quote_name(User._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {table} SET balance = balance - %s WHERE id = %s AND balance >= %s RETURNING balance",
+                [amount, user.pk, amount],
+            )
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        balance_after = row[0]
+    else:
+        updated = User.objects.filter(pk=user.pk, balance__gte=amount).update(balance=F('balance') - amount)
+        if not updated:
+            return None
+        balance_after = User.objects.filter(pk=user.pk).values_list('balance', flat=True).get()
+    
+    user.balance = balance_after
+    return LedgerEntry.objects.create(
+        user_id=user.pk,
+        delta=-amount,
+        balance_after=balance_after,
+        reason=reason,
+        payment=payment,
+        description=description,
+    )
+
+
+@transaction.atomic
+def complete_registration(user, payment, external_id=None):
+    """
+    Завершить регистрацию партнера: платеж, статус, размещение и бонусы.
+    
+    Вызывающий код должен заблокировать платеж (select_for_update) и проверить,
+    что он еще в статусе PENDING. Ошибка размещения не отменяет завершение:
+    пользователь получает только зеленый бонус, в результате - предупреждение.
+    
+    Args:
+        user: User объект
+        payment: ожидающий Payment объект
+        external_id: ID платежа у провайдера (уникален среди платежей)
+    
+    Returns:
+        dict: результат для ответа API (detail, bonuses_created, level, position...)
+    """
+    from mlm.services import place_user
+    
+    if external_id:
+        payment.external_id = external_id
+    payment.mark_completed()
+    
+    if user.status == User.UserStatus.PARTICIPANT:
+        user.status = User.UserStatus.PARTNER
+        user.save(update_fields=['status'])
+    
+    try:
+        structure_node = place_user(user, payment)
+        logger.info(f"✅ Пользователь {user.username} размещен: Level {structure_node.level}, Position {structure_node.position}")
+    except Exception as place_error:
+        logger.error(f"❌ Ошибка при размещении пользователя {user.username} в структуре: {place_error}")
+        structure_node = None
+    
+    try:
+        bonuses = apply_signup_bonuses(user, payment, node=structure_node)
+        logger.info(f"✅ Начислено бонусов: {len(bonuses)}")
+    except Exception as bonus_error:
+        logger.error(f"❌ Ошибка при начислении бонусов: {bonus_error}")
+        bonuses = []
+    
+    result = {
+        "detail": "Регистрация завершена",
+        "bonuses_created": len(bonuses),
+    }
+    if structure_node:
+        result.update({
+            "placement_parent": structure_node.parent.username if structure_node.parent else None,
+            "level": structure_node.level,
+            "position": structure_node.position,
+        })
+    else:
+        result["warning"] = "Пользователь не был размещен в структуре (возможно, структура заполнена или произошла ошибка)"
+    return result
+
+
+class IdempotencyKeyMismatch(Exception):
+    """Ключ идемпотентности уже использован с другим телом запроса."""
+
+
+def request_fingerprint(data):
+    """
+    Хеш тела запроса для проверки повторов с ключом идемпотентности.
+    
+    Args:
+        data: разобранное тело запроса (dict)
+    
+    Returns:
+        str: sha256 канонического JSON
+    """
+    canonical = json.dumps(data, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def get_idempotent_result(scope, key, request_hash):
+    """
+    Найти сохраненный результат запроса с этим ключом.
+    
+    Args:
+        scope: операция (например 'complete')
+        key: ключ идемпотентности
+        request_hash: request_fingerprint текущего запроса
+    
+    Returns:
+        IdempotencyKey или None, если ключ еще не использовался
+    
+    Raises:
+        IdempotencyKeyMismatch: ключ использован с другим телом запроса
+    """
+    record = IdempotencyKey.objects.filter(scope=scope, key=key).first()
+    if record is not None and record.request_hash != request_hash:
+        raise IdempotencyKeyMismatch(f"Ключ идемпотентности {key} уже использован с другими параметрами")
+    return record
+
+
+def save_idempotent_result(scope, key, request_hash, response_status, response_body, payment=None):
+    """
+    Сохранить результат запроса с ключом (в транзакции самой операции).
+    
+    Returns:
+        IdempotencyKey: созданная строка
+    """
+    return IdempotencyKey.objects.create(
+        scope=scope,
+        key=key,
+        request_hash=request_hash,
+        payment=payment,
+        response_status=response_status,
+        response_body=response_body,
+    )
@@ -0,0 +1,166 @@
+from decimal import Decimal
+
+from django.test import TestCase
+from django.utils import timezone
+
+from core.models import User
+from mlm.models import Tariff, StructureNode
+from mlm.services import place_user
+from billing.models import Payment, Bonus, LedgerEntry, CompletionJob
+from billing.services import (
+    apply_signup_bonuses, iter_completed_payment_batches, reconcile_bonus_batch, change_balance, debit_balance,
+)
+from billing.jobs import enqueue_completion, get_queue_position, process_completion_jobs
+
+
+class ReconcileBonusesTests(TestCase):
+    """Сверка бонусов учитывает только платежи за регистрацию."""
+
+    def setUp(self):
+        self.tariff = Tariff.objects.create(code='basic', name='Basic', entry_amount=Decimal('100.00'))
+        self.root = self._signup('root')
+
+    def _payment(self, user, **kwargs):
+        return Payment.objects.create(
+            user=user,
+            tariff=self.tariff,
+            amount=self.tariff.entry_amount,
+            status=Payment.PaymentStatus.COMPLETED,
+            completed_at=timezone.now(),
+            **kwargs,
+        )
+
+    def _signup(self, username, inviter=None):
+        user = User.objects.create(username=username, referral_code=username.upper(), invited_by=inviter)
+        payment = self._payment(user)
+        node = place_user(user, payment)
+        apply_signup_bonuses(user, payment, node=node)
+        return user
+
+    def _discrepancies(self, **kwargs):
+        tariffs = {self.tariff.pk: self.tariff}
+        return [
+            discrepancy
+            for payments in iter_completed_payment_batches()
+            for discrepancy in reconcile_bonus_batch(payments, tariffs, **kwargs)
+        ]
+
+    def test_signup_bonuses_match(self):
+        self._signup('partner', inviter=self.root)
+        self.assertEqual(self._discrepancies(), [])
+
+    def test_missing_signup_bonus_is_flagged(self):
+        partner = self._signup('partner', inviter=self.root)
+        Bonus.objects.filter(payment__user=partner, bonus_type=Bonus.BonusType.GREEN).delete()
+        discrepancies = self._discrepancies()
+        self.assertEqual(len(discrepancies), 1)
+        self.assertEqual(discrepancies[0]['bonus_type'], Bonus.BonusType.GREEN)
+        self.assertEqual(discrepancies[0]['action'], 'create')
+
+    def test_admin_top_up_is_not_flagged(self):
+        partner = self._signup('partner', inviter=self.root)
+        self._payment(partner, metadata={'admin_action': True, 'admin_user': 'admin'})
+        self.assertEqual(self._discrepancies(), [])
+
+    def test_payment_placed_without_bonuses_is_not_flagged(self):
+        user = User.objects.create(username='demo_partner_1', referral_code='DEMO1', invited_by=self.root)
+        place_user(user, self._payment(user, metadata={'without_bonuses': True}))
+        self.assertEqual(self._discrepancies(), [])
+
+    def test_unmarked_payment_without_bonuses_is_reported_for_review(self):
+        partner = self._signup('partner', inviter=self.root)
+        Bonus.objects.filter(payment__user=partner).delete()
+        discrepancies = self._discrepancies(fix=True)
+        self.assertEqual({row['action'] for row in discrepancies}, {'review'})
+        self.assertFalse(Bonus.objects.filter(payment__user=partner).exists())
+
+    def test_lost_bonuses_are_restored_with_include_unbonused(self):
+        partner = self._signup('partner', inviter=self.root)
+        Bonus.objects.filter(payment__user=partner).delete()
+        discrepancies = self._discrepancies(fix=True, include_unbonused=True)
+        self.assertEqual({row['action'] for row in discrepancies}, {'create'})
+        self.assertEqual(Bonus.objects.filter(payment__user=partner).count(), len(discrepancies))
+        self.assertEqual(self._discrepancies(), [])
+
+
+class DebitBalanceTests(TestCase):
+    """Списание не уводит баланс в минус."""
+
+    def setUp(self):
+        self.user = User.objects.create(username='buyer', referral_code='BUYER')
+        change_balance(self.user, Decimal('50.00'), LedgerEntry.Reason.ADMIN_TOPUP)
+
+    def test_debit_within_balance(self):
+        entry = debit_balance(self.user, Decimal('30.00'), LedgerEntry.Reason.ADMIN_ADJUSTMENT)
+        self.assertEqual(entry.delta, Decimal('-30.00'))
+        self.assertEqual(entry.balance_after, Decimal('20.00'))
+        self.assertEqual(self.user.balance, Decimal('20.00'))
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.balance, Decimal('20.00'))
+
+    def test_overdraft_is_refused(self):
+        self.assertIsNone(debit_balance(self.user, Decimal('50.01'), LedgerEntry.Reason.ADMIN_ADJUSTMENT))
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.balance, Decimal('50.00'))
+        self.assertEqual(LedgerEntry.objects.filter(user=self.user).count(), 1)
+
+    def test_non_positive_amount_is_rejected(self):
+        with self.assertRaises(ValueError):
+            debit_balance(self.user, Decimal('0'), LedgerEntry.Reason.ADMIN_ADJUSTMENT)
+
+
+class CompletionJobWorkerTests(TestCase):
+    """Воркер очереди завершения регистраций."""
+
+    def setUp(self):
+        self.tariff = Tariff.objects.create(code='basic', name='Basic', entry_amount=Decimal('100.00'))
+
+    def _pending(self, username, inviter=None):
+        user = User.objects.create(username=username, referral_code=username.upper(), invited_by=inviter)
+        payment = Payment.objects.create(user=user, tariff=self.tariff, amount=self.tariff.entry_amount)
+        return user, payment
+
+    def test_jobs_run_in_queue_order(self):
+        root, root_payment = self._pending('root')
+        partner, partner_payment = self._pending('partner', inviter=root)
+        root_job, _ = enqueue_completion(root, root_payment, external_id='ext-root')
+        partner_job, _ = enqueue_completion(partner, partner_payment)
+        self.assertEqual(get_queue_position(root_job), 0)
+        self.assertEqual(get_queue_position(partner_job), 1)
+
+        self.assertEqual(process_completion_jobs(), {CompletionJob.Status.DONE: 2})
+        partner_job.refresh_from_db()
+        self.assertIsNone(get_queue_position(partner_job))
+        self.assertEqual(partner_job.result['placement_parent'], 'root')
+        self.assertEqual(StructureNode.objects.get(user=partner).parent_id, root.pk)
+        root_payment.refresh_from_db()
+        self.assertEqual((root_payment.status, root_payment.external_id), (Payment.PaymentStatus.COMPLETED, 'ext-root'))
+        self.assertEqual(process_completion_jobs(), {})
+
+    def test_repeated_enqueue_returns_queued_job(self):
+        user, payment = self._pending('root')
+        job, created = enqueue_completion(user, payment)
+        self.assertTrue(created)
+        self.assertEqual(enqueue_completion(user, payment), (job, False))
+
+    def test_job_for_completed_payment_fails(self):
+        user, payment = self._pending('root')
+        job, _ = enqueue_completion(user, payment)
+        payment.mark_completed()
+        self.assertEqual(process_completion_jobs(), {CompletionJob.Status.FAILED: 1})
+        job.refresh_from_db()
+        self.assertEqual(job.error, "Платеж уже завершен")
+        self.assertFalse(StructureNode.objects.filter(user=user).exists())
+
+    def test_already_placed_user_completes_with_warning(self):
+        user, payment = self._pending('root')
+        place_user(user, Payment.objects.create(
+            user=user, tariff=self.tariff, amount=self.tariff.entry_amount,
+            status=Payment.PaymentStatus.COMPLETED, completed_at=timezone.now(),
+        ))
+        job, _ = enqueue_completion(user, payment)
+        self.assertEqual(process_completion_jobs(), {CompletionJob.Status.DONE: 1})
+        job.refresh_from_db()
+        self.assertIn('warning', job.result)
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, Payment.PaymentStatus.COMPLETED)
@@ -0,0 +1,312 @@
+"""
+Вебхук платежного провайдера: проверка подписи, разбор уведомлений,
+запись во входящую очередь (PaymentNotification) и пакетная обработка воркером.
+
+Подпись: HMAC-SHA256 от "<timestamp>.<тело запроса>" с секретом
+PAYMENT_WEBHOOK_SECRET, заголовки X-Webhook-Timestamp и X-Webhook-Signature
+("sha256=<hex>"). Тело - одно уведомление, список или {"events": [...]}:
+
+    {"event_id": "evt_1", "payment_id": 42, "external_id": "pay_1",
+     "status": "completed", "amount": "100.00"}
+"""
+import hashlib
+import hmac
+import logging
+import time
+from collections import Counter
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from core.models import User
+from .models import Payment, Bonus, PaymentNotification
+from .services import complete_registration
+
+logger = logging.getLogger(__name__)
+
+SIGNATURE_HEADER = 'X-Webhook-Signature'
+TIMESTAMP_HEADER = 'X-Webhook-Timestamp'
+
+# Статусы платежа у провайдера, которые понимает воркер
+PROVIDER_STATUS_COMPLETED = 'completed'
+PROVIDER_STATUS_FAILED = 'failed'
+PROVIDER_STATUSES = (PROVIDER_STATUS_COMPLETED, PROVIDER_STATUS_FAILED)
+
+# Максимум уведомлений в одном запросе
+MAX_EVENTS_PER_REQUEST = 1000
+
+
+class WebhookError(Exception):
+    """Некорректное тело уведомления."""
+
+
+class WebhookSignatureError(WebhookError):
+    """Подпись отсутствует, неверна или устарела."""
+
+
+def sign_payload(body, timestamp, secret=None):
+    """
+    Подписать тело запроса (так же подписывает провайдер).
+
+    Args:
+        body: тело запроса (bytes)
+        timestamp: время подписи (unix-время, int или str)
+        secret: секрет (по умолчанию PAYMENT_WEBHOOK_SECRET)
+
+    Returns:
+        str: значение заголовка X-Webhook-Signature
+    """
+    secret = secret or settings.PAYMENT_WEBHOOK_SECRET
+    digest = hmac.new(secret.encode('utf-8'), f'{timestamp}.'.encode('utf-8') + body, hashlib.sha256)
+    return f'sha256={digest.hexdigest()}'
+
+
+def verify_signature(body, timestamp, signature, secret=None, now=None):
+    """
+    Проверить подпись и свежесть запроса.
+
+    Raises:
+        WebhookSignatureError: подпись отсутствует, неверна или старше PAYMENT_WEBHOOK_TOLERANCE
+    """
+    if not timestamp or not signature:
+        raise WebhookSignatureError("Нет подписи запроса")
+    try:
+        signed_at = int(timestamp)
+    except (TypeError, ValueError):
+        raise WebhookSignatureError("Некорректное время подписи")
+    now = time.time() if now is None else now
+    if abs(now - signed_at) > settings.PAYMENT_WEBHOOK_TOLERANCE:
+        raise WebhookSignatureError("Подпись устарела")
+    if not hmac.compare_digest(sign_payload(body, timestamp, secret), signature):
+        raise WebhookSignatureError("Неверная подпись")
+
+
+def parse_notifications(data):
+    """
+    Разобрать тело вебхука в список уведомлений.
+
+    Args:
+        data: разобранный JSON (объект, список или {"events": [...]})
+
+    Returns:
+        list: словари event_id, payment_id, external_id, status, amount, payload
+
+    Raises:
+        WebhookError: если тело или одно из уведомлений некорректно
+    """
+    if isinstance(data, dict) and 'events' in data:
+        data = data['events']
+    events = data if isinstance(data, list) else [data]
+    if not events:
+        raise WebhookError("Нет уведомлений")
+    if len(events) > MAX_EVENTS_PER_REQUEST:
+        raise WebhookError(f"Не больше {MAX_EVENTS_PER_REQUEST} уведомлений в запросе")
+
+    notifications = []
+    for index, event in enumerate(events):
+        if not isinstance(event, dict):
+            raise WebhookError(f"Уведомление #{index}: ожидается объект")
+        missing = [field for field in ('event_id', 'payment_id', 'external_id', 'status') if not event.get(field)]
+        if missing:
+            raise WebhookError(f"Уведомление #{index}: нет полей {', '.join(missing)}")
+        if event['status'] not in PROVIDER_STATUSES:
+            raise WebhookError(f"Уведомление #{index}: неизвестный статус {event['status']}")
+        try:
+            payment_id = int(event['payment_id'])
+            amount = Decimal(str(event['amount'])) if event.get('amount') is not None else None
+        except (TypeError, ValueError, InvalidOperation):
+            raise WebhookError(f"Уведомление #{index}: некорректные payment_id или amount")
+        notifications.append({
+            'event_id': str(event['event_id'])[:255],
+            'payment_id': payment_id,
+            'external_id': str(event['external_id'])[:255],
+            'status': event['status'],
+            'amount': amount,
+            'payload': event,
+        })
+    return notifications
+
+
+def store_notifications(notifications):
+    """
+    Записать уведомления во входящую очередь одним bulk_create.
+    Уже полученные события (тот же event_id) пропускаются.
+
+    Returns:
+        tuple: (принято новых, повторов)
+    """
+    event_ids = [notification['event_id'] for notification in notifications]
+    known = set(PaymentNotification.objects.filter(event_id__in=event_ids).values_list('event_id', flat=True))
+    new = {}
+    for notification in notifications:
+        if notification['event_id'] not in known:
+            new.setdefault(notification['event_id'], notification)
+    # Уведомление о неизвестном платеже сохраняется без ссылки, воркер пометит его ошибкой
+    existing_payments = set(Payment.objects.filter(
+        pk__in={notification['payment_id'] for notification in new.values()},
+    ).values_list('pk', flat=True))
+    PaymentNotification.objects.bulk_create([
+        PaymentNotification(
+            event_id=notification['event_id'],
+            external_id=notification['external_id'],
+            payment_id=notification['payment_id'] if notification['payment_id'] in existing_payments else None,
+            payment_status=notification['status'],
+            amount=notification['amount'],
+            payload=notification['payload'],
+        )
+        for notification in new.values()
+    ], ignore_conflicts=True)
+    return len(new), len(notifications) - len(new)
+
+
+def process_notification_batch(batch_size=100):
+    """
+    Обработать следующий пакет полученных уведомлений в порядке id.
+
+    Платежи пакета завершаются одним bulk_update, пользователи размещаются
+    place_users_bulk (бонусы - одним bulk_create). Если пакетное размещение
+    не удалось, уведомления пакета обрабатываются по одному (complete_registration),
+    ошибка одного уведомления не влияет на остальные.
+    На PostgreSQL несколько воркеров берут разные пакеты (SKIP LOCKED).
+
+    Args:
+        batch_size: размер пакета
+
+    Returns:
+        Counter: количество уведомлений по итоговому статусу (пустой - очередь пуста)
+    """
+    with transaction.atomic():
+        queryset = PaymentNotification.objects.filter(status=PaymentNotification.Status.RECEIVED).order_by('id')
+        if connection.features.has_select_for_update_skip_locked:
+            queryset = queryset.select_for_update(skip_locked=True)
+        notifications = list(queryset[:batch_size])
+        if not notifications:
+            return Counter()
+
+        payments = Payment.objects.select_for_update().in_bulk(
+            {notification.payment_id for notification in notifications if notification.payment_id}
+        )
+        users = User.objects.in_bulk({payment.user_id for payment in payments.values()})
+        taken_external_ids = dict(Payment.objects.filter(
+            external_id__in={notification.external_id for notification in notifications},
+        ).values_list('external_id', 'id'))
+
+        to_complete = []
+        seen_payments = set()
+        for notification in notifications:
+            payment = payments.get(notification.payment_id)
+            error = _notification_error(notification, payment, taken_external_ids)
+            if error:
+                _finish(notification, PaymentNotification.Status.FAILED, error=error)
+            elif payment.status != Payment.PaymentStatus.PENDING or payment.pk in seen_payments:
+                _finish(notification, PaymentNotification.Status.SKIPPED, error=f"Платеж уже в статусе {payment.status}")
+            elif notification.payment_status == PROVIDER_STATUS_FAILED:
+                payment.status = Payment.PaymentStatus.FAILED
+                payment.save(update_fields=['status'])
+                _finish(notification, PaymentNotification.Status.PROCESSED, result={"detail": "Платеж отклонен провайдером"})
+            else:
+                to_complete.append((notification, payment, users[payment.user_id]))
+                taken_external_ids[notification.external_id] = payment.pk
+            if payment is not None:
+                seen_payments.add(payment.pk)
+
+        if to_complete:
+            try:
+                with transaction.atomic():
+                    _complete_batch(to_complete)
+            except Exception as e:
+                logger.warning(f"⚠️ Пакетная обработка {len(to_complete)} уведомлений не удалась ({e}), обрабатываем по одному")
+                for notification, payment, user in to_complete:
+                    _complete_one(notification, payment, user)
+
+        PaymentNotification.objects.bulk_update(
+            notifications, ['status', 'result', 'error', 'processed_at'],
+        )
+        return Counter(notification.status for notification in notifications)
+
+
+def _notification_error(notification, payment, taken_external_ids):
+    """Причина, по которой уведомление нельзя обработать (None - можно)."""
+    if payment is None:
+        return f"Платеж {notification.payload.get('payment_id')} не найден"
+    if notification.amount is not None and notification.amount != payment.amount:
+        return f"Сумма {notification.amount} не совпадает с суммой платежа {payment.amount}"
+    owner = taken_external_ids.get(notification.external_id)
+    if owner is not None and owner != payment.pk:
+        return f"external_id {notification.external_id} уже принадлежит платежу {owner}"
+    return None
+
+
+def _finish(notification, status, result=None, error=''):
+    """Записать итог обработки уведомления (сохраняется bulk_update пакета)."""
+    notification.status = status
+    notification.result = result or {}
+    notification.error = error
+    notification.processed_at = timezone.now()
+
+
+def _complete_batch(to_complete):
+    """Завершить платежи пакета, разместить пользователей и начислить бонусы пакетом."""
+    from mlm.models import StructureNode
+    from mlm.services import place_users_bulk
+
+    completed_at = timezone.now()
+    for notification, payment, user in to_complete:
+        payment.external_id = notification.external_id
+        payment.status = Payment.PaymentStatus.COMPLETED
+        payment.completed_at = completed_at
+    Payment.objects.bulk_update([payment for _, payment, _ in to_complete], ['external_id', 'status', 'completed_at'])
+    User.objects.filter(
+        id__in=[user.pk for _, _, user in to_complete],
+        status=User.UserStatus.PARTICIPANT,
+    ).update(status=User.UserStatus.PARTNER)
+
+    placed = set(StructureNode.objects.filter(
+        user_id__in=[user.pk for _, _, user in to_complete],
+    ).values_list('user_id', flat=True))
+    to_place = [(user, payment) for _, payment, user in to_complete if user.pk not in placed]
+    nodes = {node.user_id: node for node in place_users_bulk(to_place)}
+
+    parents = User.objects.in_bulk({node.parent_id for node in nodes.values() if node.parent_id})
+    bonus_counts = dict(
+        Bonus.objects.filter(payment_id__in=[payment.pk for _, payment, _ in to_complete])
+        .values('payment_id').annotate(total=Count('id')).values_list('payment_id', 'total')
+    )
+    for notification, payment, user in to_complete:
+        node = nodes.get(user.pk)
+        if node is None:
+            result = {"detail": "Платеж завершен", "warning": "Пользователь уже был размещен в структуре"}
+        else:
+            parent = parents.get(node.parent_id)
+            result = {
+                "detail": "Регистрация завершена",
+                "bonuses_created": bonus_counts.get(payment.pk, 0),
+                "placement_parent": parent.username if parent else None,
+                "level": node.level,
+                "position": node.position,
+            }
+        _finish(notification, PaymentNotification.Status.PROCESSED, result=result)
+
+
+def _complete_one(notification, payment, user):
+    """Завершить один платеж уведомления (запасной путь при ошибке пакета)."""
+    from mlm.models import StructureNode
+
+    # Состояние платежа в памяти могло измениться в откаченной пакетной попытке
+    payment.refresh_from_db()
+    try:
+        with transaction.atomic():
+            if StructureNode.objects.filter(user=user).exists():
+                payment.external_id = notification.external_id
+                payment.mark_completed()
+                result = {"detail": "Платеж завершен", "warning": "Пользователь уже был размещен в структуре"}
+            else:
+                result = complete_registration(user, payment, external_id=notification.external_id)
+    except Exception as e:
+        logger.error(f"❌ Уведомление {notification.event_id}: {e}")
+        _finish(notification, PaymentNotification.Status.FAILED, error=str(e))
+    else:
+        _finish(notification, PaymentNotification.Status.PROCESSED, result=result)
@@ -7,7 +7,8 @@ from django.urls import reverse
 from decimal import Decimal
 from .models import User
 from mlm.models import Tariff, StructureNode
-from billing.models import Payment, Bonus
+from billing.models import Payment, Bonus, LedgerEntry
+from billing.services import apply_ledger_entries, change_balance
 
 
 @admin.register(User)
@@ -18,6 +19,8 @@ class UserAdmin(BaseUserAdmin):
     search_fields = ['username', 'email', 'referral_code', 'telegram_id']
     actions = ['add_balance_action', 'add_balance_direct_action']
     readonly_fields = ['get_balance_info', 'get_balance_history', 'get_structure_info', 'get_referral_stats']
+    # Суммы бонусов для get_total_bonuses читаются вместе со списком пользователей
+    list_select_related = ['bonus_totals']
     date_hierarchy = 'date_joined'
     
     fieldsets = BaseUserAdmin.fieldsets + (
@@ -34,6 +37,42 @@ class UserAdmin(BaseUserAdmin):
         }),
     )
     
+    def get_form(self, request, obj=None, **kwargs):
+        form = super().get_form(request, obj, **kwargs)
+        if 'balance' in form.base_fields:
+            # Форма возвращает баланс, который видел администратор: изменение считается от него
+            form.base_fields['balance'].show_hidden_initial = True
+        return form
+    
+    def save_model(self, request, obj, form, change):
+        """Изменение баланса в форме проводится через журнал атомарным обновлением."""
+        balance_delta = Decimal('0.00')
+        if 'balance' in form.changed_data:
+            field = form.fields['balance']
+            if change:
+                seen_balance = field.to_python(form.data.get(form.add_initial_prefix('balance')))
+            else:
+                seen_balance = Decimal('0.00')
+            balance_delta = (obj.balance or Decimal('0.00')) - (seen_balance or Decimal('0.00'))
+        
+        if change:
+            # Баланс не перезаписываем значением из формы: его могли изменить параллельно
+            obj.save(update_fields=[
+                field.name for field in obj._meta.concrete_fields
+                if not field.primary_key and field.name != 'balance'
+            ])
+        else:
+            obj.balance = Decimal('0.00')
+            super().save_model(request, obj, form, change)
+        
+        if balance_delta:
+            change_balance(
+                obj,
+                balance_delta,
+                LedgerEntry.Reason.ADMIN_ADJUSTMENT,
+                description=f"Изменение баланса администратором {request.user.username}",
+            )
+    
     def get_invited_by(self, obj):
         """Отображение партнера с ссылкой на него."""
         try:
@@ -83,9 +122,11 @@ class UserAdmin(BaseUserAdmin):
                     '<strong>💰 $0.00</strong>'
                     '</div>'
                 )
-            total = Bonus.objects.filter(user=obj).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-            green = Bonus.objects.filter(user=obj, bonus_type=Bonus.BonusType.GREEN).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-            yellow = Bonus.objects.filter(user=obj, bonus_type=Bonus.BonusType.YELLOW).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
+            totals = getattr(obj, 'bonus_totals', None)
+            if totals is None:
+                total = green = yellow = Decimal('0.00')
+            else:
+                total, green, yellow = totals.total, totals.green, totals.yellow
             
             return format_html(
                 '<div style="line-height: 1.4;">'
@@ -178,12 +219,15 @@ class UserAdmin(BaseUserAdmin):
             '<p><strong>Уровень:</strong> {}</p>'
             '<p><strong>Позиция:</strong> {}</p>'
             '<p><strong>Тариф:</strong> {}</p>'
+            '<p><strong>Всего в downline:</strong> {} (глубина {})</p>'
             '{}'
             '{}'
             '</div>',
             node.level,
             node.position,
             node.tariff.name if node.tariff else 'Не указан',
+            node.descendant_count,
+            node.max_descendant_depth,
             parent_info,
             children_html
         )
@@ -385,17 +429,19 @@ class UserAdmin(BaseUserAdmin):
                 tariff = Tariff.objects.get(id=tariff_id)
                 amount_decimal = Decimal(amount)
                 
-                created_count = 0
-                for user in queryset:
-                    payment = Payment.objects.create(
-                        user=user,
+                completed_at = timezone.now()
+                payments = Payment.objects.bulk_create([
+                    Payment(
+                        user_id=user_id,
                         tariff=tariff,
                         amount=amount_decimal,
                         status=Payment.PaymentStatus.COMPLETED,
-                        completed_at=timezone.now(),
+                        completed_at=completed_at,
                         metadata={'admin_action': True, 'admin_user': request.user.username}
                     )
-                    created_count += 1
+                    for user_id in queryset.values_list('id', flat=True)
+                ])
+                created_count = len(payments)
                 
                 self.message_user(
                     request,
@@ -510,11 +556,17 @@ class UserAdmin(BaseUserAdmin):
             try:
                 amount_decimal = Decimal(amount)
                 
-                updated_count = 0
-                for user in queryset:
-                    user.balance += amount_decimal
-                    user.save()
-                    updated_count += 1
+                # Один UPDATE balance = balance + сумма на всех выбранных и записи в журнал
+                entries = apply_ledger_entries([
+                    LedgerEntry(
+                        user_id=user_id,
+                        delta=amount_decimal,
+                        reason=LedgerEntry.Reason.ADMIN_TOPUP,
+                        description=f"Пополнение администратором {request.user.username}",
+                    )
+                    for user_id in queryset.values_list('id', flat=True)
+                ])
+                updated_count = len(entries)
                 
                 self.message_user(
                     request,
@@ -4,13 +4,14 @@ Custom admin views for dashboard and statistics.
 from django.contrib.admin.views.decorators import staff_member_required
 from django.template.response import TemplateResponse
 from django.urls import path
-from django.db.models import Sum, Count, Q
+from django.db.models import F, Sum, Count, Q
 from django.utils import timezone
 from datetime import timedelta
 from decimal import Decimal
 from core.models import User
 from mlm.models import Tariff, StructureNode
 from billing.models import Payment, Bonus
+from billing.services import get_bonus_totals_summary
 
 
 @staff_member_required
@@ -32,9 +33,10 @@ def dashboard(request):
     ).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
     
     # Статистика по бонусам
-    total_bonuses = Bonus.objects.aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-    green_bonuses = Bonus.objects.filter(bonus_type=Bonus.BonusType.GREEN).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-    yellow_bonuses = Bonus.objects.filter(bonus_type=Bonus.BonusType.YELLOW).aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
+    bonus_summary = get_bonus_totals_summary()
+    total_bonuses = bonus_summary['total']
+    green_bonuses = bonus_summary['green']
+    yellow_bonuses = bonus_summary['yellow']
     
     # Статистика по структуре
     total_nodes = StructureNode.objects.count()
@@ -67,7 +69,7 @@ def dashboard(request):
     
     # Топ пользователей по бонусам
     top_users_bonuses = User.objects.annotate(
-        total_bonuses=Sum('bonuses__amount')
+        total_bonuses=F('bonus_totals__total')
     ).filter(total_bonuses__gt=0).order_by('-total_bonuses')[:10]
     
     from django.contrib import admin
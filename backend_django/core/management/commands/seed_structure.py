@@ -7,9 +7,9 @@ from django.db import transaction
 from django.utils import timezone
 
 from core.models import User
-from mlm.models import Tariff, StructureNode
+from mlm.models import Tariff
 from billing.models import Payment
-from mlm.services import place_user
+from mlm.services import place_users_bulk, create_root_node
 
 
 class Command(BaseCommand):
@@ -86,21 +86,13 @@ class Command(BaseCommand):
 
     def _ensure_root_structure(self, root_user: User, tariff: Tariff) -> None:
         """Создает корневой узел, если его еще нет."""
-        StructureNode.objects.get_or_create(
-            user=root_user,
-            defaults={
-                "parent": None,
-                "position": 1,
-                "level": 0,
-                "tariff": tariff,
-            },
-        )
+        create_root_node(root_user, tariff)
         if root_user.status != User.UserStatus.PARTNER:
             root_user.status = User.UserStatus.PARTNER
             root_user.save(update_fields=["status"])
 
     def _create_demo_partners(self, root_user: User, tariff: Tariff, count: int):
-        created_usernames = []
+        created_users = []
         for index in range(count):
             username = self._generate_username(index)
             user, created = User.objects.get_or_create(
@@ -111,19 +103,22 @@ class Command(BaseCommand):
                     "invited_by": root_user,
                 },
             )
-            if not created:
-                continue
+            if created:
+                created_users.append(user)
 
-            payment = Payment.objects.create(
+        payments = Payment.objects.bulk_create([
+            Payment(
                 user=user,
                 tariff=tariff,
                 amount=tariff.entry_amount,
                 status=Payment.PaymentStatus.COMPLETED,
                 completed_at=timezone.now(),
+                metadata={'without_bonuses': True},
             )
-            place_user(user, payment)
-            created_usernames.append(username)
-        return created_usernames
+            for user in created_users
+        ])
+        place_users_bulk(zip(created_users, payments), apply_bonuses=False)
+        return [user.username for user in created_users]
 
     def _generate_username(self, seed: int) -> str:
         suffix = "".join(random.choices(string.ascii_lowercase + string.digits, k=6))
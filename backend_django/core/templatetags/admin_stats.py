@@ -2,7 +2,7 @@ from datetime import timedelta
 
 from django import template
 from django.apps import apps
-from django.db.models import Sum
+from django.db.models import F, Sum
 from django.utils import timezone
 
 register = template.Library()
@@ -78,34 +78,20 @@ def total_revenue():
 
 @register.simple_tag
 def total_bonuses():
-    Bonus = _m('billing', 'Bonus')
-    return (Bonus.objects.aggregate(total=Sum('amount')).get('total') or 0) if Bonus else 0
+    Totals = _m('billing', 'UserBonusTotals')
+    return (Totals.objects.aggregate(total=Sum('total')).get('total') or 0) if Totals else 0
 
 
 @register.simple_tag
 def green_bonuses():
-    Bonus = _m('billing', 'Bonus')
-    if not Bonus:
-        return 0
-    return (
-        Bonus.objects.filter(bonus_type=Bonus.BonusType.GREEN)
-        .aggregate(total=Sum('amount'))
-        .get('total')
-        or 0
-    )
+    Totals = _m('billing', 'UserBonusTotals')
+    return (Totals.objects.aggregate(total=Sum('green')).get('total') or 0) if Totals else 0
 
 
 @register.simple_tag
 def yellow_bonuses():
-    Bonus = _m('billing', 'Bonus')
-    if not Bonus:
-        return 0
-    return (
-        Bonus.objects.filter(bonus_type=Bonus.BonusType.YELLOW)
-        .aggregate(total=Sum('amount'))
-        .get('total')
-        or 0
-    )
+    Totals = _m('billing', 'UserBonusTotals')
+    return (Totals.objects.aggregate(total=Sum('yellow')).get('total') or 0) if Totals else 0
 
 
 @register.simple_tag
@@ -160,7 +146,7 @@ def top_users_by_bonuses(limit=5):
     try:
         return (
             User.objects
-            .annotate(total_bonuses=Sum('bonuses__amount'))
+            .annotate(total_bonuses=F('bonus_totals__total'))
             .filter(total_bonuses__gt=0)
             .order_by('-total_bonuses')[:limit]
         )
@@ -6,6 +6,7 @@ from django.db.models import Sum, Count
 from core.models import User
 from mlm.models import StructureNode
 from billing.models import Payment, Bonus
+from billing.services import get_bonus_totals_summary
 
 
 def dashboard(request):
@@ -27,13 +28,10 @@ def dashboard(request):
     completed_payments = Payment.objects.filter(status=Payment.PaymentStatus.COMPLETED).count()
     
     # Статистика бонусов (из БД)
-    total_bonuses = Bonus.objects.aggregate(total=Sum('amount'))['total'] or 0
-    green_bonuses = Bonus.objects.filter(
-        bonus_type=Bonus.BonusType.GREEN
-    ).aggregate(total=Sum('amount'))['total'] or 0
-    yellow_bonuses = Bonus.objects.filter(
-        bonus_type=Bonus.BonusType.YELLOW
-    ).aggregate(total=Sum('amount'))['total'] or 0
+    bonus_summary = get_bonus_totals_summary()
+    total_bonuses = bonus_summary['total']
+    green_bonuses = bonus_summary['green']
+    yellow_bonuses = bonus_summary['yellow']
     
     # Последние регистрации
     recent_users = User.objects.order_by('-date_joined')[:10]
@@ -24,6 +24,12 @@ env = environ.Env(
     MAX_PARTNERS_PER_LEVEL=(int, 3),
     DEFAULT_GREEN_BONUS_PERCENT=(int, 50),
     DEFAULT_YELLOW_BONUS_PERCENT=(int, 50),
+    PLACEMENT_STRATEGY=(str, 'bfs'),
+    PLACEMENT_MAX_RETRIES=(int, 5),
+    STRUCTURE_CACHE_TIMEOUT=(int, 3600),
+    PAYMENT_WEBHOOK_SECRET=(str, ''),
+    PAYMENT_WEBHOOK_TOLERANCE=(int, 300),
+    REGISTRATION_COMPLETION_ASYNC=(bool, False),
 )
 
 # Check if .env file exists
@@ -148,6 +154,14 @@ MLM_SETTINGS = {
     'MAX_PARTNERS_PER_LEVEL': env('MAX_PARTNERS_PER_LEVEL', default=3),
     'DEFAULT_GREEN_BONUS_PERCENT': env('DEFAULT_GREEN_BONUS_PERCENT', default=50),
     'DEFAULT_YELLOW_BONUS_PERCENT': env('DEFAULT_YELLOW_BONUS_PERCENT', default=50),
+    # Стратегия размещения (mlm.placement): 'bfs' (индекс свободных позиций), 'spillover' (первая
+    # свободная позиция в поддереве пригласившего), 'balanced-leg' (нога пригласившего с наименьшим
+    # downline) или 'heap' (порядковый номер узла)
+    'PLACEMENT_STRATEGY': env('PLACEMENT_STRATEGY', default='bfs'),
+    # Сколько раз повторять размещение при конфликте параллельных запросов
+    'PLACEMENT_MAX_RETRIES': env('PLACEMENT_MAX_RETRIES', default=5),
+    # Сколько секунд хранить снимки дерева структуры в кэше (ключ включает версию структуры)
+    'STRUCTURE_CACHE_TIMEOUT': env('STRUCTURE_CACHE_TIMEOUT', default=3600),
 }
 
 # Telegram Bot Settings
@@ -156,6 +170,17 @@ TELEGRAM_BOT_USERNAME = env('TELEGRAM_BOT_USERNAME', default='Equilibrium_Club_b
 TELEGRAM_WEBAPP_URL = env('TELEGRAM_WEBAPP_URL', default='')
 TELEGRAM_WEBHOOK_URL = env('TELEGRAM_WEBHOOK_URL', default='')
 
+# Payment Provider Webhook Settings
+# Секрет подписи уведомлений провайдера (пустой - вебхук отключен)
+PAYMENT_WEBHOOK_SECRET = env('PAYMENT_WEBHOOK_SECRET', default='')
+# Допустимое расхождение времени подписи, секунд (защита от повторной отправки старых запросов)
+PAYMENT_WEBHOOK_TOLERANCE = env('PAYMENT_WEBHOOK_TOLERANCE', default=300)
+
+# Registration Completion Queue
+# True - /api/complete/ ставит завершение в очередь (202 + ID задачи), выполняет воркер
+# process_completion_jobs; по умолчанию завершение внутри HTTP-запроса (200 с результатом)
+REGISTRATION_COMPLETION_ASYNC = env('REGISTRATION_COMPLETION_ASYNC', default=False)
+
 # Railway Settings
 RAILWAY_PUBLIC_DOMAIN = env('RAILWAY_PUBLIC_DOMAIN', default='')
 
@@ -215,6 +240,7 @@ CORS_ALLOW_HEADERS = [
     'authorization',
     'content-type',
     'dnt',
+    'idempotency-key',
     'origin',
     'user-agent',
     'x-csrftoken',
@@ -227,6 +253,13 @@ if 'postgresql' in DATABASES['default'].get('ENGINE', ''):
     DATABASES['default']['OPTIONS'] = {
         'connect_timeout': 5,
     }
+elif 'sqlite' in DATABASES['default'].get('ENGINE', ''):
+    # IMMEDIATE: транзакция сразу берет блокировку записи, иначе параллельные
+    # размещения получают "database is locked" при повышении блокировки
+    DATABASES['default']['OPTIONS'] = {
+        'transaction_mode': 'IMMEDIATE',
+        'timeout': 20,
+    }
 
 # Logging
 LOGGING = {
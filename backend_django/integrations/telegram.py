@@ -12,7 +12,6 @@ from django.views.decorators.http import require_http_methods
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler
 from telegram.request import HTTPXRequest
-from django.db import models
 from asgiref.sync import sync_to_async
 from core.models import User
 from mlm.models import StructureNode, Tariff
@@ -56,10 +55,8 @@ def get_node_for_user(db_user):
 
 @sync_to_async
 def get_bonus_summary(db_user):
-    total = Bonus.objects.filter(user=db_user).aggregate(total=models.Sum('amount'))['total'] or 0
-    green = Bonus.objects.filter(user=db_user, bonus_type=Bonus.BonusType.GREEN).aggregate(total=models.Sum('amount'))['total'] or 0
-    yellow = Bonus.objects.filter(user=db_user, bonus_type=Bonus.BonusType.YELLOW).aggregate(total=models.Sum('amount'))['total'] or 0
-    return total, green, yellow
+    from billing.services import get_bonus_totals
+    return get_bonus_totals(db_user)
 
 
 @sync_to_async
@@ -90,18 +87,12 @@ def pay_from_balance(user, tariff):
     from django.db import transaction
     from django.utils import timezone
     from mlm.services import place_user
-    from billing.services import apply_signup_bonuses
+    from billing.models import LedgerEntry
+    from billing.services import apply_signup_bonuses, debit_balance
     from mlm.models import StructureNode
     
     try:
         with transaction.atomic():
-            # Обновляем пользователя из БД для получения актуального баланса
-            user.refresh_from_db()
-            
-            # Проверяем достаточность баланса
-            if user.balance < tariff.entry_amount:
-                return False, f"❌ Недостаточно средств на балансе. Текущий баланс: ${user.balance:.2f}, требуется: ${tariff.entry_amount:.2f}", None, user.balance
-            
             # Создаем платеж со статусом COMPLETED
             payment = Payment.objects.create(
                 user=user,
@@ -112,11 +103,22 @@ def pay_from_balance(user, tariff):
                 metadata={'payment_method': 'balance', 'source': 'telegram_bot'}
             )
             
-            # Списываем сумму с баланса
-            user.balance -= tariff.entry_amount
-            user.save()
+            # Проверка и списание - один условный UPDATE (balance >= суммы), с записью в журнал
+            entry = debit_balance(
+                user,
+                tariff.entry_amount,
+                LedgerEntry.Reason.PAYMENT,
+                payment=payment,
+                description=f"Оплата тарифа {tariff.name}",
+            )
+            if entry is None:
+                # Средств недостаточно - отменяем созданный платеж
+                user.refresh_from_db(fields=['balance'])
+                transaction.set_rollback(True)
+                return False, f"❌ Недостаточно средств на балансе. Текущий баланс: ${user.balance:.2f}, требуется: ${tariff.entry_amount:.2f}", None, user.balance
             
             # Проверяем, размещен ли пользователь в структуре
+            structure_node = None
             is_placed = StructureNode.objects.filter(user=user).exists()
             
             # Если пользователь еще не размещен и еще не партнер, размещаем его
@@ -124,7 +126,7 @@ def pay_from_balance(user, tariff):
                 # Меняем статус на PARTNER (если еще не партнер)
                 if user.status == User.UserStatus.PARTICIPANT:
                     user.status = User.UserStatus.PARTNER
-                    user.save()
+                    user.save(update_fields=['status'])
                 
                 # Размещаем в структуре
                 try:
@@ -137,7 +139,7 @@ def pay_from_balance(user, tariff):
             
             # Начисляем бонусы (всегда, независимо от размещения)
             try:
-                bonuses = apply_signup_bonuses(user, payment)
+                bonuses = apply_signup_bonuses(user, payment, node=structure_node)
                 logger.info(f"✅ Начислено бонусов: {len(bonuses)}")
             except Exception as e:
                 logger.error(f"❌ Ошибка при начислении бонусов: {e}")
@@ -644,25 +646,16 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             level = node.level
             position = node.position
             tariff = node.tariff.name if node.tariff else "Нет"
+            downline = node.descendant_count
         except StructureNode.DoesNotExist:
             level = "Не размещен"
             position = "-"
             tariff = "Нет"
+            downline = 0
         
         # Получаем бонусы из БД
-        total_bonuses = Bonus.objects.filter(user=db_user).aggregate(
-            total=models.Sum('amount')
-        )['total'] or 0
-        
-        green_bonuses = Bonus.objects.filter(
-            user=db_user,
-            bonus_type=Bonus.BonusType.GREEN
-        ).aggregate(total=models.Sum('amount'))['total'] or 0
-        
-        yellow_bonuses = Bonus.objects.filter(
-            user=db_user,
-            bonus_type=Bonus.BonusType.YELLOW
-        ).aggregate(total=models.Sum('amount'))['total'] or 0
+        from billing.services import get_bonus_totals
+        total_bonuses, green_bonuses, yellow_bonuses = get_bonus_totals(db_user)
         
         stats_text = f"""
 📊 Твоя статистика:
@@ -675,6 +668,7 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
    Уровень: {level}
    Позиция: {position}
    Тариф: {tariff}
+   В downline: {downline}
 
 💰 Бонусы (из БД):
    Всего: ${total_bonuses:.2f}
@@ -1,7 +1,17 @@
 from django.contrib import admin
+from django.db import transaction
 from django.utils.html import format_html
 from django.urls import reverse
-from .models import Tariff, StructureNode
+from .models import Tariff, TariffLevelBonus, StructureNode
+from .services import get_upline, repair_node_edit
+
+
+class TariffLevelBonusInline(admin.TabularInline):
+    """Уровневые бонусы тарифа (процент вышестоящему на каждой глубине)."""
+    model = TariffLevelBonus
+    extra = 0
+    fields = ['depth', 'percent']
+    ordering = ['depth']
 
 
 @admin.register(Tariff)
@@ -11,6 +21,7 @@ class TariffAdmin(admin.ModelAdmin):
     search_fields = ['code', 'name']
     list_editable = ['is_active']
     readonly_fields = ['created_at', 'get_statistics']
+    inlines = [TariffLevelBonusInline]
     
     fieldsets = (
         ('Основная информация', {
@@ -81,11 +92,11 @@ class TariffAdmin(admin.ModelAdmin):
 
 @admin.register(StructureNode)
 class StructureNodeAdmin(admin.ModelAdmin):
-    list_display = ['get_user_link', 'get_parent_link', 'level', 'position', 'get_tariff_link', 'created_at']
+    list_display = ['get_user_link', 'get_parent_link', 'level', 'position', 'descendant_count', 'get_tariff_link', 'created_at']
     list_filter = ['level', 'tariff', 'created_at']
     search_fields = ['user__username', 'parent__username']
     raw_id_fields = ['user', 'parent']
-    readonly_fields = ['created_at', 'get_children_info', 'get_structure_path']
+    readonly_fields = ['level', 'created_at', 'descendant_count', 'max_descendant_depth', 'get_children_info', 'get_structure_path']
     date_hierarchy = 'created_at'
     
     fieldsets = (
@@ -93,7 +104,7 @@ class StructureNodeAdmin(admin.ModelAdmin):
             'fields': ('user', 'parent', 'level', 'position', 'tariff')
         }),
         ('Структура', {
-            'fields': ('get_structure_path', 'get_children_info'),
+            'fields': ('descendant_count', 'max_descendant_depth', 'get_structure_path', 'get_children_info'),
             'classes': ('collapse',)
         }),
         ('Дополнительно', {
@@ -102,6 +113,32 @@ class StructureNodeAdmin(admin.ModelAdmin):
         }),
     )
     
+    def get_readonly_fields(self, request, obj=None):
+        """Пользователя узла менять нельзя: на него ссылаются дети, замыкание и индекс позиций."""
+        readonly = list(super().get_readonly_fields(request, obj))
+        if obj is not None:
+            readonly.append('user')
+        return readonly
+    
+    def save_model(self, request, obj, form, change):
+        """Ручное изменение узла меняет дерево - пересчитываем пути, замыкание, индекс и счетчики его поддерева."""
+        before = StructureNode.objects.filter(pk=obj.pk).first() if change else None
+        with transaction.atomic():
+            super().save_model(request, obj, form, change)
+            repair_node_edit(before, obj)
+    
+    def delete_model(self, request, obj):
+        with transaction.atomic():
+            super().delete_model(request, obj)
+            repair_node_edit(obj, None)
+    
+    def delete_queryset(self, request, queryset):
+        # Сначала нижние узлы: пути и уровни оставшихся узлов при этом не меняются
+        with transaction.atomic():
+            for node in queryset.order_by('-level'):
+                node.delete()
+                repair_node_edit(node, None)
+    
     def get_user_link(self, obj):
         """Ссылка на пользователя."""
         if not obj.pk or not obj.user:
@@ -189,19 +226,29 @@ class StructureNodeAdmin(admin.ModelAdmin):
         
         try:
             path_items = []
-            current = obj
-            while current.parent:
-                parent_node = StructureNode.objects.filter(user=current.parent).first()
-                if parent_node:
-                    try:
-                        url = reverse('admin:core_user_change', args=[current.parent.id])
-                        path_items.insert(0, f'<a href="{url}">{current.parent.username}</a> (L{parent_node.level} P{parent_node.position})')
-                    except Exception:
-                        username = current.parent.username if current.parent else "N/A"
-                        path_items.insert(0, f'{username} (L{parent_node.level} P{parent_node.position})')
-                    current = parent_node
-                else:
-                    break
+            # Все предки одним запросом по таблице замыкания
+            ancestors = list(get_upline(obj.user).select_related('user'))
+            for ancestor in reversed(ancestors):
+                try:
+                    url = reverse('admin:core_user_change', args=[ancestor.user.id])
+                    path_items.append(f'<a href="{url}">{ancestor.user.username}</a> (L{ancestor.level} P{ancestor.position})')
+                except Exception:
+                    path_items.append(f'{ancestor.user.username} (L{ancestor.level} P{ancestor.position})')
+            if not ancestors and obj.parent_id:
+                # Таблица замыкания еще не заполнена (backfill_structure_closure) - идем по родителям
+                current = obj
+                while current.parent:
+                    parent_node = StructureNode.objects.filter(user=current.parent).first()
+                    if parent_node:
+                        try:
+                            url = reverse('admin:core_user_change', args=[current.parent.id])
+                            path_items.insert(0, f'<a href="{url}">{current.parent.username}</a> (L{parent_node.level} P{parent_node.position})')
+                        except Exception:
+                            username = current.parent.username if current.parent else "N/A"
+                            path_items.insert(0, f'{username} (L{parent_node.level} P{parent_node.position})')
+                        current = parent_node
+                    else:
+                        break
             
             if path_items:
                 path_html = ' → '.join(path_items)
@@ -0,0 +1,35 @@
+"""
+Django команда для заполнения таблицы замыкания структуры (StructureClosure).
+Обрабатывает уровни по очереди, каждый в своей транзакции: прерванный запуск
+можно повторить, уже обработанные узлы пропускаются.
+"""
+from django.core.management.base import BaseCommand
+from mlm.models import StructureClosure
+from mlm.services import backfill_structure_closure
+
+
+class Command(BaseCommand):
+    help = 'Заполнить таблицу замыкания (предок, потомок, глубина) для узлов структуры'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rebuild',
+            action='store_true',
+            help='Удалить таблицу замыкания и построить ее заново',
+        )
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            self.stdout.write('🔄 Перестроение таблицы замыкания...')
+        else:
+            self.stdout.write('🔄 Заполнение таблицы замыкания для новых узлов...')
+        
+        def progress(level, inserted):
+            if inserted:
+                self.stdout.write(f'   ... уровень {level}: {inserted} строк')
+        
+        inserted = backfill_structure_closure(rebuild=options['rebuild'], progress=progress)
+        
+        self.stdout.write(self.style.SUCCESS('✅ Таблица замыкания заполнена!'))
+        self.stdout.write(f'   - Добавлено строк: {inserted}')
+        self.stdout.write(f'   - Всего строк: {StructureClosure.objects.count()}')
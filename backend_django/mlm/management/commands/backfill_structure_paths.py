@@ -0,0 +1,45 @@
+"""
+Django команда для заполнения материализованных путей структуры.
+Выполняется пакетами, каждый пакет в своей транзакции: прерванный запуск
+можно повторить, уже заполненные узлы пропускаются.
+"""
+from django.core.management.base import BaseCommand
+from mlm.models import StructureNode, OpenSlot
+from mlm.services import backfill_structure_paths
+
+
+class Command(BaseCommand):
+    help = 'Заполнить материализованный путь (path) у узлов структуры и свободных позиций'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            dest='batch_size',
+            type=int,
+            default=1000,
+            help='Количество строк в одной транзакции',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        pending_nodes = StructureNode.objects.filter(path='').count()
+        pending_slots = OpenSlot.objects.filter(path='').count()
+        
+        if not pending_nodes and not pending_slots:
+            self.stdout.write(self.style.SUCCESS('✅ Пути уже заполнены'))
+            return
+        
+        self.stdout.write(
+            f'🔄 Заполнение путей: узлов {pending_nodes}, свободных позиций {pending_slots} '
+            f'(пакет {batch_size})...'
+        )
+        
+        def progress(model_name, processed):
+            if processed % (batch_size * 10) == 0:
+                self.stdout.write(f'   ... {model_name}: {processed}')
+        
+        nodes_done, slots_done = backfill_structure_paths(batch_size=batch_size, progress=progress)
+        
+        self.stdout.write(self.style.SUCCESS('✅ Пути заполнены!'))
+        self.stdout.write(f'   - Узлов: {nodes_done}')
+        self.stdout.write(f'   - Свободных позиций: {slots_done}')
@@ -0,0 +1,217 @@
+"""
+Django команда для сравнения стратегий размещения на большой структуре.
+
+Каждая стратегия прогоняется на дереве в памяти (ее симулятор) и на БД.
+Прогон на БД выполняется в транзакции, которая откатывается, поэтому базовая
+структура не меняется и стратегии замеряются на одинаковых данных.
+Запускать только на тестовой базе: недостающие узлы базовой структуры
+создаются и сохраняются (стратегией bfs).
+"""
+import random
+import secrets
+import statistics
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from core.models import User
+from mlm.models import Tariff, StructureNode
+from billing.models import Payment
+from mlm.placement import PLACEMENT_STRATEGIES, get_placement_strategy
+from mlm.services import place_user, place_users_bulk, number_structure, check_heap_consistency
+
+
+class QueryCounter:
+    """Счетчик SQL-запросов для connection.execute_wrapper (не ограничен размером queries_log)."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = 'Сравнить стратегии размещения: размещений в секунду, запросов на размещение и p99 (в памяти и на БД)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--nodes',
+            type=int,
+            default=500000,
+            help='Размер структуры перед замером (недостающие узлы будут созданы)',
+        )
+        parser.add_argument(
+            '--placements',
+            type=int,
+            default=1000,
+            help='Сколько размещений замерить для каждой стратегии',
+        )
+        parser.add_argument(
+            '--strategy',
+            choices=sorted(PLACEMENT_STRATEGIES) + ['all'],
+            default='all',
+            help='Стратегия размещения для замера (all - все зарегистрированные)',
+        )
+        parser.add_argument(
+            '--target',
+            choices=('memory', 'db', 'both'),
+            default='both',
+            help='Где выполнять прогон: дерево в памяти, БД или и то и другое',
+        )
+        parser.add_argument(
+            '--batch-size',
+            dest='batch_size',
+            type=int,
+            default=5000,
+            help='Размер пакета при построении структуры в БД',
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=42,
+            help='Зерно генератора случайных пригласивших',
+        )
+
+    def handle(self, *args, **options):
+        if options['strategy'] == 'all':
+            strategies = sorted(PLACEMENT_STRATEGIES)
+        else:
+            strategies = [options['strategy']]
+        results = []
+
+        if options['target'] in ('memory', 'both'):
+            for name in strategies:
+                self.stdout.write(f'🧮 Память: {name}, {options["nodes"]} узлов + {options["placements"]} размещений...')
+                results.append((name, 'memory', self._run_memory(name, options)))
+
+        if options['target'] in ('db', 'both'):
+            tariff, _ = Tariff.objects.get_or_create(
+                code='bench',
+                defaults={'name': 'Bench', 'entry_amount': Decimal('10.00')},
+            )
+            self._ensure_structure(options['nodes'], tariff, options['batch_size'])
+            for name in strategies:
+                self.stdout.write(f'🗄  БД ({connection.vendor}): {name}, {options["placements"]} размещений...')
+                stats = self._run_db(name, tariff, options)
+                if stats is not None:
+                    results.append((name, connection.vendor, stats))
+
+        self.stdout.write(self.style.SUCCESS('✅ Результат:'))
+        self.stdout.write(f'   {"стратегия":<14}{"среда":<10}{"разм./с":>10}{"сред. мс":>10}{"p99 мс":>10}{"запросов":>10}')
+        for name, target, stats in results:
+            self.stdout.write(
+                f'   {name:<14}{target:<10}{stats["rate"]:>10.1f}{stats["mean_ms"]:>10.3f}'
+                f'{stats["p99_ms"]:>10.3f}{stats["queries"]:>10.1f}'
+            )
+
+    def _run_memory(self, name, options):
+        """Построить дерево стратегией в памяти и замерить следующие размещения."""
+        rng = random.Random(options['seed'])
+        simulator = get_placement_strategy(name).simulator()
+        placed = []
+        for user_id in range(1, options['nodes'] + 1):
+            simulator.place(user_id, rng.choice(placed) if placed else None)
+            placed.append(user_id)
+
+        durations = []
+        for user_id in range(options['nodes'] + 1, options['nodes'] + options['placements'] + 1):
+            inviter_id = rng.choice(placed)
+            started = time.perf_counter()
+            simulator.place(user_id, inviter_id)
+            durations.append(time.perf_counter() - started)
+            placed.append(user_id)
+        return self._summarize(durations, [0] * len(durations))
+
+    def _run_db(self, name, tariff, options):
+        """Замерить размещения на БД; все изменения откатываются. None - стратегия неприменима."""
+        rng = random.Random(options['seed'])
+        durations = []
+        queries = []
+        with transaction.atomic():
+            if name == 'heap':
+                if StructureNode.objects.filter(sequence=None).exists():
+                    # Базовая структура строится стратегией bfs, поэтому ее можно пронумеровать
+                    number_structure()
+                mismatches, _ = check_heap_consistency(limit=1)
+                if mismatches:
+                    # Структура не является полным деревом (в ней размещали другими стратегиями)
+                    self.stdout.write(self.style.WARNING(
+                        f'⚠️  heap пропущен: {mismatches} узлов не соответствуют порядковым номерам'
+                    ))
+                    transaction.set_rollback(True)
+                    return None
+            inviter_ids = list(StructureNode.objects.values_list('user_id', flat=True))
+            users = self._create_users(options['placements'], 'm', inviter_ids, rng)
+            for user in users:
+                payment = self._payment(user, tariff)
+                counter = QueryCounter()
+                with connection.execute_wrapper(counter):
+                    started = time.perf_counter()
+                    place_user(user, payment, strategy=name)
+                    durations.append(time.perf_counter() - started)
+                queries.append(counter.count)
+            transaction.set_rollback(True)
+        return self._summarize(durations, queries)
+
+    def _ensure_structure(self, nodes, tariff, batch_size):
+        """Достроить базовую структуру в БД до nodes узлов пакетным размещением (bfs)."""
+        existing = StructureNode.objects.count()
+        missing = nodes - existing
+        if missing <= 0:
+            return
+        self.stdout.write(f'🏗  Построение структуры: {existing} → {nodes} узлов...')
+        started = time.perf_counter()
+        rng = random.Random()
+        inviter_ids = list(StructureNode.objects.values_list('user_id', flat=True))
+        for start in range(0, missing, batch_size):
+            size = min(batch_size, missing - start)
+            users = self._create_users(size, f'b{start}', inviter_ids, rng)
+            place_users_bulk(
+                [(user, self._payment(user, tariff)) for user in users],
+                apply_bonuses=False,
+                strategy='bfs',
+            )
+            inviter_ids.extend(user.id for user in users)
+            self.stdout.write(f'   ... {start + size}/{missing}')
+        self.stdout.write(f'   Построено за {time.perf_counter() - started:.1f} с')
+
+    def _create_users(self, count, prefix, inviter_ids, rng):
+        """Создать пользователей одним bulk_create (пригласивший - случайный из inviter_ids)."""
+        run_id = secrets.token_hex(3)
+        username_prefix = f'bench_{run_id}_{prefix}_'
+        User.objects.bulk_create([
+            User(
+                username=f'{username_prefix}{index}',
+                referral_code=f'B{run_id}{prefix}{index}'[:20],
+                status=User.UserStatus.PARTNER,
+                invited_by_id=rng.choice(inviter_ids) if inviter_ids else None,
+            )
+            for index in range(count)
+        ], batch_size=1000)
+        return list(User.objects.filter(username__startswith=username_prefix).order_by('id'))
+
+    def _payment(self, user, tariff):
+        """Завершенный платеж без сохранения в БД: размещению нужны только статус и тариф."""
+        return Payment(
+            user=user,
+            tariff=tariff,
+            amount=tariff.entry_amount,
+            status=Payment.PaymentStatus.COMPLETED,
+            completed_at=timezone.now(),
+        )
+
+    def _summarize(self, durations, queries):
+        """Размещений в секунду, среднее и p99 (мс), среднее число запросов."""
+        ordered = sorted(durations)
+        total = sum(ordered)
+        return {
+            'rate': len(ordered) / total if total else 0,
+            'mean_ms': statistics.mean(ordered) * 1000,
+            'p99_ms': ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000,
+            'queries': statistics.mean(queries),
+        }
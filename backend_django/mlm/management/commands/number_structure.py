@@ -0,0 +1,44 @@
+"""
+Django команда для нумерации структуры в порядке BFS.
+Нужна перед включением PLACEMENT_STRATEGY=heap на существующих данных.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from mlm.services import number_structure, check_heap_consistency
+
+
+class Command(BaseCommand):
+    help = 'Пронумеровать узлы структуры в порядке BFS и проверить согласованность с полем parent'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Только проверить согласованность, без перенумерации',
+        )
+        parser.add_argument(
+            '--batch-size',
+            dest='batch_size',
+            type=int,
+            default=1000,
+            help='Размер пакета для обновления узлов',
+        )
+
+    def handle(self, *args, **options):
+        if not options['check']:
+            self.stdout.write('🔢 Нумерация структуры в порядке BFS...')
+            numbered = number_structure(batch_size=options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f'✅ Пронумеровано узлов: {numbered}'))
+        
+        self.stdout.write('🔍 Проверка: родитель по номеру узла совпадает с полем parent...')
+        total, mismatches = check_heap_consistency()
+        
+        if not total:
+            self.stdout.write(self.style.SUCCESS('✅ Структура согласована, режим heap можно включать'))
+            return
+        
+        for mismatch in mismatches:
+            self.stdout.write(self.style.WARNING(f'   • {mismatch}'))
+        raise CommandError(
+            f'Найдено расхождений: {total}. Структура не является полным деревом, '
+            f'режим heap для нее неприменим.'
+        )
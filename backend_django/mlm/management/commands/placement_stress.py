@@ -0,0 +1,153 @@
+"""
+Django команда для нагрузочной проверки параллельного размещения.
+Запускать только на тестовой базе: команда создает пользователей и платежи.
+"""
+import secrets
+import threading
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.models import Count
+from django.utils import timezone
+
+from core.models import User
+from mlm.models import Tariff, StructureNode, OpenSlot
+from billing.models import Payment
+from mlm.placement import get_placement_strategy
+from mlm.services import place_user
+
+
+class Command(BaseCommand):
+    help = 'Параллельно разместить N пользователей в несколько потоков и проверить отсутствие дублей позиций'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--count',
+            type=int,
+            default=300,
+            help='Количество размещаемых пользователей',
+        )
+        parser.add_argument(
+            '--threads',
+            type=int,
+            default=8,
+            help='Количество параллельных потоков',
+        )
+
+    def handle(self, *args, **options):
+        count = options['count']
+        threads_count = options['threads']
+
+        self.stdout.write(
+            f'🚀 Нагрузочная проверка размещения: {count} пользователей, {threads_count} потоков '
+            f'(стратегия {settings.MLM_SETTINGS["PLACEMENT_STRATEGY"]}, БД {connection.vendor})'
+        )
+
+        payments = self._create_paid_users(count)
+        chunks = [payments[index::threads_count] for index in range(threads_count)]
+        errors = []
+        errors_lock = threading.Lock()
+
+        def worker(chunk):
+            try:
+                for payment in chunk:
+                    try:
+                        place_user(payment.user, payment)
+                    except Exception as e:
+                        with errors_lock:
+                            errors.append(f'{payment.user.username}: {e}')
+            finally:
+                # У каждого потока свое соединение с БД
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker, args=(chunk,)) for chunk in chunks]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        placed = StructureNode.objects.filter(user__in=[payment.user_id for payment in payments]).count()
+        rate = placed / elapsed if elapsed else 0
+        self.stdout.write(f'⏱  Время: {elapsed:.2f} с, размещено: {placed}, скорость: {rate:.1f} размещений/с')
+
+        problems = self._check_structure()
+        for error in errors[:10]:
+            self.stdout.write(self.style.WARNING(f'   • {error}'))
+        if errors:
+            problems.append(f'Ошибок размещения: {len(errors)}')
+        if placed != count:
+            problems.append(f'Размещено {placed} из {count}')
+
+        if problems:
+            raise CommandError('; '.join(problems))
+        self.stdout.write(self.style.SUCCESS('✅ Дублей позиций нет, все пользователи размещены'))
+
+    def _create_paid_users(self, count):
+        """Создать пользователей с завершенными платежами."""
+        tariff, _ = Tariff.objects.get_or_create(
+            code='stress',
+            defaults={'name': 'Stress', 'entry_amount': Decimal('10.00')},
+        )
+        run_id = secrets.token_hex(4)
+        User.objects.bulk_create([
+            User(
+                username=f'stress_{run_id}_{index}',
+                email=f'stress_{run_id}_{index}@example.com',
+                referral_code=f'S{run_id}{index}'[:20],
+                status=User.UserStatus.PARTNER,
+            )
+            for index in range(count)
+        ])
+        users = list(User.objects.filter(username__startswith=f'stress_{run_id}_'))
+        Payment.objects.bulk_create([
+            Payment(
+                user=user,
+                tariff=tariff,
+                amount=tariff.entry_amount,
+                status=Payment.PaymentStatus.COMPLETED,
+                completed_at=timezone.now(),
+                metadata={'without_bonuses': True},
+            )
+            for user in users
+        ])
+        return list(
+            Payment.objects.filter(user__in=users).select_related('user', 'tariff').order_by('id')
+        )
+
+    def _check_structure(self):
+        """Проверить уникальность позиций и согласованность индекса свободных позиций."""
+        problems = []
+        max_partners = settings.MLM_SETTINGS['MAX_PARTNERS_PER_LEVEL']
+
+        duplicates = (
+            StructureNode.objects.exclude(parent=None)
+            .values('parent_id', 'position')
+            .annotate(total=Count('id'))
+            .filter(total__gt=1)
+        )
+        if duplicates.exists():
+            problems.append(f'Дублирующихся позиций: {duplicates.count()}')
+
+        overfull = (
+            StructureNode.objects.exclude(parent=None)
+            .values('parent_id')
+            .annotate(total=Count('id'))
+            .filter(total__gt=max_partners)
+        )
+        if overfull.exists():
+            problems.append(f'Узлов с превышением лимита партнеров: {overfull.count()}')
+
+        if get_placement_strategy().uses_open_slots:
+            nodes = StructureNode.objects.count()
+            children = StructureNode.objects.exclude(parent=None).count()
+            expected_slots = nodes * max_partners - children
+            actual_slots = OpenSlot.objects.count()
+            if expected_slots != actual_slots:
+                problems.append(f'Индекс свободных позиций рассинхронизирован: {actual_slots} вместо {expected_slots}')
+
+        return problems
@@ -0,0 +1,23 @@
+"""
+Django команда для очистки журнала изменений структуры.
+Клиенты, отставшие больше чем на оставленное число версий, получат resync.
+"""
+from django.core.management.base import BaseCommand
+from mlm.services import prune_structure_events
+
+
+class Command(BaseCommand):
+    help = 'Удалить старые события журнала изменений структуры'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--keep-versions',
+            dest='keep_versions',
+            type=int,
+            default=10000,
+            help='Сколько последних версий структуры хранить в журнале',
+        )
+
+    def handle(self, *args, **options):
+        deleted = prune_structure_events(options['keep_versions'])
+        self.stdout.write(self.style.SUCCESS(f'✅ Удалено событий: {deleted}'))
@@ -0,0 +1,42 @@
+"""
+Django команда для пересчета счетчиков downline (descendant_count, max_descendant_depth).
+Счетчики считаются по таблице замыкания, поэтому сначала должна быть
+выполнена backfill_structure_closure.
+"""
+from django.core.management.base import BaseCommand
+from mlm.services import rebuild_downline_counters, downline_counters_stale
+
+
+class Command(BaseCommand):
+    help = 'Пересчитать счетчики downline у узлов структуры по таблице замыкания'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            dest='batch_size',
+            type=int,
+            default=1000,
+            help='Количество узлов в одном UPDATE',
+        )
+        parser.add_argument(
+            '--if-stale',
+            action='store_true',
+            help='Пересчитывать, только если у узлов с детьми счетчики не заполнены',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if options['if_stale'] and not downline_counters_stale():
+            self.stdout.write(self.style.SUCCESS('✅ Счетчики downline заполнены'))
+            return
+        
+        self.stdout.write('🔄 Пересчет счетчиков downline...')
+        
+        def progress(processed):
+            if processed % (batch_size * 10) == 0:
+                self.stdout.write(f'   ... {processed}')
+        
+        processed = rebuild_downline_counters(batch_size=batch_size, progress=progress)
+        
+        self.stdout.write(self.style.SUCCESS('✅ Счетчики пересчитаны!'))
+        self.stdout.write(f'   - Узлов: {processed}')
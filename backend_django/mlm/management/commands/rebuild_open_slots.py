@@ -0,0 +1,30 @@
+"""
+Django команда для перестроения индекса свободных позиций.
+Нужна после ручного редактирования структуры или изменения MAX_PARTNERS_PER_LEVEL.
+"""
+from django.core.management.base import BaseCommand
+from mlm.models import StructureNode
+from mlm.services import rebuild_open_slots
+
+
+class Command(BaseCommand):
+    help = 'Перестроить индекс свободных позиций (OpenSlot) по текущей структуре'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            dest='batch_size',
+            type=int,
+            default=1000,
+            help='Размер пакета для вставки строк индекса',
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write('🔄 Перестроение индекса свободных позиций...')
+        
+        total_nodes = StructureNode.objects.count()
+        total_slots = rebuild_open_slots(batch_size=options['batch_size'])
+        
+        self.stdout.write(self.style.SUCCESS('✅ Индекс перестроен!'))
+        self.stdout.write(f'   - Узлов в структуре: {total_nodes}')
+        self.stdout.write(f'   - Свободных позиций: {total_slots}')
@@ -0,0 +1,67 @@
+# Generated by Django 5.1.2 on 2026-10-18 02:40
+
+import django.db.models.deletion
+from django.conf import settings
+from collections import deque
+from django.db import migrations, models
+
+
+def fill_open_slots(apps, schema_editor):
+    """Заполнить индекс свободных позиций для уже существующей структуры (BFS)."""
+    StructureNode = apps.get_model('mlm', 'StructureNode')
+    OpenSlot = apps.get_model('mlm', 'OpenSlot')
+    max_partners = settings.MLM_SETTINGS['MAX_PARTNERS_PER_LEVEL']
+
+    nodes = list(
+        StructureNode.objects.order_by('level', 'position', 'id')
+        .values_list('user_id', 'parent_id', 'level', 'position')
+    )
+    placed = {row[0] for row in nodes}
+    children = {}
+    queue = deque()
+    for user_id, parent_id, level, position in nodes:
+        if parent_id is None or parent_id not in placed:
+            queue.append((user_id, level))
+        else:
+            children.setdefault(parent_id, []).append((user_id, level, position))
+
+    slots = []
+    while queue:
+        user_id, level = queue.popleft()
+        node_children = children.get(user_id, [])
+        used_positions = {position for _, _, position in node_children}
+        for pos in range(1, max_partners + 1):
+            if pos not in used_positions:
+                slots.append(OpenSlot(parent_id=user_id, position=pos, level=level + 1))
+        for child_id, child_level, _ in node_children:
+            queue.append((child_id, child_level))
+
+    OpenSlot.objects.bulk_create(slots, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mlm', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OpenSlot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.IntegerField(verbose_name='Позиция')),
+                ('level', models.IntegerField(help_text='Уровень, на котором окажется новый партнер', verbose_name='Уровень')),
+                ('parent', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='open_slots', to=settings.AUTH_USER_MODEL, verbose_name='Родитель')),
+            ],
+            options={
+                'verbose_name': 'Свободная позиция',
+                'verbose_name_plural': 'Свободные позиции',
+                'ordering': ['level', 'id'],
+                'indexes': [models.Index(fields=['level', 'id'], name='mlm_openslot_bfs_idx')],
+                'unique_together': {('parent', 'position')},
+            },
+        ),
+        migrations.RunPython(fill_open_slots, migrations.RunPython.noop),
+    ]
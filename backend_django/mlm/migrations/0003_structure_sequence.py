@@ -0,0 +1,29 @@
+# Generated by Django 5.1.2 on 2026-10-18 02:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mlm', '0002_openslot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StructureState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_sequence', models.BigIntegerField(default=-1, help_text='Номер последнего узла, размещенного в режиме heap (-1 - структура пуста)', verbose_name='Последний порядковый номер')),
+            ],
+            options={
+                'verbose_name': 'Состояние структуры',
+                'verbose_name_plural': 'Состояние структуры',
+            },
+        ),
+        migrations.AddField(
+            model_name='structurenode',
+            name='sequence',
+            field=models.BigIntegerField(blank=True, help_text='Номер узла в порядке BFS (используется режимом размещения heap)', null=True, unique=True, verbose_name='Порядковый номер'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.1.2 on 2026-10-18 02:49
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mlm', '0003_structure_sequence'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='openslot',
+            options={'ordering': ['level', 'path', 'id'], 'verbose_name': 'Свободная позиция', 'verbose_name_plural': 'Свободные позиции'},
+        ),
+        migrations.RemoveIndex(
+            model_name='openslot',
+            name='mlm_openslot_bfs_idx',
+        ),
+        migrations.AddField(
+            model_name='openslot',
+            name='path',
+            field=models.CharField(blank=True, default='', help_text='Материализованный путь, который получит новый партнер', max_length=255, verbose_name='Путь'),
+        ),
+        migrations.AddField(
+            model_name='structurenode',
+            name='path',
+            field=models.CharField(blank=True, db_index=True, default='', help_text='Материализованный путь: ID корня и позиции на каждом уровне. Все узлы поддерева имеют путь, начинающийся с пути его корня', max_length=255, verbose_name='Путь'),
+        ),
+        migrations.AddIndex(
+            model_name='openslot',
+            index=models.Index(fields=['level', 'path', 'id'], name='mlm_openslot_bfs_path_idx'),
+        ),
+    ]
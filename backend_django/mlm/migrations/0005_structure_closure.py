@@ -0,0 +1,31 @@
+# Generated by Django 5.1.2 on 2026-10-18 02:51
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mlm', '0004_structure_path'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StructureClosure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField(help_text='Количество уровней между предком и потомком (0 - сам узел)', verbose_name='Глубина')),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='closure_descendants', to=settings.AUTH_USER_MODEL, verbose_name='Предок')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='closure_ancestors', to=settings.AUTH_USER_MODEL, verbose_name='Потомок')),
+            ],
+            options={
+                'verbose_name': 'Связь предок-потомок',
+                'verbose_name_plural': 'Связи предок-потомок',
+                'indexes': [models.Index(fields=['ancestor', 'depth'], name='mlm_closure_ancestor_idx'), models.Index(fields=['descendant', 'depth'], name='mlm_closure_descendant_idx')],
+                'unique_together': {('ancestor', 'descendant')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 02:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mlm', '0005_structure_closure'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='structurestate',
+            name='version',
+            field=models.BigIntegerField(default=0, help_text='Увеличивается при каждом изменении структуры (ключ кэша дерева и ETag)', verbose_name='Версия структуры'),
+        ),
+    ]
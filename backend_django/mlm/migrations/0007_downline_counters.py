@@ -0,0 +1,23 @@
+# Generated by Django 5.1.2 on 2026-10-18 02:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mlm', '0006_structure_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='structurenode',
+            name='descendant_count',
+            field=models.PositiveIntegerField(default=0, help_text='Количество всех нижестоящих (обновляется при размещении)', verbose_name='Всего в downline'),
+        ),
+        migrations.AddField(
+            model_name='structurenode',
+            name='max_descendant_depth',
+            field=models.PositiveIntegerField(default=0, help_text='На сколько уровней вниз уходит downline (0 - нижестоящих нет)', verbose_name='Глубина downline'),
+        ),
+    ]
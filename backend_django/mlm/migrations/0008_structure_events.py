@@ -0,0 +1,35 @@
+# Generated by Django 5.1.2 on 2026-10-18 03:01
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mlm', '0007_downline_counters'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StructureEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField(db_index=True, verbose_name='Версия структуры')),
+                ('event_type', models.CharField(choices=[('NODE_CREATED', 'Узел добавлен'), ('RESYNC', 'Структура изменена вручную')], default='NODE_CREATED', max_length=20, verbose_name='Тип события')),
+                ('position', models.IntegerField(blank=True, null=True, verbose_name='Позиция')),
+                ('level', models.IntegerField(blank=True, null=True, verbose_name='Уровень')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('parent', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Родитель')),
+                ('tariff', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='mlm.tariff', verbose_name='Тариф')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='structure_events', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Событие структуры',
+                'verbose_name_plural': 'События структуры',
+                'ordering': ['version', 'id'],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.2 on 2026-10-18 03:53
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mlm', '0008_structure_events'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TariffLevelBonus',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField(help_text='На сколько уровней выше нового партнера находится получатель', verbose_name='Уровень')),
+                ('percent', models.DecimalField(decimal_places=2, help_text='Процент от суммы вступительного взноса', max_digits=5, verbose_name='Процент')),
+                ('tariff', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='level_bonuses', to='mlm.tariff', verbose_name='Тариф')),
+            ],
+            options={
+                'verbose_name': 'Уровневый бонус',
+                'verbose_name_plural': 'Уровневые бонусы',
+                'ordering': ['tariff', 'depth'],
+                'unique_together': {('tariff', 'depth')},
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.2 on 2026-10-18 04:13
+
+from django.db import migrations, models
+
+
+def init_sequence_valid(apps, schema_editor):
+    """Нумерация актуальна, только если структура уже пронумерована целиком."""
+    StructureState = apps.get_model('mlm', 'StructureState')
+    StructureNode = apps.get_model('mlm', 'StructureNode')
+    numbered = not StructureNode.objects.filter(sequence=None).exists()
+    StructureState.objects.filter(last_sequence__gte=0).update(sequence_valid=numbered)
+    StructureState.objects.filter(last_sequence__lt=0).update(sequence_valid=not StructureNode.objects.exists())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mlm', '0009_tariff_level_bonus'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='structurestate',
+            name='open_slots_valid',
+            field=models.BooleanField(default=True, help_text='Сбрасывается размещениями в режиме heap, восстанавливается командой rebuild_open_slots', verbose_name='Индекс свободных позиций актуален'),
+        ),
+        migrations.AddField(
+            model_name='structurestate',
+            name='sequence_valid',
+            field=models.BooleanField(default=True, help_text='Сбрасывается размещениями по индексу свободных позиций, восстанавливается командой number_structure', verbose_name='Нумерация узлов актуальна'),
+        ),
+        migrations.RunPython(init_sequence_valid, migrations.RunPython.noop),
+    ]
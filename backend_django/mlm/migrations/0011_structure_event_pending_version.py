@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 04:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mlm', '0010_placement_index_flags'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='structureevent',
+            name='version',
+            field=models.BigIntegerField(blank=True, db_index=True, null=True, verbose_name='Версия структуры'),
+        ),
+    ]
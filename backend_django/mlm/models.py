@@ -51,6 +51,43 @@ class Tariff(models.Model):
         return f"{self.name} ({self.code})"
 
 
+class TariffLevelBonus(models.Model):
+    """
+    Уровневый бонус тарифа: процент вышестоящему на заданной глубине.
+    Глубина 1 - владелец позиции (parent), 2 - его родитель и т.д.
+    Начисляется дополнительно к зеленому и желтому бонусам.
+    """
+    tariff = models.ForeignKey(
+        Tariff,
+        on_delete=models.CASCADE,
+        related_name='level_bonuses',
+        verbose_name=_('Тариф')
+    )
+    depth = models.PositiveIntegerField(
+        verbose_name=_('Уровень'),
+        help_text=_('На сколько уровней выше нового партнера находится получатель')
+    )
+    percent = models.DecimalField(
+        max_digits=5,
+        decimal_places=2,
+        verbose_name=_('Процент'),
+        help_text=_('Процент от суммы вступительного взноса')
+    )
+    
+    class Meta:
+        verbose_name = _('Уровневый бонус')
+        verbose_name_plural = _('Уровневые бонусы')
+        ordering = ['tariff', 'depth']
+        unique_together = [['tariff', 'depth']]
+    
+    def clean(self):
+        if self.depth is not None and self.depth < 1:
+            raise ValidationError({'depth': _('Уровень должен быть не меньше 1')})
+    
+    def __str__(self):
+        return f"{self.tariff_id}: уровень {self.depth} - {self.percent}%"
+
+
 class StructureNode(models.Model):
     """
     Узел MLM структуры.
@@ -78,6 +115,15 @@ class StructureNode(models.Model):
         default=0,
         verbose_name=_('Уровень')
     )
+    path = models.CharField(
+        max_length=255,
+        blank=True,
+        default='',
+        db_index=True,
+        verbose_name=_('Путь'),
+        help_text=_('Материализованный путь: ID корня и позиции на каждом уровне. '
+                    'Все узлы поддерева имеют путь, начинающийся с пути его корня')
+    )
     tariff = models.ForeignKey(
         Tariff,
         on_delete=models.SET_NULL,
@@ -85,6 +131,23 @@ class StructureNode(models.Model):
         blank=True,
         verbose_name=_('Тариф')
     )
+    descendant_count = models.PositiveIntegerField(
+        default=0,
+        verbose_name=_('Всего в downline'),
+        help_text=_('Количество всех нижестоящих (обновляется при размещении)')
+    )
+    max_descendant_depth = models.PositiveIntegerField(
+        default=0,
+        verbose_name=_('Глубина downline'),
+        help_text=_('На сколько уровней вниз уходит downline (0 - нижестоящих нет)')
+    )
+    sequence = models.BigIntegerField(
+        null=True,
+        blank=True,
+        unique=True,
+        verbose_name=_('Порядковый номер'),
+        help_text=_('Номер узла в порядке BFS (используется режимом размещения heap)')
+    )
     created_at = models.DateTimeField(
         auto_now_add=True,
         verbose_name=_('Дата создания')
@@ -97,12 +160,17 @@ class StructureNode(models.Model):
         ordering = ['level', 'position']
     
     def clean(self):
-        """Валидация позиции."""
+        """Валидация позиции и родителя."""
         max_partners = settings.MLM_SETTINGS['MAX_PARTNERS_PER_LEVEL']
         if self.position and self.position > max_partners:
             raise ValidationError(
                 f'Позиция не может быть больше {max_partners}'
             )
+        # Узел нельзя перенести под самого себя или в свое поддерево
+        if self.user_id and self.parent_id and StructureClosure.objects.filter(
+            ancestor_id=self.user_id, descendant_id=self.parent_id
+        ).exists():
+            raise ValidationError('Родитель не может находиться в поддереве узла')
     
     def __str__(self):
         return f"{self.user.username} (Level {self.level}, Position {self.position})"
@@ -112,3 +180,187 @@ class StructureNode(models.Model):
         """Получить дочерние узлы."""
         return StructureNode.objects.filter(parent=self.user)
 
+
+class OpenSlot(models.Model):
+    """
+    Свободная позиция в структуре (индекс фронтира размещения).
+    На каждую незанятую позицию узла хранится отдельная строка, поэтому
+    первое свободное место по порядку BFS берется одним индексным запросом.
+    """
+    parent = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='open_slots',
+        verbose_name=_('Родитель')
+    )
+    position = models.IntegerField(
+        verbose_name=_('Позиция')
+    )
+    level = models.IntegerField(
+        verbose_name=_('Уровень'),
+        help_text=_('Уровень, на котором окажется новый партнер')
+    )
+    path = models.CharField(
+        max_length=255,
+        blank=True,
+        default='',
+        verbose_name=_('Путь'),
+        help_text=_('Материализованный путь, который получит новый партнер')
+    )
+    
+    class Meta:
+        verbose_name = _('Свободная позиция')
+        verbose_name_plural = _('Свободные позиции')
+        unique_together = [['parent', 'position']]
+        # Внутри уровня пути упорядочены слева направо, поэтому (level, path) и есть порядок заполнения
+        ordering = ['level', 'path', 'id']
+        indexes = [
+            models.Index(fields=['level', 'path', 'id'], name='mlm_openslot_bfs_path_idx'),
+        ]
+    
+    def __str__(self):
+        return f"Slot L{self.level} P{self.position} (parent {self.parent_id})"
+
+
+class StructureState(models.Model):
+    """
+    Служебные счетчики структуры.
+    Хранится в единственной строке (pk=1).
+    """
+    SINGLETON_PK = 1
+    
+    last_sequence = models.BigIntegerField(
+        default=-1,
+        verbose_name=_('Последний порядковый номер'),
+        help_text=_('Номер последнего узла, размещенного в режиме heap (-1 - структура пуста)')
+    )
+    version = models.BigIntegerField(
+        default=0,
+        verbose_name=_('Версия структуры'),
+        help_text=_('Увеличивается при каждом изменении структуры (ключ кэша дерева и ETag)')
+    )
+    open_slots_valid = models.BooleanField(
+        default=True,
+        verbose_name=_('Индекс свободных позиций актуален'),
+        help_text=_('Сбрасывается размещениями в режиме heap, восстанавливается командой rebuild_open_slots')
+    )
+    sequence_valid = models.BooleanField(
+        default=True,
+        verbose_name=_('Нумерация узлов актуальна'),
+        help_text=_('Сбрасывается размещениями по индексу свободных позиций, восстанавливается командой number_structure')
+    )
+    
+    class Meta:
+        verbose_name = _('Состояние структуры')
+        verbose_name_plural = _('Состояние структуры')
+    
+    def __str__(self):
+        return f"Structure state (last sequence {self.last_sequence}, version {self.version})"
+
+
+class StructureClosure(models.Model):
+    """
+    Таблица замыкания структуры: строка на каждую пару (предок, потомок).
+    Для каждого узла хранится и строка на самого себя с depth=0, поэтому
+    вышестоящие, нижестоящие на N уровней и размер downline
+    выбираются одним индексным запросом.
+    """
+    ancestor = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='closure_descendants',
+        verbose_name=_('Предок')
+    )
+    descendant = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='closure_ancestors',
+        verbose_name=_('Потомок')
+    )
+    depth = models.PositiveIntegerField(
+        verbose_name=_('Глубина'),
+        help_text=_('Количество уровней между предком и потомком (0 - сам узел)')
+    )
+    
+    class Meta:
+        verbose_name = _('Связь предок-потомок')
+        verbose_name_plural = _('Связи предок-потомок')
+        unique_together = [['ancestor', 'descendant']]
+        indexes = [
+            models.Index(fields=['ancestor', 'depth'], name='mlm_closure_ancestor_idx'),
+            models.Index(fields=['descendant', 'depth'], name='mlm_closure_descendant_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.ancestor_id} → {self.descendant_id} (depth {self.depth})"
+
+
+class StructureEvent(models.Model):
+    """
+    Журнал изменений структуры (только добавление).
+    Каждое событие помечено версией структуры, в которой оно произошло,
+    поэтому клиент, знающий свою версию, может дочитать только новые изменения.
+    Версия присваивается после commit изменения (пока ее нет - событие не опубликовано).
+    """
+    
+    class EventType(models.TextChoices):
+        NODE_CREATED = 'NODE_CREATED', _('Узел добавлен')
+        RESYNC = 'RESYNC', _('Структура изменена вручную')
+    
+    version = models.BigIntegerField(
+        null=True,
+        blank=True,
+        db_index=True,
+        verbose_name=_('Версия структуры')
+    )
+    event_type = models.CharField(
+        max_length=20,
+        choices=EventType.choices,
+        default=EventType.NODE_CREATED,
+        verbose_name=_('Тип события')
+    )
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='structure_events',
+        verbose_name=_('Пользователь')
+    )
+    parent = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+',
+        verbose_name=_('Родитель')
+    )
+    position = models.IntegerField(
+        null=True,
+        blank=True,
+        verbose_name=_('Позиция')
+    )
+    level = models.IntegerField(
+        null=True,
+        blank=True,
+        verbose_name=_('Уровень')
+    )
+    tariff = models.ForeignKey(
+        Tariff,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        verbose_name=_('Тариф')
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name=_('Дата создания')
+    )
+    
+    class Meta:
+        verbose_name = _('Событие структуры')
+        verbose_name_plural = _('События структуры')
+        ordering = ['version', 'id']
+    
+    def __str__(self):
+        return f"v{self.version} {self.event_type} {self.user_id}"
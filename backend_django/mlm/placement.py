@@ -0,0 +1,416 @@
+"""
+Стратегии размещения пользователей в MLM структуре.
+
+Стратегия выбирается через MLM_SETTINGS['PLACEMENT_STRATEGY'] и отвечает только
+за выбор места (родитель, позиция); создание узла, таблица замыкания, журнал
+изменений и счетчики downline общие и остаются в mlm.services.
+
+У каждой стратегии есть симулятор - та же логика выбора места на дереве в памяти,
+без БД (используется командой benchmark_placement).
+"""
+import bisect
+from collections import Counter, deque, namedtuple
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+
+from core.models import User
+from .models import StructureNode, StructureState, OpenSlot
+from .services import (
+    PlacementConflict,
+    root_path,
+    child_path,
+    path_ancestors,
+    register_open_slots,
+    find_open_slot,
+    find_subtree_open_slot,
+    heap_parent_position,
+    allocate_heap_slot,
+    allocate_frontier_nodes_bulk,
+    allocate_heap_nodes_bulk,
+)
+
+# Выбранное место: parent - User (None для корня), sequence - номер узла в режиме heap
+PlacementTarget = namedtuple('PlacementTarget', ['parent', 'position', 'level', 'path', 'sequence'])
+
+# Зарегистрированные стратегии: имя -> экземпляр
+PLACEMENT_STRATEGIES = {}
+
+
+def register_placement_strategy(strategy_class):
+    """Декоратор: зарегистрировать стратегию размещения под ее именем."""
+    PLACEMENT_STRATEGIES[strategy_class.name] = strategy_class()
+    return strategy_class
+
+
+def get_placement_strategy(name=None):
+    """
+    Получить стратегию размещения.
+
+    Args:
+        name: имя стратегии (по умолчанию MLM_SETTINGS['PLACEMENT_STRATEGY'])
+
+    Returns:
+        PlacementStrategy объект
+
+    Raises:
+        ImproperlyConfigured: если стратегия с таким именем не зарегистрирована
+    """
+    name = name or settings.MLM_SETTINGS['PLACEMENT_STRATEGY']
+    try:
+        return PLACEMENT_STRATEGIES[name]
+    except KeyError:
+        raise ImproperlyConfigured(
+            f"Неизвестная стратегия размещения: {name}. Доступны: {', '.join(sorted(PLACEMENT_STRATEGIES))}"
+        )
+
+
+def _slot_target(slot, user):
+    """Занять позицию из индекса OpenSlot (строка уже заблокирована) и вернуть место."""
+    if slot is None:
+        # Структура пуста - пользователь становится корнем
+        return PlacementTarget(None, 1, 0, root_path(user.id), None)
+    deleted, _ = OpenSlot.objects.filter(pk=slot.pk).delete()
+    if not deleted:
+        # На СУБД без построчных блокировок позицию мог забрать параллельный запрос
+        raise PlacementConflict(f"Позиция {slot.position} у {slot.parent.username} уже занята")
+    return PlacementTarget(slot.parent, slot.position, slot.level, slot.path, None)
+
+
+class PlacementStrategy:
+    """
+    Базовая стратегия размещения.
+
+    Наследник реализует claim() (выбрать и занять место внутри транзакции)
+    и find_parent() (то же без блокировок, для предпросмотра), а также
+    указывает simulator_class для прогона в памяти.
+    """
+    name = None
+    # Ведет ли стратегия индекс свободных позиций OpenSlot
+    uses_open_slots = True
+    simulator_class = None
+
+    def claim(self, user, pending_descendants=None):
+        """
+        Выбрать и занять место для пользователя. Выполняется внутри транзакции.
+
+        Args:
+            user: User объект для размещения
+            pending_descendants: Counter путь -> число узлов, добавленных в поддерево
+                текущим пакетом (счетчики downline пакета обновляются в конце)
+
+        Returns:
+            PlacementTarget
+
+        Raises:
+            PlacementConflict: если место занято параллельным размещением
+        """
+        raise NotImplementedError
+
+    def find_parent(self, user):
+        """
+        Место, которое получит пользователь, без блокировок и изменений.
+
+        Returns:
+            tuple: (parent_user, position) или (None, None) если структура пуста
+        """
+        raise NotImplementedError
+
+    def allocate_bulk(self, users_with_payments, tariffs):
+        """
+        Разместить пакет пользователей: создать узлы и строки индекса.
+        Выполняется внутри транзакции; замыкание, события и счетчики
+        записывает place_users_bulk.
+
+        По умолчанию места выбираются по одному через claim().
+
+        Returns:
+            list: Список созданных StructureNode объектов
+        """
+        pending_descendants = Counter()
+        nodes = []
+        for user, payment in users_with_payments:
+            target = self.claim(user, pending_descendants=pending_descendants)
+            node = StructureNode.objects.create(
+                user=user,
+                parent=target.parent,
+                position=target.position,
+                level=target.level,
+                path=target.path,
+                tariff=tariffs[payment.tariff_id],
+                sequence=target.sequence,
+            )
+            if self.uses_open_slots:
+                register_open_slots(node)
+            pending_descendants.update(path_ancestors(node.path))
+            nodes.append(node)
+        return nodes
+
+    def simulator(self, max_partners=None):
+        """Симулятор стратегии (дерево в памяти)."""
+        return self.simulator_class(max_partners or settings.MLM_SETTINGS['MAX_PARTNERS_PER_LEVEL'])
+
+
+class TreeSimulator:
+    """
+    Дерево в памяти для прогона стратегии без БД.
+
+    Хранит для каждого узла родителя, уровень, путь, занятые позиции и размер
+    downline; наследник реализует choose() - выбор места по логике стратегии.
+    """
+
+    def __init__(self, max_partners):
+        self.max_partners = max_partners
+        self.parent = {}
+        self.level = {}
+        self.path = {}
+        self.children = {}
+        self.descendant_count = {}
+        self.root_id = None
+
+    def __len__(self):
+        return len(self.parent)
+
+    def place(self, user_id, inviter_id=None):
+        """
+        Разместить пользователя.
+
+        Returns:
+            tuple: (parent_id, position)
+        """
+        if self.root_id is None:
+            parent_id, position = None, 1
+            self.root_id = user_id
+            self.level[user_id] = 0
+            self.path[user_id] = root_path(user_id)
+        else:
+            parent_id, position = self.choose(inviter_id)
+            self.level[user_id] = self.level[parent_id] + 1
+            self.path[user_id] = child_path(self.path[parent_id], position)
+            self.children[parent_id][position] = user_id
+        self.parent[user_id] = parent_id
+        self.children[user_id] = {}
+        self.descendant_count[user_id] = 0
+
+        ancestor_id = parent_id
+        while ancestor_id is not None:
+            self.descendant_count[ancestor_id] += 1
+            ancestor_id = self.parent[ancestor_id]
+        self.placed(user_id)
+        return parent_id, position
+
+    def choose(self, inviter_id):
+        """Выбрать место (parent_id, position) для нового узла."""
+        raise NotImplementedError
+
+    def placed(self, user_id):
+        """Обновить вспомогательные индексы после добавления узла."""
+
+    def free_positions(self, user_id):
+        """Свободные позиции узла по возрастанию."""
+        used = self.children[user_id]
+        return [pos for pos in range(1, self.max_partners + 1) if pos not in used]
+
+
+class FrontierSimulator(TreeSimulator):
+    """Общий фронтир в порядке BFS: очередь свободных позиций."""
+
+    def __init__(self, max_partners):
+        super().__init__(max_partners)
+        self.frontier = deque()
+
+    def choose(self, inviter_id):
+        return self.frontier.popleft()
+
+    def placed(self, user_id):
+        self.frontier.extend((user_id, pos) for pos in range(1, self.max_partners + 1))
+
+
+class SubtreeFrontierSimulator(TreeSimulator):
+    """Фронтир по уровням, отсортированный по пути: поиск в диапазоне путей поддерева."""
+
+    def __init__(self, max_partners):
+        super().__init__(max_partners)
+        self.open_by_level = {}
+
+    def choose(self, inviter_id):
+        if inviter_id in self.path:
+            prefix = self.path[inviter_id]
+            for level in range(self.level[inviter_id] + 1, max(self.open_by_level) + 1):
+                slots = self.open_by_level.get(level, [])
+                index = bisect.bisect_left(slots, (prefix,))
+                if index < len(slots) and slots[index][0].startswith(prefix):
+                    return self._take(level, index)
+        level = min(level for level, slots in self.open_by_level.items() if slots)
+        return self._take(level, 0)
+
+    def _take(self, level, index):
+        _, parent_id, position = self.open_by_level[level].pop(index)
+        return parent_id, position
+
+    def placed(self, user_id):
+        slots = self.open_by_level.setdefault(self.level[user_id] + 1, [])
+        for pos in range(1, self.max_partners + 1):
+            bisect.insort(slots, (child_path(self.path[user_id], pos), user_id, pos))
+
+
+class BalancedLegSimulator(TreeSimulator):
+    """Спуск от пригласившего в ногу с наименьшим downline."""
+
+    def choose(self, inviter_id):
+        current = inviter_id if inviter_id in self.parent else self.root_id
+        while True:
+            free = self.free_positions(current)
+            if free:
+                return current, free[0]
+            children = self.children[current]
+            current = min(
+                children.values(),
+                key=lambda child_id: (self.descendant_count[child_id], self.path[child_id]),
+            )
+
+
+class HeapSimulator(TreeSimulator):
+    """Полное k-арное дерево: родитель вычисляется по порядковому номеру."""
+
+    def __init__(self, max_partners):
+        super().__init__(max_partners)
+        self.by_sequence = []
+
+    def choose(self, inviter_id):
+        parent_sequence, position = heap_parent_position(len(self.by_sequence), self.max_partners)
+        return self.by_sequence[parent_sequence], position
+
+    def placed(self, user_id):
+        self.by_sequence.append(user_id)
+
+
+@register_placement_strategy
+class BFSPlacementStrategy(PlacementStrategy):
+    """Глобальный BFS: первая свободная позиция индекса OpenSlot."""
+    name = 'bfs'
+    simulator_class = FrontierSimulator
+
+    def claim(self, user, pending_descendants=None):
+        return _slot_target(find_open_slot(for_update=True), user)
+
+    def find_parent(self, user):
+        slot = find_open_slot()
+        if slot is None:
+            return None, None
+        return slot.parent, slot.position
+
+    def allocate_bulk(self, users_with_payments, tariffs):
+        # Места всего пакета считаются за один проход по фронтиру
+        return allocate_frontier_nodes_bulk(users_with_payments, tariffs)
+
+
+@register_placement_strategy
+class SpilloverPlacementStrategy(PlacementStrategy):
+    """Spillover: первая свободная позиция в порядке BFS внутри поддерева пригласившего."""
+    name = 'spillover'
+    simulator_class = SubtreeFrontierSimulator
+
+    def claim(self, user, pending_descendants=None):
+        return _slot_target(find_subtree_open_slot(user.invited_by_id, for_update=True), user)
+
+    def find_parent(self, user):
+        slot = find_subtree_open_slot(user.invited_by_id)
+        if slot is None:
+            return None, None
+        return slot.parent, slot.position
+
+
+@register_placement_strategy
+class BalancedLegPlacementStrategy(PlacementStrategy):
+    """
+    Balanced leg: спуск от пригласившего (или корня) в ногу с наименьшим downline,
+    пока не встретится узел со свободной позицией.
+
+    Размер ног читается из счетчиков descendant_count, поэтому на каждый уровень
+    спуска - один запрос к детям текущего узла.
+    """
+    name = 'balanced-leg'
+    simulator_class = BalancedLegSimulator
+
+    def claim(self, user, pending_descendants=None):
+        parent, position = self._descend(user, pending_descendants)
+        if parent is None:
+            return PlacementTarget(None, 1, 0, root_path(user.id), None)
+
+        slots = OpenSlot.objects.filter(parent_id=parent['user_id'], position=position)
+        slot = slots.select_for_update(skip_locked=True, of=('self',)).first()
+        if slot is None and slots.exists():
+            raise PlacementConflict(f"Позиция {position} у пользователя {parent['user_id']} захвачена параллельно")
+        if slot is not None:
+            slot.delete()
+        return PlacementTarget(
+            User.objects.get(pk=parent['user_id']),
+            position,
+            parent['level'] + 1,
+            child_path(parent['path'], position),
+            None,
+        )
+
+    def find_parent(self, user):
+        parent, position = self._descend(user)
+        if parent is None:
+            return None, None
+        return User.objects.get(pk=parent['user_id']), position
+
+    def _descend(self, user, pending_descendants=None):
+        """Найти узел со свободной позицией: (данные узла, позиция) или (None, None)."""
+        max_partners = settings.MLM_SETTINGS['MAX_PARTNERS_PER_LEVEL']
+        pending_descendants = pending_descendants or {}
+        fields = ('user_id', 'level', 'path', 'position', 'descendant_count')
+
+        current = None
+        if user.invited_by_id is not None:
+            current = StructureNode.objects.filter(user_id=user.invited_by_id).values(*fields).first()
+        if current is None:
+            current = StructureNode.objects.filter(parent=None).order_by('path', 'id').values(*fields).first()
+        if current is None:
+            return None, None
+
+        while True:
+            children = list(StructureNode.objects.filter(parent_id=current['user_id']).values(*fields))
+            used = {child['position'] for child in children}
+            for position in range(1, max_partners + 1):
+                if position not in used:
+                    return current, position
+            current = min(
+                children,
+                key=lambda child: (
+                    child['descendant_count'] + pending_descendants.get(child['path'], 0),
+                    child['position'],
+                ),
+            )
+
+
+@register_placement_strategy
+class HeapPlacementStrategy(PlacementStrategy):
+    """Heap: родитель и позиция вычисляются по порядковому номеру узла (индекс OpenSlot не ведется)."""
+    name = 'heap'
+    uses_open_slots = False
+    simulator_class = HeapSimulator
+
+    def claim(self, user, pending_descendants=None):
+        parent_user, position, level, sequence, path = allocate_heap_slot()
+        if parent_user is None:
+            path = root_path(user.id)
+        return PlacementTarget(parent_user, position, level, path, sequence)
+
+    def find_parent(self, user):
+        max_partners = settings.MLM_SETTINGS['MAX_PARTNERS_PER_LEVEL']
+        state = StructureState.objects.filter(pk=StructureState.SINGLETON_PK).first()
+        last_sequence = state.last_sequence if state else -1
+        parent_sequence, position = heap_parent_position(last_sequence + 1, max_partners)
+        if parent_sequence is None:
+            return None, None
+        parent_node = StructureNode.objects.select_related('user').filter(sequence=parent_sequence).first()
+        if parent_node is None:
+            raise ValidationError(f"Узел с порядковым номером {parent_sequence} не найден")
+        return parent_node.user, position
+
+    def allocate_bulk(self, users_with_payments, tariffs):
+        return allocate_heap_nodes_bulk(users_with_payments, tariffs)
@@ -1,123 +1,1241 @@
 """
 MLM Services - логика размещения пользователей в структуре.
 """
+import heapq
+import logging
+import random
+import time
 from collections import deque
+from contextlib import contextmanager
 from django.conf import settings
-from django.db import transaction
+from django.db import connection, transaction, IntegrityError, OperationalError
+from django.db.models import Count, Exists, F, Max, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce, Concat, Greatest, Substr
 from django.core.exceptions import ValidationError
-from .models import StructureNode, Tariff
+from .models import StructureNode, Tariff, OpenSlot, StructureState, StructureClosure, StructureEvent
 from core.models import User
 
+logger = logging.getLogger(__name__)
+
+# Базовая пауза (в секундах) между повторными попытками размещения
+PLACEMENT_RETRY_DELAY = 0.01
+
+# Размер пакета для bulk_create / bulk_update
+BULK_BATCH_SIZE = 1000
+
+# Материализованный путь: ID корня фиксированной ширины + по сегменту на позицию каждого уровня
+PATH_ROOT_WIDTH = 10
+PATH_STEP = 2
+
+# Сколько событий отдавать клиенту за раз; если изменений больше - клиенту проще перечитать дерево
+STRUCTURE_CHANGES_LIMIT = 1000
+
+# Порядок фронтира: внутри уровня пути упорядочены слева направо, т.е. в порядке BFS
+OPEN_SLOT_ORDER = ('level', 'path', 'id')
+
+
+class PlacementConflict(Exception):
+    """Свободная позиция занята параллельным размещением, попытку нужно повторить."""
+
 
 def get_active_tariff(tariff_code=None):
     """
-    Получить активный тариф.
+    Получить активный тариф.
+    
+    Args:
+        tariff_code: Код тарифа (опционально)
+    
+    Returns:
+        Tariff объект или None
+    """
+    if tariff_code:
+        try:
+            return Tariff.objects.get(code=tariff_code, is_active=True)
+        except Tariff.DoesNotExist:
+            return None
+    
+    # Возвращаем первый активный тариф по умолчанию
+    return Tariff.objects.filter(is_active=True).first()
+
+
+def root_path(user_id):
+    """Материализованный путь корневого узла: ID пользователя фиксированной ширины."""
+    return f"{user_id:0{PATH_ROOT_WIDTH}d}"
+
+
+def child_path(parent_path, position):
+    """
+    Материализованный путь узла по пути родителя и позиции.
+    
+    Пустой путь родителя (структура еще не заполнена командой
+    backfill_structure_paths) дает пустой путь - backfill заполнит его позже.
+    """
+    if not parent_path:
+        return ''
+    return f"{parent_path}{position:0{PATH_STEP}d}"
+
+
+def path_ancestors(path):
+    """
+    Пути всех предков узла (от корня к родителю).
+    
+    Args:
+        path: материализованный путь узла
+    
+    Returns:
+        list: Список путей предков
+    """
+    return [path[:end] for end in range(PATH_ROOT_WIDTH, len(path), PATH_STEP)]
+
+
+def register_open_slots(node):
+    """
+    Добавить в индекс свободные позиции только что созданного узла.
+    
+    Args:
+        node: StructureNode объект (новый, без детей)
+    
+    Returns:
+        list: Список созданных OpenSlot объектов
+    """
+    max_partners = settings.MLM_SETTINGS['MAX_PARTNERS_PER_LEVEL']
+    return OpenSlot.objects.bulk_create([
+        OpenSlot(
+            parent_id=node.user_id,
+            position=pos,
+            level=node.level + 1,
+            path=child_path(node.path, pos),
+        )
+        for pos in range(1, max_partners + 1)
+    ])
+
+
+def iter_structure_bfs(nodes):
+    """
+    Обойти структуру в ширину (в том же порядке, в котором ее заполняет размещение).
+    
+    Args:
+        nodes: итерируемое из кортежей (user_id, parent_id, level, position)
+    
+    Yields:
+        tuple: (user_id, level, path, used_positions) для каждого узла в порядке BFS
+    """
+    nodes = sorted(nodes, key=lambda row: (row[2], row[3], row[0]))
+    placed = {row[0] for row in nodes}
+    children = {}
+    roots = []
+    for user_id, parent_id, level, position in nodes:
+        if parent_id is None or parent_id not in placed:
+            roots.append((user_id, level, root_path(user_id)))
+        else:
+            children.setdefault(parent_id, []).append((user_id, level, position))
+    
+    # Корни обходим в порядке их путей, чтобы BFS совпадал с сортировкой (level, path)
+    queue = deque(sorted(roots, key=lambda root: (root[1], root[2])))
+    while queue:
+        user_id, level, path = queue.popleft()
+        node_children = children.get(user_id, [])
+        yield user_id, level, path, {position for _, _, position in node_children}
+        for child_id, child_level, position in node_children:
+            queue.append((child_id, child_level, child_path(path, position)))
+
+
+def iter_open_slots_bfs(nodes, max_partners):
+    """
+    Обойти структуру в ширину и вернуть свободные позиции в порядке BFS.
+    
+    Args:
+        nodes: итерируемое из кортежей (user_id, parent_id, level, position)
+        max_partners: максимум партнеров у одного узла
+    
+    Yields:
+        tuple: (parent_user_id, position, level, path) для каждой свободной позиции
+    """
+    for user_id, level, path, used_positions in iter_structure_bfs(nodes):
+        for pos in range(1, max_partners + 1):
+            if pos not in used_positions:
+                yield user_id, pos, level + 1, child_path(path, pos)
+
+
+@transaction.atomic
+def rebuild_open_slots(batch_size=1000):
+    """
+    Перестроить индекс свободных позиций по текущей структуре.
+    
+    Вся структура читается одним запросом, обход BFS выполняется в памяти.
+    
+    Args:
+        batch_size: размер пакета для bulk_create
+    
+    Returns:
+        int: Количество свободных позиций в индексе
+    """
+    max_partners = settings.MLM_SETTINGS['MAX_PARTNERS_PER_LEVEL']
+    nodes = StructureNode.objects.order_by('id').values_list(
+        'user_id', 'parent_id', 'level', 'position'
+    )
+    
+    OpenSlot.objects.all().delete()
+    slots = [
+        OpenSlot(parent_id=parent_id, position=position, level=level, path=path)
+        for parent_id, position, level, path in iter_open_slots_bfs(nodes.iterator(), max_partners)
+    ]
+    OpenSlot.objects.bulk_create(slots, batch_size=batch_size)
+    StructureState.objects.update_or_create(
+        pk=StructureState.SINGLETON_PK,
+        defaults={'open_slots_valid': True},
+    )
+    return len(slots)
+
+
+def prune_occupied_open_slots():
+    """
+    Удалить из индекса позиции, которые уже заняты узлами.
+    
+    Такие строки появляются, если узел создан в обход индекса (админка, режим heap):
+    размещение захватывает позицию и получает ошибку уникальности (parent, position).
+    
+    Returns:
+        int: Количество удаленных позиций
+    """
+    occupied = StructureNode.objects.filter(parent_id=OuterRef('parent_id'), position=OuterRef('position'))
+    deleted, _ = OpenSlot.objects.filter(Exists(occupied)).delete()
+    if deleted:
+        logger.warning(f"⚠️ Из индекса свободных позиций удалено {deleted} уже занятых позиций")
+    return deleted
+
+
+def _relink_subtree(user_id, old_level, old_path, new_parent_id):
+    """
+    Перенести производные данные поддерева узла под нового родителя.
+    
+    Связи внутри поддерева не меняются, поэтому пересчитываются только строки
+    замыкания к внешним предкам, уровни и пути узлов поддерева и его свободных позиций.
+    
+    Args:
+        user_id: ID пользователя верхнего узла поддерева (узел уже сохранен с новой позицией)
+        old_level: уровень узла до переноса
+        old_path: путь узла до переноса
+        new_parent_id: ID нового родителя (None или неразмещенный родитель - узел становится корнем)
+    """
+    node = StructureNode.objects.get(user_id=user_id)
+    parent = None
+    if new_parent_id is not None:
+        parent = StructureNode.objects.filter(user_id=new_parent_id).values('level', 'path').first()
+    if parent is None:
+        new_level, new_path = 0, root_path(user_id)
+    else:
+        new_level, new_path = parent['level'] + 1, child_path(parent['path'], node.position)
+    
+    subtree = StructureClosure.objects.filter(ancestor_id=user_id).values('descendant_id')
+    StructureClosure.objects.filter(descendant_id__in=Subquery(subtree)).exclude(
+        ancestor_id__in=Subquery(subtree)
+    ).delete()
+    if parent is not None:
+        table = connection.ops.quote_name(StructureClosure._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} (ancestor_id, descendant_id, depth) "
+                f"SELECT a.ancestor_id, s.descendant_id, a.depth + s.depth + 1 FROM {table} a "
+                f"JOIN {table} s ON s.ancestor_id = %s WHERE a.descendant_id = %s",
+                [user_id, new_parent_id],
+            )
+    
+    if old_path and new_path:
+        path = Concat(Value(new_path), Substr('path', len(old_path) + 1))
+    else:
+        # Пути еще не заполнены - их заполнит backfill_structure_paths
+        path = Value('')
+    delta = new_level - old_level
+    StructureNode.objects.filter(user_id__in=Subquery(subtree)).update(level=F('level') + delta, path=path)
+    OpenSlot.objects.filter(parent_id__in=Subquery(subtree)).update(level=F('level') + delta, path=path)
+
+
+def _refresh_max_descendant_depth(user_ids):
+    """Пересчитать глубину downline у узлов по таблице замыкания (индекс по ancestor, depth)."""
+    deepest = StructureClosure.objects.filter(ancestor_id=OuterRef('user_id')).order_by('-depth').values('depth')[:1]
+    StructureNode.objects.filter(user_id__in=user_ids).update(max_descendant_depth=Coalesce(Subquery(deepest), 0))
+
+
+def _free_position(parent_id, position, level, path):
+    """Вернуть в индекс позицию, освобожденную узлом (если родитель размещен, а позиция свободна)."""
+    if parent_id is None or not StructureNode.objects.filter(user_id=parent_id).exists():
+        return
+    if StructureNode.objects.filter(parent_id=parent_id, position=position).exists():
+        return
+    OpenSlot.objects.get_or_create(parent_id=parent_id, position=position, defaults={'level': level, 'path': path})
+
+
+@transaction.atomic
+def repair_node_edit(before, node):
+    """
+    Обновить производные данные после ручной правки узла в админке: пути,
+    таблицу замыкания, индекс свободных позиций и счетчики downline.
+    
+    Пересчитывается только затронутое поддерево и счетчики его старых и новых
+    предков. Поддерево удаленного узла становится отдельными корнями - так же,
+    как его строят rebuild_open_slots и backfill_structure_paths.
+    
+    Args:
+        before: StructureNode в состоянии до правки (None - узел добавлен)
+        node: сохраненный StructureNode (None - узел удален)
+    
+    """
+    moved = before is None or node is None or (node.parent_id, node.position) != (before.parent_id, before.position)
+    if before is None:
+        parent = StructureNode.objects.filter(user_id=node.parent_id).values('level', 'path').first()
+        if parent is None:
+            node.level, node.path = 0, root_path(node.user_id)
+        else:
+            node.level, node.path = parent['level'] + 1, child_path(parent['path'], node.position)
+        node.save(update_fields=['level', 'path'])
+        OpenSlot.objects.filter(parent_id=node.parent_id, position=node.position).delete()
+        register_open_slots(node)
+        record_closure(node)
+        update_ancestor_counters(node)
+    elif moved:
+        old_ancestor_ids = list(
+            StructureClosure.objects.filter(descendant_id=before.user_id, depth__gt=0).values_list('ancestor_id', flat=True)
+        )
+        size = StructureClosure.objects.filter(ancestor_id=before.user_id).count()
+        
+        if node is None:
+            children = StructureNode.objects.filter(parent_id=before.user_id).values_list('user_id', 'level', 'path')
+            for child_id, child_level, child_path_value in list(children):
+                _relink_subtree(child_id, child_level, child_path_value, None)
+            StructureClosure.objects.filter(Q(descendant_id=before.user_id) | Q(ancestor_id=before.user_id)).delete()
+            OpenSlot.objects.filter(parent_id=before.user_id).delete()
+            new_ancestor_ids = []
+        else:
+            OpenSlot.objects.filter(parent_id=node.parent_id, position=node.position).delete()
+            _relink_subtree(node.user_id, before.level, before.path, node.parent_id)
+            new_ancestor_ids = list(
+                StructureClosure.objects.filter(descendant_id=node.user_id, depth__gt=0).values_list('ancestor_id', flat=True)
+            )
+        _free_position(before.parent_id, before.position, before.level, before.path)
+        
+        StructureNode.objects.filter(user_id__in=old_ancestor_ids).update(descendant_count=F('descendant_count') - size)
+        StructureNode.objects.filter(user_id__in=new_ancestor_ids).update(descendant_count=F('descendant_count') + size)
+        _refresh_max_descendant_depth(set(old_ancestor_ids) | set(new_ancestor_ids))
+    
+    if moved:
+        # Ручная правка нарушает нумерацию узлов режима heap
+        StructureState.objects.filter(pk=StructureState.SINGLETON_PK).update(sequence_valid=False)
+    log_structure_change(resync=True)
+
+
+def backfill_structure_paths(batch_size=1000, progress=None):
+    """
+    Заполнить материализованные пути у узлов и свободных позиций, где они пусты.
+    
+    Узлы обрабатываются по уровням пакетами по batch_size, каждый пакет - в своей
+    транзакции. Прерванный запуск можно просто повторить: обработанные строки
+    уже имеют путь и повторно не выбираются.
+    
+    Args:
+        batch_size: размер пакета
+        progress: необязательная функция progress(model_name, processed) для отчета
+    
+    Returns:
+        tuple: (заполнено узлов, заполнено свободных позиций)
+    """
+    nodes_done = 0
+    empty_nodes = StructureNode.objects.filter(path='')
+    while True:
+        level = empty_nodes.order_by('level').values_list('level', flat=True).first()
+        if level is None:
+            break
+        while True:
+            with transaction.atomic():
+                batch = list(
+                    empty_nodes.filter(level=level).order_by('id').values_list('id', 'user_id', 'parent_id', 'position')[:batch_size]
+                )
+                if not batch:
+                    break
+                parent_paths = dict(
+                    StructureNode.objects.filter(user_id__in={row[2] for row in batch if row[2]})
+                    .values_list('user_id', 'path')
+                )
+                updates = []
+                for node_id, user_id, parent_id, position in batch:
+                    if parent_id is None or parent_id not in parent_paths:
+                        path = root_path(user_id)
+                    else:
+                        path = child_path(parent_paths[parent_id], position)
+                    if not path:
+                        # Родитель без пути (нарушена согласованность level) - корень пути от самого узла
+                        path = root_path(user_id)
+                    updates.append(StructureNode(id=node_id, path=path))
+                StructureNode.objects.bulk_update(updates, ['path'])
+            nodes_done += len(updates)
+            if progress:
+                progress('StructureNode', nodes_done)
+    
+    slots_done = 0
+    orphan_slots = 0
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                OpenSlot.objects.filter(path='', id__gt=last_id)
+                .order_by('id').values_list('id', 'parent_id', 'position')[:batch_size]
+            )
+            if not batch:
+                break
+            parent_paths = dict(
+                StructureNode.objects.filter(user_id__in={row[1] for row in batch}).values_list('user_id', 'path')
+            )
+            OpenSlot.objects.bulk_update(
+                [
+                    OpenSlot(id=slot_id, path=child_path(parent_paths[parent_id], position))
+                    for slot_id, parent_id, position in batch
+                    if parent_id in parent_paths
+                ],
+                ['path'],
+            )
+        orphan_slots += sum(1 for _, parent_id, _ in batch if parent_id not in parent_paths)
+        last_id = batch[-1][0]
+        slots_done += len(batch)
+        if progress:
+            progress('OpenSlot', slots_done)
+    
+    if orphan_slots:
+        logger.warning(
+            f"⚠️ В индексе свободных позиций {orphan_slots} позиций без узла-родителя: выполните rebuild_open_slots"
+        )
+    
+    return nodes_done, slots_done
+
+
+def get_downline(node, max_depth=None):
+    """
+    Получить все узлы поддерева одним запросом по материализованному пути.
+    
+    Args:
+        node: StructureNode объект (корень поддерева)
+        max_depth: Максимальная глубина относительно node (если None - без ограничений)
+    
+    Returns:
+        QuerySet: Узлы поддерева без самого node в порядке (level, path), то есть в порядке BFS
+    """
+    queryset = StructureNode.objects.filter(path__startswith=node.path, level__gt=node.level)
+    if max_depth is not None:
+        queryset = queryset.filter(level__lte=node.level + max_depth)
+    return queryset.order_by('level', 'path')
+
+
+def record_closure(node):
+    """
+    Добавить строки таблицы замыкания для только что созданного узла.
+    
+    Одна вставка INSERT ... SELECT: строки предков родителя с глубиной + 1
+    и строка самого узла с глубиной 0.
+    
+    Args:
+        node: StructureNode объект (новый, без детей)
+    """
+    table = connection.ops.quote_name(StructureClosure._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} (ancestor_id, descendant_id, depth) "
+            f"SELECT ancestor_id, %s, depth + 1 FROM {table} WHERE descendant_id = %s "
+            f"UNION ALL SELECT %s, %s, 0",
+            [node.user_id, node.parent_id, node.user_id, node.user_id],
+        )
+
+
+def build_closure_rows(nodes):
+    """
+    Построить строки таблицы замыкания для пакета новых узлов.
+    
+    Предки родителей, размещенных раньше, читаются одним запросом,
+    для родителей из этого же пакета строки собираются в памяти.
+    
+    Args:
+        nodes: список StructureNode (родитель в списке идет раньше потомка)
+    
+    Returns:
+        list: Несохраненные StructureClosure объекты
+    """
+    batch_user_ids = {node.user_id for node in nodes}
+    ancestors = {}
+    for descendant_id, ancestor_id, depth in StructureClosure.objects.filter(
+        descendant_id__in={node.parent_id for node in nodes if node.parent_id not in batch_user_ids}
+    ).values_list('descendant_id', 'ancestor_id', 'depth'):
+        ancestors.setdefault(descendant_id, []).append((ancestor_id, depth))
+    
+    rows = []
+    for node in nodes:
+        node_ancestors = [(node.user_id, 0)] + [
+            (ancestor_id, depth + 1) for ancestor_id, depth in ancestors.get(node.parent_id, [])
+        ]
+        ancestors[node.user_id] = node_ancestors
+        rows.extend(
+            StructureClosure(ancestor_id=ancestor_id, descendant_id=node.user_id, depth=depth)
+            for ancestor_id, depth in node_ancestors
+        )
+    return rows
+
+
+def backfill_structure_closure(rebuild=False, progress=None):
+    """
+    Заполнить таблицу замыкания для узлов, у которых ее строк еще нет.
+    
+    Обработка идет по уровням, по два INSERT ... SELECT на уровень, каждый
+    уровень - в своей транзакции. Прерванный запуск можно повторить.
+    
+    Args:
+        rebuild: сначала удалить всю таблицу и построить ее заново
+        progress: необязательная функция progress(level, inserted) для отчета
+    
+    Returns:
+        int: Количество добавленных строк
+    """
+    if rebuild:
+        StructureClosure.objects.all().delete()
+    
+    closure = connection.ops.quote_name(StructureClosure._meta.db_table)
+    nodes = connection.ops.quote_name(StructureNode._meta.db_table)
+    not_processed = (
+        f"NOT EXISTS (SELECT 1 FROM {closure} s WHERE s.ancestor_id = n.user_id AND s.descendant_id = n.user_id)"
+    )
+    inserted = 0
+    levels = StructureNode.objects.order_by('level').values_list('level', flat=True).distinct()
+    for level in list(levels):
+        with transaction.atomic(), connection.cursor() as cursor:
+            # Сначала предки (через строки родителя), затем строка самого узла - она отмечает узел обработанным
+            cursor.execute(
+                f"INSERT INTO {closure} (ancestor_id, descendant_id, depth) "
+                f"SELECT c.ancestor_id, n.user_id, c.depth + 1 FROM {nodes} n "
+                f"JOIN {closure} c ON c.descendant_id = n.parent_id "
+                f"WHERE n.level = %s AND {not_processed}",
+                [level],
+            )
+            level_inserted = cursor.rowcount
+            cursor.execute(
+                f"INSERT INTO {closure} (ancestor_id, descendant_id, depth) "
+                f"SELECT n.user_id, n.user_id, 0 FROM {nodes} n WHERE n.level = %s AND {not_processed}",
+                [level],
+            )
+            level_inserted += cursor.rowcount
+        inserted += level_inserted
+        if progress:
+            progress(level, level_inserted)
+    return inserted
+
+
+def get_upline(user, max_depth=None):
+    """
+    Получить вышестоящих (цепочку родителей до корня) одним запросом.
+    
+    Args:
+        user: User объект
+        max_depth: сколько уровней вверх (если None - до корня)
+    
+    Returns:
+        QuerySet: StructureNode предков, от ближайшего к корню, с аннотацией depth
+    """
+    # Все условия на связь задаются одним filter(), иначе Django добавит отдельный JOIN
+    conditions = {'user__closure_descendants__descendant': user, 'user__closure_descendants__depth__gt': 0}
+    if max_depth is not None:
+        conditions['user__closure_descendants__depth__lte'] = max_depth
+    return StructureNode.objects.filter(**conditions).annotate(depth=F('user__closure_descendants__depth')).order_by('depth')
+
+
+def get_uplines(user_ids, max_depth):
+    """
+    Получить вышестоящих нескольких пользователей одним запросом по таблице замыкания.
+    
+    Args:
+        user_ids: ID пользователей (узлы и их строки замыкания уже записаны)
+        max_depth: сколько уровней вверх
+    
+    Returns:
+        dict: {user_id: [(ancestor_id, depth), ...]} от ближайшего к корню
+    """
+    uplines = {user_id: [] for user_id in user_ids}
+    rows = (
+        StructureClosure.objects
+        .filter(descendant_id__in=uplines, depth__gt=0, depth__lte=max_depth)
+        .order_by('descendant_id', 'depth')
+        .values_list('descendant_id', 'ancestor_id', 'depth')
+    )
+    for descendant_id, ancestor_id, depth in rows:
+        uplines[descendant_id].append((ancestor_id, depth))
+    return uplines
+
+
+def get_descendants(user, max_depth=None):
+    """
+    Получить нижестоящих узла одним запросом по таблице замыкания.
+    
+    Args:
+        user: User объект
+        max_depth: сколько уровней вниз (если None - без ограничений)
+    
+    Returns:
+        QuerySet: StructureNode потомков с аннотацией depth, в порядке (depth, path)
+    """
+    # Все условия на связь задаются одним filter(), иначе Django добавит отдельный JOIN
+    conditions = {'user__closure_ancestors__ancestor': user, 'user__closure_ancestors__depth__gt': 0}
+    if max_depth is not None:
+        conditions['user__closure_ancestors__depth__lte'] = max_depth
+    return StructureNode.objects.filter(**conditions).annotate(depth=F('user__closure_ancestors__depth')).order_by('depth', 'path')
+
+
+def lock_ancestors(queryset):
+    """
+    Заблокировать строки предков снизу вверх (SELECT ... FOR UPDATE по убыванию уровня).
+    
+    Общие предки параллельных размещений - одна цепочка до корня, поэтому
+    в таком порядке они блокируются одинаково и взаимных блокировок нет,
+    а корень, общий для всех, блокируется последним.
+    """
+    return list(queryset.select_for_update().order_by('-level').values_list('pk', flat=True))
+
+
+def update_ancestor_counters(node):
+    """
+    Обновить счетчики downline у всех предков нового узла одним UPDATE.
+    
+    Предки выбираются подзапросом к таблице замыкания (record_closure
+    должна быть уже вызвана).
+    
+    Args:
+        node: StructureNode объект (новый, без детей)
+    
+    Returns:
+        int: Количество обновленных предков
+    """
+    ancestor_ids = StructureClosure.objects.filter(
+        descendant_id=node.user_id, depth__gt=0
+    ).values('ancestor_id')
+    ancestors = StructureNode.objects.filter(user_id__in=Subquery(ancestor_ids))
+    lock_ancestors(ancestors)
+    return ancestors.update(
+        descendant_count=F('descendant_count') + 1,
+        max_descendant_depth=Greatest(F('max_descendant_depth'), Value(node.level) - F('level')),
+    )
+
+
+def apply_ancestor_counters_bulk(closure_rows):
+    """
+    Обновить счетчики downline для пакета новых узлов.
+    
+    Предки группируются по одинаковому приращению, поэтому выполняется
+    по одному UPDATE на группу, а не на каждого предка.
+    
+    Args:
+        closure_rows: строки build_closure_rows для новых узлов
+    """
+    increments = {}
+    for row in closure_rows:
+        if row.depth == 0:
+            continue
+        count, depth = increments.get(row.ancestor_id, (0, 0))
+        increments[row.ancestor_id] = (count + 1, max(depth, row.depth))
+    
+    # Предки блокируются снизу вверх (см. lock_ancestors) до обновлений по группам
+    levels = {}
+    ancestor_ids = list(increments)
+    for start in range(0, len(ancestor_ids), BULK_BATCH_SIZE):
+        levels.update(
+            StructureNode.objects.filter(user_id__in=ancestor_ids[start:start + BULK_BATCH_SIZE])
+            .values_list('user_id', 'level')
+        )
+    ancestor_ids.sort(key=lambda ancestor_id: -levels.get(ancestor_id, 0))
+    for start in range(0, len(ancestor_ids), BULK_BATCH_SIZE):
+        lock_ancestors(StructureNode.objects.filter(user_id__in=ancestor_ids[start:start + BULK_BATCH_SIZE]))
+    
+    groups = {}
+    for ancestor_id, increment in increments.items():
+        groups.setdefault(increment, []).append(ancestor_id)
+    
+    for (count, depth), ancestor_ids in groups.items():
+        for start in range(0, len(ancestor_ids), BULK_BATCH_SIZE):
+            StructureNode.objects.filter(user_id__in=ancestor_ids[start:start + BULK_BATCH_SIZE]).update(
+                descendant_count=F('descendant_count') + count,
+                max_descendant_depth=Greatest(F('max_descendant_depth'), Value(depth)),
+            )
+
+
+def rebuild_downline_counters(batch_size=1000, progress=None):
+    """
+    Пересчитать счетчики downline по таблице замыкания.
+    
+    Узлы обновляются диапазонами id, каждый диапазон - одним UPDATE с подзапросами.
+    
+    Args:
+        batch_size: количество узлов в одном UPDATE
+        progress: необязательная функция progress(processed) для отчета
+    
+    Returns:
+        int: Количество пересчитанных узлов
+    """
+    descendants = StructureClosure.objects.filter(
+        ancestor_id=OuterRef('user_id'), depth__gt=0
+    ).order_by().values('ancestor_id')
+    processed = 0
+    last_id = 0
+    while True:
+        ids = list(
+            StructureNode.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            break
+        with transaction.atomic():
+            StructureNode.objects.filter(id__gte=ids[0], id__lte=ids[-1]).update(
+                descendant_count=Coalesce(Subquery(descendants.annotate(total=Count('id')).values('total')), 0),
+                max_descendant_depth=Coalesce(Subquery(descendants.annotate(depth=Max('depth')).values('depth')), 0),
+            )
+        processed += len(ids)
+        last_id = ids[-1]
+        if progress:
+            progress(processed)
+    return processed
+
+
+def downline_counters_stale():
+    """Есть узлы с детьми, у которых счетчик downline равен нулю (счетчики не заполнены)."""
+    return StructureNode.objects.filter(
+        descendant_count=0,
+        user__children_nodes__isnull=False,
+    ).exists()
+
+
+def get_downline_level_counts(user):
+    """
+    Количество нижестоящих на каждом уровне относительно пользователя (один запрос).
+    
+    Args:
+        user: User объект
+    
+    Returns:
+        dict: {относительный уровень: количество}, уровни от 1
+    """
+    return dict(
+        StructureClosure.objects.filter(ancestor=user, depth__gt=0)
+        .values('depth').annotate(total=Count('id')).order_by('depth').values_list('depth', 'total')
+    )
+
+
+def get_downline_sizes(user_ids=None):
+    """
+    Размер downline (количество всех нижестоящих) одним агрегирующим запросом.
+    
+    Args:
+        user_ids: ограничить список пользователей (если None - по всем)
+    
+    Returns:
+        dict: {user_id: количество нижестоящих}; пользователи без нижестоящих не попадают
+    """
+    queryset = StructureClosure.objects.filter(depth__gt=0)
+    if user_ids is not None:
+        queryset = queryset.filter(ancestor_id__in=user_ids)
+    return dict(queryset.values('ancestor_id').annotate(total=Count('id')).values_list('ancestor_id', 'total'))
+
+
+def log_structure_change(nodes=(), resync=False):
+    """
+    Записать изменения структуры в журнал.
+    
+    События записываются в транзакции, изменившей структуру, без версии: версию
+    им присваивает publish_structure_changes после commit. Поэтому размещения
+    не держат общую строку версии до конца своей транзакции.
+    
+    Args:
+        nodes: новые узлы (по событию NODE_CREATED на каждый)
+        resync: структура изменена не размещением (вручную) - клиентам нужно перечитать дерево
+    """
+    events = [
+        StructureEvent(
+            event_type=StructureEvent.EventType.NODE_CREATED,
+            user_id=node.user_id,
+            parent_id=node.parent_id,
+            position=node.position,
+            level=node.level,
+            tariff_id=node.tariff_id,
+        )
+        for node in nodes
+    ]
+    if resync:
+        events.append(StructureEvent(event_type=StructureEvent.EventType.RESYNC))
+    if not events:
+        return
+    StructureEvent.objects.bulk_create(events, batch_size=BULK_BATCH_SIZE)
+    transaction.on_commit(publish_structure_changes)
+
+
+def publish_structure_changes():
+    """
+    Присвоить новую версию структуры закоммиченным событиям журнала без версии.
+    
+    Вызывается после commit транзакции, изменившей структуру. Строка версии
+    блокируется только на время этой короткой транзакции, поэтому версии идут
+    в порядке commit: все изменения версии не выше прочитанной уже видны.
+    События, чья публикация не состоялась (процесс упал после commit),
+    получат версию при следующем вызове.
+    
+    Returns:
+        int: Текущая версия структуры
+    """
+    pending = StructureEvent.objects.filter(version=None)
+    if not pending.exists():
+        return get_structure_version()
+    with transaction.atomic():
+        state, _ = StructureState.objects.select_for_update().get_or_create(pk=StructureState.SINGLETON_PK)
+        # События могла опубликовать параллельная транзакция, пока мы ждали блокировку
+        if pending.update(version=state.version + 1):
+            state.version += 1
+            state.save(update_fields=['version'])
+        return state.version
+
+
+def structure_changes_pending():
+    """Есть закоммиченные изменения структуры, которым еще не присвоена версия."""
+    return StructureEvent.objects.filter(version=None).exists()
+
+
+def get_structure_changes(since, limit=STRUCTURE_CHANGES_LIMIT):
+    """
+    Изменения структуры после версии since.
+    
+    Флаг resync означает, что дельты недостаточно и дерево нужно перечитать:
+    клиент отстал больше, чем хранит журнал, изменений больше limit,
+    структура менялась вручную или версия клиента из будущего.
+    
+    Args:
+        since: версия, которая уже есть у клиента
+        limit: максимум событий в ответе
+    
+    Returns:
+        dict: {'version', 'since', 'resync', 'events'}
+    """
+    version = get_structure_version()
+    result = {'version': version, 'since': since, 'resync': False, 'events': []}
+    if since == version:
+        return result
+    
+    oldest = StructureEvent.objects.exclude(version=None).order_by('version').values_list('version', flat=True).first()
+    if since > version or oldest is None or since < oldest - 1:
+        result['resync'] = True
+        return result
+    
+    events = list(
+        StructureEvent.objects.filter(version__gt=since, version__lte=version)
+        .select_related('user', 'tariff')
+        .order_by('version', 'id')[:limit + 1]
+    )
+    if len(events) > limit or any(event.event_type == StructureEvent.EventType.RESYNC for event in events):
+        result['resync'] = True
+        return result
+    
+    result['events'] = [
+        {
+            'version': event.version,
+            'type': event.event_type,
+            'user': {
+                'id': event.user.id,
+                'username': event.user.username,
+                'referral_code': event.user.referral_code,
+            },
+            'parent_id': event.parent_id,
+            'level': event.level,
+            'position': event.position,
+            'tariff': {
+                'code': event.tariff.code,
+                'name': event.tariff.name,
+            } if event.tariff else None,
+        }
+        for event in events
+    ]
+    return result
+
+
+def prune_structure_events(keep_versions):
+    """
+    Удалить старые события журнала, оставив последние keep_versions версий.
+    
+    Клиенты с более старой версией получат resync.
+    
+    Args:
+        keep_versions: сколько последних версий хранить
+    
+    Returns:
+        int: Количество удаленных событий
+    """
+    deleted, _ = StructureEvent.objects.filter(version__lte=get_structure_version() - keep_versions).delete()
+    return deleted
+
+
+def get_structure_version():
+    """Текущая версия структуры (0, если структура еще не менялась)."""
+    return StructureState.objects.filter(pk=StructureState.SINGLETON_PK).values_list('version', flat=True).first() or 0
+
+
+@contextmanager
+def structure_snapshot():
+    """
+    Транзакция с единым снимком структуры: версия и дерево, прочитанные внутри,
+    согласованы между собой (размещение не может закоммититься между ними).
+    
+    На PostgreSQL транзакция открывается с уровнем REPEATABLE READ - все запросы
+    видят данные на момент первого из них. На SQLite открытая транзакция
+    не дает писателям закоммитить изменения до ее завершения.
+    Внутри уже открытой транзакции уровень изоляции не меняется.
+    """
+    outermost = not connection.in_atomic_block
+    with transaction.atomic():
+        if outermost and connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        yield
+
+
+def find_open_slot(for_update=False):
+    """
+    Найти первую свободную позицию в порядке BFS.
+    
+    Если узлы в структуре есть, а индекс пуст (например, узлы создавались
+    в обход place_user), индекс перестраивается.
+    
+    Args:
+        for_update: заблокировать строку позиции (SELECT ... FOR UPDATE SKIP LOCKED).
+            Позиции, уже захваченные параллельными размещениями, пропускаются.
+            Должен вызываться внутри транзакции.
+    
+    Returns:
+        OpenSlot объект или None, если структура пуста
+    
+    Raises:
+        PlacementConflict: если все свободные позиции заняты параллельными размещениями
+    """
+    queryset = OpenSlot.objects.select_related('parent').order_by(*OPEN_SLOT_ORDER)
+    if for_update:
+        # Блокируем только строку позиции: строка родителя должна оставаться доступной другим воркерам
+        queryset = queryset.select_for_update(skip_locked=True, of=('self',))
+    
+    slot = queryset.first()
+    if slot is None:
+        if for_update and OpenSlot.objects.exists():
+            raise PlacementConflict("Все свободные позиции захвачены параллельными размещениями")
+        if StructureNode.objects.exists():
+            rebuild_open_slots()
+            slot = queryset.first()
+    return slot
+
+
+def find_subtree_open_slot(inviter_id, for_update=False):
+    """
+    Найти первую свободную позицию в порядке BFS внутри поддерева пригласившего (spillover).
+    
+    Поиск идет по уровням поддерева: на каждом уровне - один индексный запрос
+    по (level, path) в диапазоне путей поддерева, то есть не больше запросов,
+    чем уровней в структуре. Если пригласивший не размещен (или пути еще не
+    заполнены), используется общий фронтир find_open_slot.
+    
+    Args:
+        inviter_id: ID пригласившего пользователя (может быть None)
+        for_update: заблокировать строку позиции (SELECT ... FOR UPDATE SKIP LOCKED)
+    
+    Returns:
+        OpenSlot объект или None, если структура пуста
+    
+    Raises:
+        PlacementConflict: если все свободные позиции поддерева захвачены параллельными размещениями
+    """
+    inviter_node = None
+    if inviter_id is not None:
+        inviter_node = StructureNode.objects.filter(user_id=inviter_id).values('level', 'path').first()
+    if not inviter_node or not inviter_node['path']:
+        return find_open_slot(for_update=for_update)
+    
+    prefix = inviter_node['path']
+    # Пути состоят из цифр, поэтому все пути поддерева лежат в диапазоне (prefix, prefix + ':')
+    subtree_slots = OpenSlot.objects.filter(path__gt=prefix, path__lt=prefix + ':')
+    queryset = subtree_slots.select_related('parent')
+    if for_update:
+        queryset = queryset.select_for_update(skip_locked=True, of=('self',))
+    
+    max_level = OpenSlot.objects.aggregate(max_level=Max('level'))['max_level']
+    if max_level is None:
+        return find_open_slot(for_update=for_update)
+    
+    for level in range(inviter_node['level'] + 1, max_level + 1):
+        slot = queryset.filter(level=level).order_by('path').first()
+        if slot is not None:
+            return slot
+    
+    if for_update and subtree_slots.exists():
+        raise PlacementConflict("Все свободные позиции поддерева захвачены параллельными размещениями")
+    # Свободных позиций в поддереве нет (индекс рассинхронизирован) - общий фронтир
+    return find_open_slot(for_update=for_update)
+
+
+def find_parent_for_new_partner(user, strategy=None):
+    """
+    Найти родителя для размещения нового партнера.
+    
+    Место выбирает стратегия размещения (см. mlm.placement): по умолчанию
+    первая свободная позиция индекса OpenSlot в порядке обхода в ширину (BFS).
+    Ничего не блокирует и не изменяет.
     
     Args:
-        tariff_code: Код тарифа (опционально)
+        user: User объект для размещения
+        strategy: имя стратегии (по умолчанию MLM_SETTINGS['PLACEMENT_STRATEGY'])
     
     Returns:
-        Tariff объект или None
+        tuple: (parent_user, position) или (None, None) если не найдено
     """
-    if tariff_code:
+    from .placement import get_placement_strategy
+    
+    return get_placement_strategy(strategy).find_parent(user)
+
+
+def heap_parent_position(sequence, max_partners):
+    """
+    Вычислить родителя и позицию узла в полном k-арном дереве по его номеру.
+    
+    Args:
+        sequence: порядковый номер узла (корень - 0)
+        max_partners: ширина дерева (MAX_PARTNERS_PER_LEVEL)
+    
+    Returns:
+        tuple: (parent_sequence, position) или (None, 1) для корня
+    """
+    if sequence == 0:
+        return None, 1
+    return (sequence - 1) // max_partners, (sequence - 1) % max_partners + 1
+
+
+def allocate_heap_slot():
+    """
+    Выделить место в режиме PLACEMENT_STRATEGY='heap'.
+    
+    Вместо поиска свободной позиции увеличивается счетчик StructureState,
+    а родитель и позиция вычисляются арифметически по номеру узла.
+    Должна вызываться внутри транзакции: строка счетчика блокируется до commit.
+    
+    Returns:
+        tuple: (parent_user, position, level, sequence, path)
+    
+    Raises:
+        ValidationError: если существующая структура не пронумерована
+    """
+    max_partners = settings.MLM_SETTINGS['MAX_PARTNERS_PER_LEVEL']
+    state, _ = StructureState.objects.select_for_update().get_or_create(pk=StructureState.SINGLETON_PK)
+    sequence = state.last_sequence + 1
+    
+    if sequence == 0 and StructureNode.objects.exists():
+        raise ValidationError(
+            "Структура не пронумерована для режима heap. Выполните: python manage.py number_structure"
+        )
+    
+    parent_sequence, position = heap_parent_position(sequence, max_partners)
+    if parent_sequence is None:
+        parent_user, level, path = None, 0, None
+    else:
         try:
-            return Tariff.objects.get(code=tariff_code, is_active=True)
-        except Tariff.DoesNotExist:
-            return None
+            parent_node = StructureNode.objects.select_related('user').get(sequence=parent_sequence)
+        except StructureNode.DoesNotExist:
+            raise ValidationError(f"Узел с порядковым номером {parent_sequence} не найден")
+        parent_user, level = parent_node.user, parent_node.level + 1
+        path = child_path(parent_node.path, position)
     
-    # Возвращаем первый активный тариф по умолчанию
-    return Tariff.objects.filter(is_active=True).first()
+    state.last_sequence = sequence
+    state.save(update_fields=['last_sequence'])
+    return parent_user, position, level, sequence, path
 
 
-def find_parent_for_new_partner(user):
+@transaction.atomic
+def number_structure(batch_size=1000):
     """
-    Найти родителя для размещения нового партнера используя BFS.
+    Пронумеровать существующую структуру в порядке BFS (backfill для режима heap).
     
-    Алгоритм:
-    1. Начинаем с корня структуры (Level 0)
-    2. Используем BFS (обход в ширину)
-    3. Ищем первого пользователя с менее чем MAX_PARTNERS_PER_LEVEL партнерами
-    4. Возвращаем найденного родителя и свободную позицию
+    Args:
+        batch_size: размер пакета для bulk_update
+    
+    Returns:
+        int: Количество пронумерованных узлов
+    """
+    rows = StructureNode.objects.values_list('user_id', 'parent_id', 'level', 'position')
+    order = [user_id for user_id, _, _, _ in iter_structure_bfs(rows.iterator())]
+    node_ids = dict(StructureNode.objects.values_list('user_id', 'id'))
+    
+    # Сначала сбрасываем номера, чтобы не нарушить уникальность при перенумерации
+    StructureNode.objects.exclude(sequence=None).update(sequence=None)
+    StructureNode.objects.bulk_update(
+        [StructureNode(id=node_ids[user_id], sequence=sequence) for sequence, user_id in enumerate(order)],
+        ['sequence'],
+        batch_size=batch_size,
+    )
+    StructureState.objects.update_or_create(
+        pk=StructureState.SINGLETON_PK,
+        defaults={'last_sequence': len(order) - 1},
+    )
+    # Режим heap применим, только если нумерация в порядке BFS совпадает с полем parent
+    mismatches, _ = check_heap_consistency(limit=0)
+    StructureState.objects.filter(pk=StructureState.SINGLETON_PK).update(sequence_valid=not mismatches)
+    return len(order)
+
+
+def check_heap_consistency(limit=20):
+    """
+    Проверить, что родитель, вычисленный по номеру узла, совпадает с полем parent.
     
     Args:
-        user: User объект для размещения
+        limit: сколько расхождений вернуть для отчета
     
     Returns:
-        tuple: (parent_user, position) или (None, None) если не найдено
+        tuple: (количество расхождений, список первых расхождений)
     """
     max_partners = settings.MLM_SETTINGS['MAX_PARTNERS_PER_LEVEL']
+    rows = StructureNode.objects.exclude(sequence=None).values_list(
+        'sequence', 'user_id', 'parent_id', 'position'
+    )
+    user_by_sequence = {}
+    nodes = []
+    for sequence, user_id, parent_id, position in rows.iterator():
+        user_by_sequence[sequence] = user_id
+        nodes.append((sequence, user_id, parent_id, position))
     
-    # Если это первый пользователь - он становится корнем
-    if not StructureNode.objects.exists():
-        return None, None  # Корень не имеет parent
-    
-    # Находим корневой узел (Level 0, parent=None)
-    root_nodes = StructureNode.objects.filter(level=0).select_related('user')
+    mismatches = []
+    total = 0
+    for sequence, user_id, parent_id, position in nodes:
+        parent_sequence, expected_position = heap_parent_position(sequence, max_partners)
+        expected_parent = user_by_sequence.get(parent_sequence) if parent_sequence is not None else None
+        if expected_parent != parent_id or expected_position != position:
+            total += 1
+            if len(mismatches) < limit:
+                mismatches.append({
+                    'sequence': sequence,
+                    'user_id': user_id,
+                    'parent_id': parent_id,
+                    'expected_parent_id': expected_parent,
+                    'position': position,
+                    'expected_position': expected_position,
+                })
     
-    if not root_nodes.exists():
-        # Если нет корня, но есть узлы - берем первого пользователя
-        first_node = StructureNode.objects.select_related('user').first()
-        if first_node:
-            return first_node.user, 1
+    unnumbered = StructureNode.objects.filter(sequence=None).count()
+    if unnumbered:
+        total += unnumbered
+        if len(mismatches) < limit:
+            mismatches.append({'unnumbered_nodes': unnumbered})
     
-    # BFS: очередь для обхода
-    queue = deque()
+    return total, mismatches
+
+
+# Стратегии, для которых в этом процессе уже проверены индексы размещения
+_checked_placement_strategies = set()
+
+
+def check_placement_indexes(strategy):
+    """
+    Проверить, что индекс, по которому размещает стратегия, соответствует структуре.
     
-    # Добавляем все корневые узлы в очередь
-    for root_node in root_nodes:
-        queue.append(root_node.user)
+    Стратегии по индексу свободных позиций (bfs, spillover, balanced-leg) не нумеруют
+    узлы, а heap не ведет индекс OpenSlot, поэтому смена PLACEMENT_STRATEGY на живой
+    структуре без перестроения индекса отправляла бы размещения на занятые позиции.
+    Первое размещение стратегии в процессе проверяет флаги StructureState и отмечает
+    второй индекс устаревшим; дальше проверка не выполняется.
     
-    # Множество посещенных пользователей (для избежания циклов)
-    visited = set()
+    Args:
+        strategy: PlacementStrategy объект
     
-    while queue:
-        current_user = queue.popleft()
-        
-        if current_user.id in visited:
-            continue
-        
-        visited.add(current_user.id)
-        
-        # Получаем узел текущего пользователя
-        try:
-            current_node = StructureNode.objects.get(user=current_user)
-        except StructureNode.DoesNotExist:
-            continue
-        
-        # Проверяем количество партнеров у текущего пользователя
-        children_count = StructureNode.objects.filter(parent=current_user).count()
-        
-        if children_count < max_partners:
-            # Нашли свободное место!
-            # Определяем свободную позицию (1, 2 или 3)
-            existing_positions = set(
-                StructureNode.objects.filter(parent=current_user)
-                .values_list('position', flat=True)
+    Raises:
+        ValidationError: если индекс стратегии устарел (нужна rebuild_open_slots или number_structure)
+    """
+    if strategy.name in _checked_placement_strategies:
+        return
+    state, _ = StructureState.objects.get_or_create(pk=StructureState.SINGLETON_PK)
+    if strategy.uses_open_slots:
+        if not state.open_slots_valid:
+            raise ValidationError(
+                f"Индекс свободных позиций устарел (структура заполнялась в режиме heap), "
+                f"стратегия {strategy.name} недоступна. Выполните: python manage.py rebuild_open_slots"
             )
-            
-            # Находим первую свободную позицию
-            for pos in range(1, max_partners + 1):
-                if pos not in existing_positions:
-                    return current_user, pos
-        
-        # Если место не найдено, добавляем детей в очередь для дальнейшего поиска
-        children = StructureNode.objects.filter(parent=current_user).select_related('user')
-        for child_node in children:
-            if child_node.user.id not in visited:
-                queue.append(child_node.user)
+        stale_field = 'sequence_valid'
+    else:
+        if not state.sequence_valid:
+            raise ValidationError(
+                f"Нумерация узлов устарела (структура заполнялась по индексу свободных позиций), "
+                f"стратегия {strategy.name} недоступна. Выполните: python manage.py number_structure"
+            )
+        stale_field = 'open_slots_valid'
     
-    # Если не нашли место (не должно произойти в нормальных условиях)
-    return None, None
+    if getattr(state, stale_field):
+        # Размещения этой стратегии не ведут второй индекс - отмечаем его устаревшим
+        StructureState.objects.filter(pk=StructureState.SINGLETON_PK).update(**{stale_field: False})
+        transaction.on_commit(lambda: _checked_placement_strategies.add(strategy.name))
+    else:
+        _checked_placement_strategies.add(strategy.name)
 
 
 @transaction.atomic
-def place_user(user, payment):
+def create_root_node(user, tariff, strategy=None):
+    """
+    Создать корневой узел пользователя, если его еще нет.
+    
+    Корень получает путь, строку замыкания, событие журнала и, в зависимости
+    от стратегии размещения, свободные позиции индекса OpenSlot или номер 0
+    режима heap. Дополнительный корень в непустой структуре не вписывается
+    в нумерацию heap - она отмечается устаревшей (нужна number_structure).
+    
+    Args:
+        user: User объект
+        tariff: Tariff объект
+        strategy: имя стратегии размещения (по умолчанию MLM_SETTINGS['PLACEMENT_STRATEGY'])
+    
+    Returns:
+        tuple: (StructureNode, создан ли узел)
+    """
+    from .placement import get_placement_strategy
+    
+    root_node = StructureNode.objects.filter(user=user).first()
+    if root_node is not None:
+        return root_node, False
+    
+    placement_strategy = get_placement_strategy(strategy)
+    sequence = None
+    if not placement_strategy.uses_open_slots:
+        if StructureNode.objects.exists():
+            StructureState.objects.filter(pk=StructureState.SINGLETON_PK).update(sequence_valid=False)
+        else:
+            sequence = 0
+            StructureState.objects.update_or_create(
+                pk=StructureState.SINGLETON_PK,
+                defaults={'last_sequence': sequence, 'sequence_valid': True},
+            )
+    
+    root_node = StructureNode.objects.create(
+        user=user,
+        parent=None,
+        position=1,
+        level=0,
+        path=root_path(user.id),
+        tariff=tariff,
+        sequence=sequence,
+    )
+    if placement_strategy.uses_open_slots:
+        register_open_slots(root_node)
+    record_closure(root_node)
+    log_structure_change([root_node])
+    return root_node, True
+
+
+def place_user(user, payment, strategy=None):
     """
     Разместить пользователя в MLM структуре.
     
+    Безопасно при параллельных вызовах: каждая попытка выполняется в отдельной
+    точке сохранения, свободная позиция захватывается построчной блокировкой,
+    а при конфликте уникальности или таймауте блокировки попытка повторяется
+    (не более PLACEMENT_MAX_RETRIES раз).
+    
     Args:
         user: User объект для размещения
         payment: Payment объект (должен быть COMPLETED)
+        strategy: имя стратегии размещения (по умолчанию MLM_SETTINGS['PLACEMENT_STRATEGY'])
     
     Returns:
         StructureNode объект
@@ -125,9 +1243,7 @@ def place_user(user, payment):
     Raises:
         ValidationError: если размещение невозможно
     """
-    # Проверяем, что пользователь еще не размещен
-    if StructureNode.objects.filter(user=user).exists():
-        raise ValidationError(f"Пользователь {user.username} уже размещен в структуре")
+    from .placement import get_placement_strategy
     
     # Проверяем статус платежа
     if payment.status != payment.PaymentStatus.COMPLETED:
@@ -138,103 +1254,561 @@ def place_user(user, payment):
     if not tariff:
         raise ValidationError("Платеж должен иметь тариф")
     
-    # Находим родителя для размещения
-    parent_user, position = find_parent_for_new_partner(user)
+    placement_strategy = get_placement_strategy(strategy)
+    check_placement_indexes(placement_strategy)
+    return _run_with_placement_retries(
+        lambda: _place_user_once(user, tariff, placement_strategy), user.username
+    )
+
+
+def _run_with_placement_retries(attempt_func, label):
+    """
+    Выполнить попытку размещения в точке сохранения с повторами при конфликтах.
     
-    # Проверяем, найдено ли место для размещения
-    # Если есть узлы в структуре, но не найден parent, значит структура заполнена
-    if StructureNode.objects.exists() and parent_user is None and position is None:
-        raise ValidationError("Структура заполнена. Нет свободных мест для размещения нового партнера.")
+    Args:
+        attempt_func: функция одной попытки (выполняется внутри транзакции)
+        label: подпись для логов и сообщения об ошибке
     
-    # Определяем уровень
-    if parent_user is None:
-        # Это корневой пользователь (структура пуста)
-        level = 0
-        position = 1  # Корень всегда имеет позицию 1
-    else:
+    Returns:
+        Результат attempt_func
+    
+    Raises:
+        ValidationError: если все попытки завершились конфликтом
+    """
+    max_retries = settings.MLM_SETTINGS['PLACEMENT_MAX_RETRIES']
+    for attempt in range(1, max_retries + 1):
         try:
-            parent_node = StructureNode.objects.get(user=parent_user)
-            level = parent_node.level + 1
-        except StructureNode.DoesNotExist:
-            raise ValidationError(f"Родительский узел для пользователя {parent_user.username} не найден")
+            with transaction.atomic():
+                return attempt_func()
+        except (IntegrityError, OperationalError, PlacementConflict) as e:
+            # IntegrityError - позицию заняли параллельно, OperationalError - истек таймаут блокировки
+            if isinstance(e, IntegrityError):
+                # Захваченная строка индекса могла указывать на позицию, занятую в обход индекса:
+                # откат точки сохранения вернул ее, поэтому удаляем такие строки вне попытки
+                prune_occupied_open_slots()
+            if attempt == max_retries:
+                raise ValidationError(
+                    f"Не удалось разместить {label} после {max_retries} попыток: {e}"
+                )
+            logger.warning(f"⚠️ Конфликт при размещении {label} (попытка {attempt}): {e}")
+            # Небольшая случайная пауза, чтобы параллельные воркеры разошлись
+            time.sleep(random.uniform(0, PLACEMENT_RETRY_DELAY * attempt))
+
+
+def _place_user_once(user, tariff, strategy):
+    """Одна попытка размещения. Должна выполняться внутри транзакции."""
+    # Проверяем, что пользователь еще не размещен
+    if StructureNode.objects.filter(user=user).exists():
+        raise ValidationError(f"Пользователь {user.username} уже размещен в структуре")
+    
+    # Стратегия выбирает место и захватывает его (строку OpenSlot или номер узла)
+    target = strategy.claim(user)
     
     # Создаем узел структуры
     structure_node = StructureNode.objects.create(
         user=user,
-        parent=parent_user,
-        position=position or 1,  # Если корень, позиция 1
-        level=level,
-        tariff=tariff
+        parent=target.parent,
+        position=target.position,
+        level=target.level,
+        path=target.path,
+        tariff=tariff,
+        sequence=target.sequence
     )
     
+    if strategy.uses_open_slots:
+        # Свободные позиции нового узла попадают в конец фронтира
+        register_open_slots(structure_node)
+    record_closure(structure_node)
+    log_structure_change([structure_node])
+    update_ancestor_counters(structure_node)
+    
     return structure_node
 
 
-def get_structure_tree(root_user=None, max_depth=None):
+def place_users_bulk(users_with_payments, apply_bonuses=True, strategy=None):
     """
-    Получить дерево структуры для визуализации.
+    Разместить в структуре сразу много оплативших пользователей.
+    
+    Места выбирает стратегия размещения (bfs и heap - за один проход в памяти),
+    узлы, строки индекса, таблицы замыкания и бонусы записываются через bulk_create.
+    Порядок размещения совпадает с последовательными вызовами place_user.
     
     Args:
-        root_user: Корневой пользователь (если None - первый корневой)
-        max_depth: Максимальная глубина (если None - без ограничений)
+        users_with_payments: список пар (user, payment), платежи COMPLETED
+        apply_bonuses: начислить зеленые/желтые бонусы
+        strategy: имя стратегии размещения (по умолчанию MLM_SETTINGS['PLACEMENT_STRATEGY'])
     
     Returns:
-        dict: Дерево структуры
+        list: Список созданных StructureNode объектов в порядке входных данных
+    
+    Raises:
+        ValidationError: если кого-то из пользователей нельзя разместить
     """
-    if root_user is None:
-        # Находим корневой узел
-        root_node = StructureNode.objects.filter(level=0).first()
-        if not root_node:
-            return None
-        root_user = root_node.user
+    from .placement import get_placement_strategy
     
-    def build_tree(node_user, current_depth=0):
-        """Рекурсивно строим дерево."""
-        if max_depth is not None and current_depth >= max_depth:
-            return None
+    users_with_payments = list(users_with_payments)
+    if not users_with_payments:
+        return []
+    placement_strategy = get_placement_strategy(strategy)
+    
+    user_ids = [user.id for user, _ in users_with_payments]
+    if len(set(user_ids)) != len(user_ids):
+        raise ValidationError("Пользователи в пакете повторяются")
+    
+    for user, payment in users_with_payments:
+        if payment.status != payment.PaymentStatus.COMPLETED:
+            raise ValidationError(f"Платеж {payment.id} должен быть завершен перед размещением")
+        if not payment.tariff_id:
+            raise ValidationError(f"Платеж {payment.id} должен иметь тариф")
+    
+    check_placement_indexes(placement_strategy)
+    tariffs = Tariff.objects.in_bulk({payment.tariff_id for _, payment in users_with_payments})
+    
+    def attempt():
+        already_placed = set(
+            StructureNode.objects.filter(user_id__in=user_ids).values_list('user_id', flat=True)
+        )
+        if already_placed:
+            raise ValidationError(f"Пользователи уже размещены в структуре: {sorted(already_placed)}")
         
-        try:
-            node = StructureNode.objects.get(user=node_user)
-        except StructureNode.DoesNotExist:
-            return None
+        nodes = placement_strategy.allocate_bulk(users_with_payments, tariffs)
+        closure_rows = build_closure_rows(nodes)
+        StructureClosure.objects.bulk_create(closure_rows, batch_size=BULK_BATCH_SIZE)
         
-        # Получаем детей
-        children_nodes = StructureNode.objects.filter(
-            parent=node_user
-        ).select_related('user', 'tariff').order_by('position')
+        if apply_bonuses:
+            from billing.services import apply_signup_bonuses_bulk
+            
+            apply_signup_bonuses_bulk(
+                [(user, payment, node.parent_id) for node, (user, payment) in zip(nodes, users_with_payments)],
+                tariffs,
+            )
+        log_structure_change(nodes)
+        apply_ancestor_counters_bulk(closure_rows)
+        return nodes
+    
+    return _run_with_placement_retries(attempt, f"пакет из {len(users_with_payments)} пользователей")
+
+
+def allocate_frontier_nodes_bulk(users_with_payments, tariffs):
+    """Разместить пакет по индексу свободных позиций. Выполняется внутри транзакции."""
+    max_partners = settings.MLM_SETTINGS['MAX_PARTNERS_PER_LEVEL']
+    count = len(users_with_payments)
+    locked_slots = OpenSlot.objects.select_for_update(skip_locked=True, of=('self',)).order_by(*OPEN_SLOT_ORDER)
+    
+    # Очередь с приоритетом (level, path, порядок) - тот же порядок, что и OPEN_SLOT_ORDER.
+    # Новые позиции получают порядок после всех существующих, как если бы их вставили в индекс по одной.
+    frontier = []
+    next_order = (OpenSlot.objects.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+    last_fetched = None  # ключ (level, path, id) последней прочитанной из БД позиции
+    exhausted = False
+    
+    def fetch_slots():
+        """Дочитать из БД следующую страницу фронтира (не больше размера пакета)."""
+        nonlocal last_fetched, exhausted
+        queryset = locked_slots
+        if last_fetched is not None:
+            level, path, slot_id = last_fetched
+            queryset = queryset.filter(
+                Q(level__gt=level) | Q(level=level, path__gt=path) | Q(level=level, path=path, id__gt=slot_id)
+            )
+        page = list(queryset.values_list('id', 'parent_id', 'position', 'level', 'path')[:count])
+        for slot_id, parent_id, position, level, path in page:
+            heapq.heappush(frontier, ((level, path, slot_id), slot_id, parent_id, position, level, path))
+        if page:
+            last_fetched = (page[-1][3], page[-1][4], page[-1][0])
+        exhausted = len(page) < count
+    
+    fetch_slots()
+    if not frontier and StructureNode.objects.exists():
+        if OpenSlot.objects.exists():
+            raise PlacementConflict("Все свободные позиции захвачены параллельными размещениями")
+        rebuild_open_slots()
+        next_order = (OpenSlot.objects.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+        fetch_slots()
+    
+    nodes = []
+    consumed_slot_ids = []
+    for user, payment in users_with_payments:
+        # Новая позиция может оказаться раньше еще не прочитанных из БД - тогда дочитываем
+        while not exhausted and (not frontier or (frontier[0][1] is None and frontier[0][0] > last_fetched)):
+            fetch_slots()
         
-        children = []
-        for child_node in children_nodes:
-            child_tree = build_tree(child_node.user, current_depth + 1)
-            children.append({
-                'user': {
-                    'id': child_node.user.id,
-                    'username': child_node.user.username,
-                    'referral_code': child_node.user.referral_code,
-                },
-                'level': child_node.level,
-                'position': child_node.position,
-                'tariff': {
-                    'code': child_node.tariff.code if child_node.tariff else None,
-                    'name': child_node.tariff.name if child_node.tariff else None,
-                } if child_node.tariff else None,
-                'children': child_tree['children'] if child_tree else [],
-            })
+        if frontier:
+            _, slot_id, parent_id, position, level, path = heapq.heappop(frontier)
+            if slot_id is not None:
+                consumed_slot_ids.append(slot_id)
+        else:
+            # Структура пуста - первый пользователь становится корнем
+            parent_id, position, level, path = None, 1, 0, root_path(user.id)
         
-        return {
-            'user': {
-                'id': node.user.id,
-                'username': node.user.username,
-                'referral_code': node.user.referral_code,
-            },
-            'level': node.level,
-            'position': node.position,
-            'tariff': {
-                'code': node.tariff.code if node.tariff else None,
-                'name': node.tariff.name if node.tariff else None,
-            } if node.tariff else None,
-            'children': children,
-        }
+        nodes.append(StructureNode(
+            user=user,
+            parent_id=parent_id,
+            position=position,
+            level=level,
+            path=path,
+            tariff=tariffs[payment.tariff_id],
+        ))
+        for pos in range(1, max_partners + 1):
+            new_path = child_path(path, pos)
+            heapq.heappush(frontier, ((level + 1, new_path, next_order), None, user.id, pos, level + 1, new_path))
+            next_order += 1
+    
+    if consumed_slot_ids:
+        deleted, _ = OpenSlot.objects.filter(id__in=consumed_slot_ids).delete()
+        if deleted != len(consumed_slot_ids):
+            raise PlacementConflict("Часть свободных позиций занята параллельным размещением")
+    
+    StructureNode.objects.bulk_create(nodes, batch_size=BULK_BATCH_SIZE)
+    
+    # Незанятые позиции новых узлов дописываем в индекс в порядке BFS
+    new_slots = sorted(item for item in frontier if item[1] is None)
+    OpenSlot.objects.bulk_create(
+        [
+            OpenSlot(parent_id=parent_id, position=position, level=level, path=path)
+            for _, _, parent_id, position, level, path in new_slots
+        ],
+        batch_size=BULK_BATCH_SIZE,
+    )
+    return nodes
+
+
+def allocate_heap_nodes_bulk(users_with_payments, tariffs):
+    """Разместить пакет в режиме heap: выделяется диапазон номеров. Выполняется внутри транзакции."""
+    max_partners = settings.MLM_SETTINGS['MAX_PARTNERS_PER_LEVEL']
+    state, _ = StructureState.objects.select_for_update().get_or_create(pk=StructureState.SINGLETON_PK)
+    first_sequence = state.last_sequence + 1
+    
+    if first_sequence == 0 and StructureNode.objects.exists():
+        raise ValidationError(
+            "Структура не пронумерована для режима heap. Выполните: python manage.py number_structure"
+        )
+    
+    # Родители, размещенные раньше, загружаются одним запросом; остальные - из этого же пакета
+    parent_sequences = {
+        heap_parent_position(first_sequence + index, max_partners)[0]
+        for index in range(len(users_with_payments))
+    }
+    existing_parents = {
+        sequence: (user_id, level, path)
+        for sequence, user_id, level, path in StructureNode.objects.filter(
+            sequence__in=[seq for seq in parent_sequences if seq is not None and seq < first_sequence]
+        ).values_list('sequence', 'user_id', 'level', 'path')
+    }
+    
+    nodes = []
+    for index, (user, payment) in enumerate(users_with_payments):
+        sequence = first_sequence + index
+        parent_sequence, position = heap_parent_position(sequence, max_partners)
+        if parent_sequence is None:
+            parent_id, level, path = None, 0, root_path(user.id)
+        elif parent_sequence >= first_sequence:
+            parent_node = nodes[parent_sequence - first_sequence]
+            parent_id, level = parent_node.user_id, parent_node.level + 1
+            path = child_path(parent_node.path, position)
+        elif parent_sequence in existing_parents:
+            parent_user_id, parent_level, parent_path = existing_parents[parent_sequence]
+            parent_id, level = parent_user_id, parent_level + 1
+            path = child_path(parent_path, position)
+        else:
+            raise ValidationError(f"Узел с порядковым номером {parent_sequence} не найден")
+        
+        nodes.append(StructureNode(
+            user=user,
+            parent_id=parent_id,
+            position=position,
+            level=level,
+            path=path,
+            tariff=tariffs[payment.tariff_id],
+            sequence=sequence,
+        ))
+    
+    StructureNode.objects.bulk_create(nodes, batch_size=BULK_BATCH_SIZE)
+    state.last_sequence = first_sequence + len(nodes) - 1
+    state.save(update_fields=['last_sequence'])
+    return nodes
+
+
+# Ключи строк iter_subtree (совпадают с именами полей values())
+SUBTREE_FIELDS = (
+    'id', 'user_id', 'parent_id', 'level', 'position', 'path',
+    'user__username', 'user__referral_code', 'tariff_id', 'tariff__code', 'tariff__name',
+    'descendant_count',
+)
+
+# Размер пакета при чтении поддерева (fetchmany / parent__in)
+SUBTREE_CHUNK_SIZE = 2000
+
+
+def iter_subtree(root, max_depth=None, chunk_size=SUBTREE_CHUNK_SIZE):
+    """
+    Потоково прочитать поддерево в виде строк-словарей без ORM объектов.
+    
+    На PostgreSQL - один рекурсивный запрос WITH RECURSIVE через серверный курсор,
+    на остальных СУБД - по запросу parent__in на уровень (пакетами по chunk_size).
+    Строки идут в порядке BFS (уровень, затем позиции слева направо),
+    поэтому родитель всегда раньше своих детей.
+    
+    Args:
+        root: StructureNode корня поддерева
+        max_depth: Максимальная глубина относительно корня (если None - без ограничений)
+        chunk_size: размер пакета чтения
+    
+    Yields:
+        dict: Строка с ключами SUBTREE_FIELDS
+    """
+    if connection.vendor == 'postgresql':
+        yield from _iter_subtree_recursive_cte(root, max_depth, chunk_size)
+    else:
+        yield from _iter_subtree_by_levels(root, max_depth, chunk_size)
+
+
+def _iter_subtree_recursive_cte(root, max_depth, chunk_size):
+    """Поддерево одним запросом WITH RECURSIVE (PostgreSQL)."""
+    nodes = connection.ops.quote_name(StructureNode._meta.db_table)
+    users = connection.ops.quote_name(User._meta.db_table)
+    tariffs = connection.ops.quote_name(Tariff._meta.db_table)
+    params = [root.pk]
+    depth_condition = ''
+    if max_depth is not None:
+        depth_condition = 'WHERE s.depth < %s'
+        params.append(max_depth)
+    
+    sql = (
+        f"WITH RECURSIVE subtree AS ("
+        f" SELECT n.id, n.user_id, n.parent_id, n.level, n.position, n.path, n.tariff_id, n.descendant_count,"
+        f" 0 AS depth, ARRAY[n.position] AS sort_key"
+        f" FROM {nodes} n WHERE n.id = %s"
+        f" UNION ALL"
+        f" SELECT c.id, c.user_id, c.parent_id, c.level, c.position, c.path, c.tariff_id, c.descendant_count,"
+        f" s.depth + 1, s.sort_key || c.position"
+        f" FROM {nodes} c JOIN subtree s ON c.parent_id = s.user_id {depth_condition}"
+        f")"
+        f" SELECT s.id, s.user_id, s.parent_id, s.level, s.position, s.path,"
+        f" u.username, u.referral_code, s.tariff_id, t.code, t.name, s.descendant_count"
+        f" FROM subtree s"
+        f" JOIN {users} u ON u.id = s.user_id"
+        f" LEFT JOIN {tariffs} t ON t.id = s.tariff_id"
+        f" ORDER BY s.depth, s.sort_key"
+    )
+    # chunked_cursor - серверный курсор (как у QuerySet.iterator()), строки не держатся в памяти целиком
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(zip(SUBTREE_FIELDS, row))
+
+
+def _iter_subtree_by_levels(root, max_depth, chunk_size):
+    """Поддерево по уровням: один запрос parent__in на пакет родителей."""
+    yield from StructureNode.objects.filter(pk=root.pk).values(*SUBTREE_FIELDS)
+    
+    frontier = [root.user_id]
+    depth = 0
+    while frontier and (max_depth is None or depth < max_depth):
+        parent_order = {user_id: index for index, user_id in enumerate(frontier)}
+        level_rows = []
+        for start in range(0, len(frontier), chunk_size):
+            level_rows.extend(
+                StructureNode.objects.filter(parent_id__in=frontier[start:start + chunk_size]).values(*SUBTREE_FIELDS)
+            )
+        # Порядок BFS: дети в порядке родителей, у одного родителя - по позиции
+        level_rows.sort(key=lambda row: (parent_order[row['parent_id']], row['position']))
+        yield from level_rows
+        frontier = [row['user_id'] for row in level_rows]
+        depth += 1
+
+
+def structure_tree_node(row):
+    """
+    Узел дерева get_structure_tree из строки iter_subtree (без детей).
+    
+    Args:
+        row: строка с ключами SUBTREE_FIELDS
+    
+    Returns:
+        dict: Узел дерева с пустым списком children
+    """
+    return {
+        'user': {
+            'id': row['user_id'],
+            'username': row['user__username'],
+            'referral_code': row['user__referral_code'],
+        },
+        'level': row['level'],
+        'position': row['position'],
+        'tariff': {
+            'code': row['tariff__code'],
+            'name': row['tariff__name'],
+        } if row['tariff_id'] else None,
+        'children': [],
+    }
+
+
+def build_structure_tree(rows, root_user_id):
+    """
+    Собрать вложенное дерево из плоских строк за O(N).
+    
+    Args:
+        rows: строки iter_subtree (родитель раньше детей)
+        root_user_id: ID пользователя-корня
     
-    return build_tree(root_user)
+    Returns:
+        dict: Дерево структуры или None, если корня нет среди строк
+    """
+    nodes = {row['user_id']: structure_tree_node(row) for row in rows}
+    
+    for row in sorted(rows, key=lambda row: row['position']):
+        if row['user_id'] != root_user_id and row['parent_id'] in nodes:
+            nodes[row['parent_id']]['children'].append(nodes[row['user_id']])
+    return nodes.get(root_user_id)
+
+
+def get_structure_children(parent_node, after_position=None, limit=50):
+    """
+    Получить одну страницу прямых детей узла для ленивого раскрытия дерева.
+    
+    Страницы листаются по ключу (курсор - позиция последнего ребенка страницы),
+    размер downline берется из счетчиков узла.
+    
+    Args:
+        parent_node: StructureNode, детей которого нужно вернуть
+        after_position: курсор - вернуть детей с позицией больше этой
+        limit: размер страницы
+    
+    Returns:
+        dict: {'node': узел-родитель, 'children': [узлы], 'next_cursor': курсор или None}
+    """
+    queryset = StructureNode.objects.filter(parent_id=parent_node.user_id).order_by('position')
+    if after_position is not None:
+        queryset = queryset.filter(position__gt=after_position)
+    rows = list(queryset.values(*SUBTREE_FIELDS)[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    parent_row = StructureNode.objects.filter(pk=parent_node.pk).values(*SUBTREE_FIELDS).get()
+    
+    def lazy_node(row):
+        node = structure_tree_node(row)
+        del node['children']
+        node['descendant_count'] = row['descendant_count']
+        node['has_children'] = row['descendant_count'] > 0
+        return node
+    
+    return {
+        'node': lazy_node(parent_row),
+        'children': [lazy_node(row) for row in rows],
+        'next_cursor': rows[-1]['position'] if has_more else None,
+    }
+
+
+def build_structure_columnar(rows, root_user_id):
+    """
+    Собрать дерево в колоночном виде: параллельные массивы без вложенности.
+    
+    Узел i описывается элементами ids[i], parents[i], levels[i], positions[i],
+    tariffs[i], usernames[i], referral_codes[i]. parents[i] - индекс родителя
+    в этих же массивах (-1 у корня), tariffs[i] - индекс в tariff_table (-1 - без тарифа).
+    Узлы идут в порядке BFS, родитель всегда раньше детей.
+    
+    Args:
+        rows: строки iter_subtree (родитель раньше детей)
+        root_user_id: ID пользователя-корня
+    
+    Returns:
+        dict: Колоночное представление или None, если корня нет среди строк
+    """
+    index_by_user = {}
+    tariff_index = {}
+    columns = {
+        'ids': [], 'parents': [], 'levels': [], 'positions': [],
+        'tariffs': [], 'usernames': [], 'referral_codes': [],
+    }
+    tariff_table = []
+    for row in rows:
+        if row['user_id'] == root_user_id:
+            parent_index = -1
+        elif row['parent_id'] in index_by_user:
+            parent_index = index_by_user[row['parent_id']]
+        else:
+            continue
+        
+        tariff_id = row['tariff_id']
+        if tariff_id and tariff_id not in tariff_index:
+            tariff_index[tariff_id] = len(tariff_table)
+            tariff_table.append({'code': row['tariff__code'], 'name': row['tariff__name']})
+        
+        index_by_user[row['user_id']] = len(columns['ids'])
+        columns['ids'].append(row['user_id'])
+        columns['parents'].append(parent_index)
+        columns['levels'].append(row['level'])
+        columns['positions'].append(row['position'])
+        columns['tariffs'].append(tariff_index[tariff_id] if tariff_id else -1)
+        columns['usernames'].append(row['user__username'])
+        columns['referral_codes'].append(row['user__referral_code'])
+    
+    if root_user_id not in index_by_user:
+        return None
+    return {'format': 'columnar', 'count': len(columns['ids']), **columns, 'tariff_table': tariff_table}
+
+
+def get_structure_columnar(root_user=None, max_depth=None):
+    """
+    Получить дерево структуры в колоночном виде (см. build_structure_columnar).
+    
+    Args:
+        root_user: Корневой пользователь (если None - первый корневой)
+        max_depth: Максимальная глубина (если None - без ограничений)
+    
+    Returns:
+        dict: Колоночное дерево или None, если структура пуста
+    """
+    if max_depth is not None and max_depth <= 0:
+        return None
+    
+    root_node = get_structure_root(root_user)
+    if not root_node:
+        return None
+    return build_structure_columnar(iter_subtree(root_node, max_depth), root_node.user_id)
+
+
+def get_structure_root(root_user=None):
+    """
+    Найти корневой узел для дерева структуры.
+    
+    Args:
+        root_user: Корневой пользователь (если None - первый корневой)
+    
+    Returns:
+        StructureNode или None
+    """
+    if root_user is None:
+        return StructureNode.objects.filter(level=0).first()
+    return StructureNode.objects.filter(user=root_user).first()
+
 
+def get_structure_tree(root_user=None, max_depth=None):
+    """
+    Получить дерево структуры для визуализации.
+    
+    Поддерево читается через iter_subtree и собирается в памяти.
+    
+    Args:
+        root_user: Корневой пользователь (если None - первый корневой)
+        max_depth: Максимальная глубина (если None - без ограничений)
+    
+    Returns:
+        dict: Дерево структуры
+    """
+    if max_depth is not None and max_depth <= 0:
+        return None
+    
+    root_node = get_structure_root(root_user)
+    if not root_node:
+        return None
+    
+    rows = list(iter_subtree(root_node, max_depth))
+    return build_structure_tree(rows, root_node.user_id)
@@ -0,0 +1,268 @@
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.test import TestCase
+from django.utils import timezone
+
+from core.models import User
+from billing.models import Payment
+from mlm import services
+from mlm.models import Tariff, StructureNode, StructureClosure, OpenSlot, StructureState, StructureEvent
+from mlm.services import (
+    place_user, place_users_bulk, get_structure_tree, get_structure_version, number_structure,
+    rebuild_open_slots, repair_node_edit, root_path, child_path,
+)
+
+MAX_PARTNERS = 3
+
+
+class StructureTestCase(TestCase):
+    """Пользователи с оплаченными платежами и проверки производных данных структуры."""
+
+    def setUp(self):
+        self.tariff = Tariff.objects.create(code='basic', name='Basic', entry_amount=Decimal('100.00'))
+        # Кэш проверенных стратегий живет в процессе, а флаги StructureState откатываются вместе с тестом
+        services._checked_placement_strategies.clear()
+        self.next_user = 0
+
+    def _users(self, count, inviters=None):
+        """
+        Создать пользователей с завершенными платежами.
+
+        inviters: функция index -> индекс пригласившего среди создаваемых (или None)
+        """
+        users = []
+        for index in range(count):
+            inviter = None
+            if inviters is not None and index:
+                inviter = users[inviters(index)][0]
+            self.next_user += 1
+            user = User.objects.create(
+                username=f'user{self.next_user}',
+                referral_code=f'REF{self.next_user}',
+                invited_by=inviter,
+            )
+            payment = Payment.objects.create(
+                user=user,
+                tariff=self.tariff,
+                amount=self.tariff.entry_amount,
+                status=Payment.PaymentStatus.COMPLETED,
+                completed_at=timezone.now(),
+            )
+            users.append((user, payment))
+        return users
+
+    def _place(self, users, strategy='bfs', bulk=False):
+        if bulk:
+            return place_users_bulk(users, apply_bonuses=False, strategy=strategy)
+        return [place_user(user, payment, strategy=strategy) for user, payment in users]
+
+    def _layout(self, users):
+        """Место каждого пользователя: (индекс родителя в списке, позиция, уровень)."""
+        index = {user.pk: position for position, (user, _) in enumerate(users)}
+        nodes = {node.user_id: node for node in StructureNode.objects.filter(user__in=[user for user, _ in users])}
+        return [
+            (index.get(nodes[user.pk].parent_id), nodes[user.pk].position, nodes[user.pk].level)
+            for user, _ in users
+        ]
+
+    def _reset_structure(self):
+        for model in (StructureClosure, OpenSlot, StructureEvent, StructureNode, StructureState):
+            model.objects.all().delete()
+        services._checked_placement_strategies.clear()
+
+    def assertIndexesConsistent(self, open_slots=True):
+        """Пути, уровни, таблица замыкания, счетчики и индекс свободных позиций соответствуют полю parent."""
+        nodes = {node.user_id: node for node in StructureNode.objects.all()}
+        closure = set(StructureClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth'))
+        expected_closure = set()
+        for node in nodes.values():
+            parent = nodes.get(node.parent_id)
+            if parent is None:
+                self.assertEqual((node.level, node.path), (0, root_path(node.user_id)))
+            else:
+                self.assertEqual(node.level, parent.level + 1)
+                self.assertEqual(node.path, child_path(parent.path, node.position))
+            ancestor, depth = node, 0
+            while ancestor is not None:
+                expected_closure.add((ancestor.user_id, node.user_id, depth))
+                ancestor, depth = nodes.get(ancestor.parent_id), depth + 1
+        self.assertEqual(closure, expected_closure)
+
+        for node in nodes.values():
+            depths = [depth for ancestor_id, _, depth in closure if ancestor_id == node.user_id and depth]
+            self.assertEqual(node.descendant_count, len(depths))
+            self.assertEqual(node.max_descendant_depth, max(depths, default=0))
+
+        if open_slots:
+            taken = {(node.parent_id, node.position) for node in nodes.values()}
+            free = {
+                (user_id, position, nodes[user_id].level + 1, child_path(nodes[user_id].path, position))
+                for user_id in nodes
+                for position in range(1, MAX_PARTNERS + 1)
+                if (user_id, position) not in taken
+            }
+            self.assertEqual(set(OpenSlot.objects.values_list('parent_id', 'position', 'level', 'path')), free)
+
+
+class PlacementOrderTests(StructureTestCase):
+    """Размещение заполняет дерево в порядке BFS: родитель i-го узла - узел (i-1)//3."""
+
+    def test_bfs_parent_is_previous_level_index(self):
+        for strategy in ('bfs', 'heap'):
+            for bulk in (False, True):
+                with self.subTest(strategy=strategy, bulk=bulk):
+                    self._reset_structure()
+                    users = self._users(40)
+                    self._place(users, strategy=strategy, bulk=bulk)
+                    layout = self._layout(users)
+                    self.assertEqual(layout[0], (None, 1, 0))
+                    for index in range(1, len(users)):
+                        parent = (index - 1) // MAX_PARTNERS
+                        self.assertEqual(
+                            layout[index],
+                            (parent, (index - 1) % MAX_PARTNERS + 1, layout[parent][2] + 1),
+                        )
+
+    def test_bulk_matches_sequential_placement(self):
+        for strategy in ('bfs', 'spillover', 'balanced-leg', 'heap'):
+            with self.subTest(strategy=strategy):
+                layouts = []
+                for bulk in (False, True):
+                    self._reset_structure()
+                    users = self._users(60, inviters=lambda index: (index * 7) % index)
+                    # Часть структуры уже размещена по одному: пакет продолжает существующий фронтир
+                    self._place(users[:10], strategy=strategy)
+                    self._place(users[10:], strategy=strategy, bulk=bulk)
+                    layouts.append(self._layout(users))
+                self.assertEqual(layouts[0], layouts[1])
+
+    def test_indexes_consistent_after_placement(self):
+        for strategy in ('bfs', 'spillover', 'heap'):
+            for bulk in (False, True):
+                with self.subTest(strategy=strategy, bulk=bulk):
+                    self._reset_structure()
+                    users = self._users(50, inviters=lambda index: index // 2)
+                    self._place(users[:5], strategy=strategy)
+                    self._place(users[5:], strategy=strategy, bulk=bulk)
+                    self.assertIndexesConsistent(open_slots=strategy != 'heap')
+
+    def test_already_placed_user_is_refused(self):
+        (user, payment), = self._users(1)
+        place_user(user, payment)
+        with self.assertRaises(ValidationError):
+            place_user(user, payment)
+
+
+class StrategySwitchTests(StructureTestCase):
+    """Смена стратегии на живой структуре требует перестроить индекс новой стратегии."""
+
+    def _restart(self):
+        # PLACEMENT_STRATEGY меняется перезапуском процесса - кэш проверенных стратегий сбрасывается
+        services._checked_placement_strategies.clear()
+
+    def test_switch_is_refused_until_index_rebuilt(self):
+        self._place(self._users(10), strategy='bfs')
+        self._restart()
+        (user, payment), = self._users(1)
+        with self.assertRaisesMessage(ValidationError, 'number_structure'):
+            place_user(user, payment, strategy='heap')
+
+        number_structure()
+        place_user(user, payment, strategy='heap')
+
+        self._restart()
+        (user, payment), = self._users(1)
+        with self.assertRaisesMessage(ValidationError, 'rebuild_open_slots'):
+            place_user(user, payment, strategy='bfs')
+
+        rebuild_open_slots()
+        place_user(user, payment, strategy='bfs')
+        self.assertIndexesConsistent()
+
+    def test_bulk_switch_is_refused(self):
+        self._place(self._users(5), strategy='heap')
+        self._restart()
+        with self.assertRaises(ValidationError):
+            place_users_bulk(self._users(3), apply_bonuses=False, strategy='bfs')
+
+
+class StructureTreeTests(StructureTestCase):
+    """get_structure_tree совпадает с деревом, построенным по полю parent."""
+
+    def _expected_tree(self, node, nodes, children, max_depth):
+        return {
+            'user': {'id': node.user_id, 'username': node.user.username, 'referral_code': node.user.referral_code},
+            'level': node.level,
+            'position': node.position,
+            'tariff': {'code': node.tariff.code, 'name': node.tariff.name} if node.tariff_id else None,
+            'children': [
+                self._expected_tree(child, nodes, children, None if max_depth is None else max_depth - 1)
+                for child in sorted(children.get(node.user_id, []), key=lambda child: child.position)
+            ] if max_depth is None or max_depth > 0 else [],
+        }
+
+    def test_tree_matches_parent_links_for_each_depth(self):
+        users = self._users(45)
+        self._place(users)
+        nodes = {node.user_id: node for node in StructureNode.objects.select_related('user', 'tariff')}
+        children = {}
+        for node in nodes.values():
+            children.setdefault(node.parent_id, []).append(node)
+
+        for root_user in (None, users[2][0]):
+            root = nodes[(root_user or users[0][0]).pk]
+            for max_depth in (None, 1, 2, 3, 10):
+                with self.subTest(root=root.user.username, max_depth=max_depth):
+                    self.assertEqual(
+                        get_structure_tree(root_user, max_depth),
+                        self._expected_tree(root, nodes, children, max_depth),
+                    )
+        self.assertIsNone(get_structure_tree(None, 0))
+
+
+class AdminRepairTests(StructureTestCase):
+    """Правка узла в админке пересчитывает производные данные только его поддерева."""
+
+    def test_move_and_delete_keep_indexes_consistent(self):
+        users = self._users(30)
+        self._place(users)
+        node = StructureNode.objects.get(user=users[2][0])
+        before = StructureNode.objects.get(pk=node.pk)
+        node.parent = users[20][0]
+        node.position = 1
+        node.full_clean()
+        node.save()
+        repair_node_edit(before, node)
+        self.assertIndexesConsistent()
+
+        deleted = StructureNode.objects.get(user=users[1][0])
+        deleted.delete()
+        repair_node_edit(deleted, None)
+        self.assertIndexesConsistent()
+
+        place_user(*self._users(1)[0])
+        self.assertIndexesConsistent()
+
+    def test_move_into_own_subtree_is_rejected(self):
+        users = self._users(10)
+        self._place(users)
+        node = StructureNode.objects.get(user=users[1][0])
+        node.parent = users[4][0]
+        with self.assertRaises(ValidationError):
+            node.full_clean()
+
+
+class StructureVersionTests(StructureTestCase):
+    """Версия структуры присваивается событиям после commit."""
+
+    def test_version_is_published_after_commit(self):
+        (user, payment), = self._users(1)
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                place_user(user, payment)
+                self.assertEqual(get_structure_version(), 0)
+                self.assertTrue(StructureEvent.objects.filter(version=None).exists())
+        self.assertEqual(get_structure_version(), 1)
+        self.assertEqual(list(StructureEvent.objects.values_list('user_id', 'version')), [(user.pk, 1)])
@@ -32,6 +32,13 @@ timeout 300 python manage.py collectstatic --noinput || echo "⚠️  Static fil
 echo "🔄 Applying migrations..."
 timeout 300 python manage.py migrate --noinput || echo "⚠️  Migrations timeout or failed"
 
+# Заполнение материализованных путей структуры (пакетами, повторный запуск продолжает с места остановки)
+echo "🌳 Backfilling structure paths..."
+timeout 300 python manage.py backfill_structure_paths || echo "⚠️  Structure paths backfill timeout or failed"
+timeout 300 python manage.py backfill_structure_closure || echo "⚠️  Structure closure backfill timeout or failed"
+timeout 300 python manage.py rebuild_downline_counters --if-stale || echo "⚠️  Downline counters rebuild timeout or failed"
+timeout 300 python manage.py rebuild_bonus_totals --if-stale || echo "⚠️  Bonus totals rebuild timeout or failed"
+
 # Создание администратора (если указаны переменные окружения)
 if [ -n "$ADMIN_PASSWORD" ]; then
     echo "👤 Creating/updating admin user..."
@@ -45,6 +52,24 @@ else
     echo "ℹ️  ADMIN_PASSWORD not set, skipping admin creation"
 fi
 
+# Воркер очереди завершения регистраций (если включен REGISTRATION_COMPLETION_ASYNC: /api/complete/ отвечает 202 и ставит задачу)
+# Значение настройки читаем через Django, чтобы разбор булевых значений совпадал с django-environ
+COMPLETION_ASYNC=$(python manage.py shell -c "from django.conf import settings; print(settings.REGISTRATION_COMPLETION_ASYNC)" 2>/dev/null | tail -n 1)
+if [ "$COMPLETION_ASYNC" = "True" ]; then
+    echo "📥 Starting registration completion worker..."
+    (while true; do
+        python manage.py process_completion_jobs || echo "⚠️  Completion worker exited, restarting..."
+        sleep 5
+    done) &
+fi
+
+# Воркер уведомлений платежного провайдера (вебхук только сохраняет их во входящую очередь)
+echo "💳 Starting payment notifications worker..."
+(while true; do
+    python manage.py process_payment_notifications || echo "⚠️  Payment notifications worker exited, restarting..."
+    sleep 5
+done) &
+
 # Запуск Gunicorn
 echo "🌐 Starting Gunicorn..."
 # Устанавливаем переменную для главного процесса
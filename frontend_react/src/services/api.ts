@@ -5,6 +5,10 @@ import axios from 'axios'
 
 const API_URL = import.meta.env.VITE_API_URL || 'http://localhost:8000'
 
+// Ожидание задачи завершения регистрации: опрос раз в секунду, не дольше минуты
+const COMPLETION_POLL_INTERVAL_MS = 1000
+const COMPLETION_POLL_ATTEMPTS = 60
+
 const api = axios.create({
   baseURL: API_URL,
   headers: {
@@ -131,7 +135,23 @@ export const apiService = {
       { user_id: userId },
       { headers }
     )
-    return response.data
+    if (response.status !== 202) {
+      return response.data
+    }
+
+    // Завершение поставлено в очередь: ждем, пока воркер выполнит задачу
+    const jobId = response.data.job_id
+    for (let attempt = 0; attempt < COMPLETION_POLL_ATTEMPTS; attempt++) {
+      await new Promise((resolve) => setTimeout(resolve, COMPLETION_POLL_INTERVAL_MS))
+      const job = await api.get(`/api/complete/jobs/${jobId}/`, { headers })
+      if (job.data.status === 'DONE') {
+        return job.data.result
+      }
+      if (job.data.status === 'FAILED') {
+        throw new Error(job.data.error || 'Ошибка завершения регистрации')
+      }
+    }
+    throw new Error(`Задача #${jobId} не выполнена за ${(COMPLETION_POLL_ATTEMPTS * COMPLETION_POLL_INTERVAL_MS) / 1000} с: воркер очереди не отвечает, проверьте статус позже`)
   },
 }
 